@@ -25,11 +25,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'django_db_app.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django_db_app.replicas.ReplicaMiddleware',
+    'django_db_app.admission.AdmissionMiddleware',
+    'django_db_app.profiling.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -95,3 +99,145 @@ STATIC_URL = 'static/'
 
 # Default primary key field type.
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Catalog metadata registry (see `django_db_app.registry`).
+# Max age in seconds of the per-process copy of Parameter/Measure/EnumValue.
+METADATA_REGISTRY_TTL = 300
+
+# Max age in seconds of the per-process category subtree rollup
+# (see `django_db_app.rollup`).
+CATEGORY_ROLLUP_TTL = 300
+
+# Max age in seconds of the per-process numeric parameter matrix
+# (see `django_db_app.analytics`).
+NUMERIC_ANALYTICS_TTL = 300
+
+# Admin changelists for large tables: estimated row counts above the
+# threshold, bounded list filters, no full result count.
+ADMIN_SCALE_MODE = False
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+
+# Opt-in per-request profiling for staff (see `django_db_app.profiling`).
+# A profile is taken for `?_profile=1` or `X-Profile: 1`, at most one at a
+# time and PROFILING_RATE_LIMIT per minute; the last PROFILING_KEEP are kept.
+PROFILING_ENABLED = False
+PROFILING_DIR = BASE_DIR / 'profiles'
+PROFILING_INTERVAL = 0.005
+PROFILING_RATE_LIMIT = 6
+PROFILING_KEEP = 50
+
+# Prometheus metrics at /metrics (see `django_db_app.metrics`). With several
+# worker processes set METRICS_MULTIPROCESS_DIR to a directory shared by
+# them; each process writes its totals there every METRICS_FLUSH_INTERVAL
+# seconds. Clear the directory on deploy.
+METRICS_MULTIPROCESS_DIR = None
+METRICS_FLUSH_INTERVAL = 5
+
+# Catalog change log (see `django_db_app.changes`): max changes per batch,
+# and age in days after which delete records are dropped by compaction.
+CATALOG_CHANGES_BATCH_SIZE = 1000
+CATALOG_CHANGES_TOMBSTONE_DAYS = 30
+
+# Warm-up in db_admin/wsgi.py before serving (before fork with
+# `gunicorn --preload`), see `django_db_app.warmup`.
+WARMUP_ON_STARTUP = False
+WARMUP_ANALYTICS = False
+WARMUP_GC_FREEZE = True
+
+# Batch product parameter lookup (POST /products/params/): max request body
+# in bytes, products and parameter names per request.
+BATCH_PARAMS_MAX_BODY = 65536
+BATCH_PARAMS_MAX_PRODUCTS = 500
+BATCH_PARAMS_MAX_PARAMS = 100
+
+# Per-process LRU cache of resolved product parameters for the product
+# page (see `django_db_app.paramcache`): max entries and max age in seconds.
+# Set PRODUCT_PARAMS_CACHE_ALIAS to a CACHES alias to share entries between
+# processes as well.
+PRODUCT_PARAMS_CACHE_SIZE = 10000
+PRODUCT_PARAMS_CACHE_TTL = 300
+PRODUCT_PARAMS_CACHE_ALIAS = None
+
+# Optional catalog sharding by top-level category (see
+# `django_db_app.sharding`). List DATABASES aliases with 'default' first,
+# e.g. ['default', 'catalog_1']; fewer than two disables sharding. Migrate
+# each shard with `migrate --database <alias>`, then run
+# `manage.py catalog_shards init`.
+DATABASE_ROUTERS = ['django_db_app.replicas.ReplicaRouter',
+                    'django_db_app.sharding.ShardRouter']
+CATALOG_SHARDS = []
+CATALOG_SHARD_DIRECTORY_TTL = 60
+
+# Background report exports (see `django_db_app.jobs`), run by
+# `manage.py export_jobs worker`: threads per worker process, queue poll
+# interval and seconds without a heartbeat after which a running job is
+# requeued. Finished files are kept in EXPORT_JOBS_DIR for EXPORT_JOBS_KEEP
+# seconds. On SQLite, progress is only visible during an export in WAL mode.
+EXPORT_JOBS_DIR = BASE_DIR / 'exports'
+EXPORT_JOBS_KEEP = 24 * 3600
+EXPORT_JOBS_CONCURRENCY = 2
+EXPORT_JOBS_POLL_INTERVAL = 1
+EXPORT_JOBS_STALE_AFTER = 60
+
+# Admission control for expensive pages (see `django_db_app.admission`):
+# routes mapped to cost classes, per-class concurrency limit, wait queue
+# size, queue timeout and per-user budget. Slots are lock files in
+# ADMISSION_DIR shared by all worker processes on the host.
+ADMISSION_ENABLED = True
+ADMISSION_DIR = BASE_DIR / 'admission'
+ADMISSION_CLASSES = {
+    'heavy': {'limit': 2, 'queue': 8, 'timeout': 15, 'per_user': 2,
+              'retry_after': 10},
+    'medium': {'limit': 4, 'queue': 16, 'timeout': 5, 'per_user': 3,
+               'retry_after': 2},
+}
+ADMISSION_ROUTES = {
+    'all_products_with_params': 'heavy',
+    'products_with_aggregate_params': 'heavy',
+    'products_with_params': 'medium',
+    'batch_product_params': 'medium',
+    'similar_products': 'medium',
+    'products_by_param': 'medium',
+    'parameter_stats': 'medium',
+}
+
+# Stock reservations (see `django_db_app.stock`): default and max seconds
+# before an unconfirmed reservation expires and returns its stock, max
+# products per reservation, max operations per write transaction and how
+# often expired reservations are swept while serving reservations.
+STOCK_RESERVATION_TTL = 600
+STOCK_RESERVATION_MAX_TTL = 3600
+STOCK_RESERVATION_MAX_ITEMS = 100
+STOCK_BATCH_SIZE = 100
+STOCK_RESERVATION_SWEEP_INTERVAL = 10
+
+# Read replicas for reports, exports and read APIs (see
+# `django_db_app.replicas`): primary alias -> replica alias, e.g.
+# {'default': 'reports'} with
+#     'reports': {'ENGINE': 'django.db.backends.sqlite3',
+#                 'NAME': BASE_DIR / 'reports.sqlite3',
+#                 'OPTIONS': {'init_command': 'PRAGMA query_only = ON'}}
+# in DATABASES (or a PostgreSQL standby). A replica is used while it is at
+# most REPLICA_MAX_LAG seconds behind and has the client's last write; its
+# position is checked every REPLICA_CHECK_INTERVAL seconds. A SQLite copy is
+# refreshed by `manage.py report_replicas refresh --watch` every
+# REPLICA_REFRESH_INTERVAL seconds.
+DATABASE_REPLICAS = {}
+REPLICA_MAX_LAG = 30
+REPLICA_CHECK_INTERVAL = 2
+REPLICA_REFRESH_INTERVAL = 10
+
+# Parallel report exports (see `django_db_app.parallel`): exports of at least
+# PARALLEL_REPORTS_MIN_PRODUCTS products are split into product id ranges of
+# PARALLEL_REPORTS_CHUNK_SIZE and built by a pool of PARALLEL_REPORTS_WORKERS
+# processes (0 or 1 builds them in the serving process). Benchmark with
+# `manage.py export_jobs bench`.
+PARALLEL_REPORTS_WORKERS = 0
+PARALLEL_REPORTS_MIN_PRODUCTS = 20000
+PARALLEL_REPORTS_CHUNK_SIZE = 5000
+
+# HTML report tables rendered without the template loop and streamed in
+# chunks of REPORT_TABLE_CHUNK_SIZE characters (see `django_db_app.tables`).
+REPORT_FAST_TABLES = True
+REPORT_TABLE_CHUNK_SIZE = 65536
@@ -1,8 +1,14 @@
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'db_admin.settings')
 
 application = get_wsgi_application()
+
+# Прогрев до приёма запросов (до fork при `gunicorn --preload`).
+if getattr(settings, 'WARMUP_ON_STARTUP', False):
+    from django_db_app.warmup import warm_up
+    warm_up()
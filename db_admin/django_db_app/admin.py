@@ -1,11 +1,119 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.template.response import TemplateResponse
+from django.utils.functional import cached_property
 from django import forms
+from .bulk import (adjust_prices, clear_param_value, hoist_param,
+                   set_param_value)
+from .db import estimate_row_count
 from .models import Measure, Category, Product, EnumValue, Parameter, ParameterValue, ParameterAggregate
+from .registry import registry
+
+
+# Режим больших таблиц (ADMIN_SCALE_MODE): оценка числа строк вместо
+# COUNT(*), ограниченные списки фильтров, без подсчёта полного размера.
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if (getattr(settings, 'ADMIN_SCALE_MODE', False) and
+                hasattr(queryset, 'query') and not queryset.query.where):
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if (estimate is not None and estimate >
+                    getattr(settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 0)):
+                return estimate
+        return super().count
+
+
+def lookup_category_id(value):
+    """Идентификатор категории из параметра фильтра; некорректное значение
+    админка показывает как ошибку фильтра, а не как ошибку сервера."""
+    try:
+        return int(value)
+    except ValueError as e:
+        raise IncorrectLookupParameters(e) from e
+
+
+class SubtreeListFilter(admin.SimpleListFilter):
+    """Фильтр по поддереву корневой категории."""
+    title = 'Раздел'
+    parameter_name = 'subtree'
+    category_field = 'id'
+
+    def lookups(self, request, model_admin):
+        return Category.objects.filter(
+            parent__isnull=True, is_enum=False
+        ).order_by('name').values_list('id', 'name')
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        ids = Category(pk=lookup_category_id(self.value())).get_subtree_ids()
+        return queryset.filter(**{f'{self.category_field}__in': ids})
+
+
+class ProductSubtreeListFilter(SubtreeListFilter):
+    category_field = 'category_id'
+
+
+class EnumCategoryListFilter(admin.SimpleListFilter):
+    title = 'Перечисление'
+    parameter_name = 'category'
+
+    def lookups(self, request, model_admin):
+        return Category.objects.filter(
+            is_enum=True
+        ).order_by('name').values_list('id', 'name')
+
+    def queryset(self, request, queryset):
+        if not self.value():
+            return queryset
+        return queryset.filter(category_id=lookup_category_id(self.value()))
+
+
+class ScaleModeAdmin(admin.ModelAdmin):
+    """Список, рассчитанный на таблицы с миллионами строк.
+
+    Для списка объектов загружаются только поля из `changelist_only`
+    вместе со связанными объектами из `list_select_related`; в режиме
+    больших таблиц фильтры заменяются на `scale_list_filter`.
+    """
+    paginator = EstimatedCountPaginator
+    changelist_only = ()
+    scale_list_filter = None
+
+    @property
+    def show_full_result_count(self):
+        return not getattr(settings, 'ADMIN_SCALE_MODE', False)
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        match = request.resolver_match
+        if (self.changelist_only and match and
+                match.url_name.endswith('_changelist')):
+            queryset = queryset.select_related(
+                *self.list_select_related
+            ).only(*self.changelist_only)
+        return queryset
+
+    def get_list_filter(self, request):
+        if (getattr(settings, 'ADMIN_SCALE_MODE', False) and
+                self.scale_list_filter is not None):
+            return self.scale_list_filter
+        return super().get_list_filter(request)
 
 
 @admin.register(Measure)
-class MeasureAdmin(admin.ModelAdmin):
-    list_display = ('name', 'name_short')
+class MeasureAdmin(ScaleModeAdmin):
+    list_display = ('name', 'name_short', 'base', 'factor')
+    list_select_related = ('base',)
+    autocomplete_fields = ('base',)
     search_fields = ('name', 'name_short')
     ordering = ('name',)
 
@@ -29,14 +137,131 @@ class CategoryForm(forms.ModelForm):
         return cleaned_data
 
 
+class SubtreeParamForm(forms.Form):
+    param = forms.ModelChoiceField(
+        queryset=Parameter.objects.all(),
+        label='Параметр',
+    )
+    value = forms.CharField(
+        label='Значение',
+        required=False,
+        help_text="Для параметра типа 'enum' укажите код значения.",
+    )
+
+
+class SubtreePriceForm(forms.Form):
+    percent = forms.DecimalField(
+        label='Изменение, %',
+        required=False,
+    )
+    amount = forms.DecimalField(
+        label='Изменение на сумму',
+        required=False,
+        decimal_places=2,
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if (cleaned_data.get('percent') is None and
+                cleaned_data.get('amount') is None):
+            raise forms.ValidationError(
+                "Укажите процент или сумму изменения цены."
+            )
+        return cleaned_data
+
+
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ScaleModeAdmin):
     form = CategoryForm
     list_display = ('name', 'parent', 'is_enum', 'measure')
+    list_select_related = ('parent', 'measure')
+    changelist_only = ('name', 'is_enum', 'parent__name', 'measure__id')
     list_filter = ('is_enum', 'parent')
+    scale_list_filter = ('is_enum', SubtreeListFilter)
     search_fields = ('name',)
     ordering = ('name',)
     raw_id_fields = ('parent',)
+    autocomplete_fields = ('measure',)
+    actions = ('subtree_set_param', 'subtree_clear_param',
+               'subtree_hoist_param', 'subtree_reprice')
+
+    def run_subtree_action(self, request, queryset, form_class, action,
+                           done_message, operation):
+        if 'apply' in request.POST:
+            form = form_class(request.POST)
+            if form.is_valid():
+                # Вложенные выбранные категории уже входят в поддерево
+                # выбранного предка и повторно не обрабатываются.
+                selected = {category.id for category in queryset}
+                parents = dict(Category.objects.values_list('id',
+                                                            'parent_id'))
+                totals = {}
+                try:
+                    for category in queryset:
+                        parent_id = parents.get(category.id)
+                        while parent_id and parent_id not in selected:
+                            parent_id = parents.get(parent_id)
+                        if parent_id:
+                            continue
+                        result = operation(category, form.cleaned_data)
+                        for key, value in result.items():
+                            totals[key] = totals.get(key, 0) + value
+                except ValidationError as e:
+                    self.message_user(request, '; '.join(e.messages),
+                                      messages.ERROR)
+                    return None
+                summary = ', '.join(f'{key}: {value}'
+                                    for key, value in totals.items())
+                self.message_user(request, f'{done_message} — {summary}.',
+                                  messages.SUCCESS)
+                return None
+        else:
+            form = form_class()
+
+        return TemplateResponse(request, 'admin/bulk_subtree.html', {
+            **self.admin_site.each_context(request),
+            'title': action.short_description,
+            'opts': self.model._meta,
+            'form': form,
+            'queryset': queryset,
+            'action': request.POST['action'],
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        })
+
+    @admin.action(description='Задать значение параметра изделиям поддерева')
+    def subtree_set_param(self, request, queryset):
+        return self.run_subtree_action(
+            request, queryset, SubtreeParamForm, self.subtree_set_param,
+            'Значение параметра задано',
+            lambda category, data: set_param_value(category, data['param'],
+                                                   data['value'])
+        )
+
+    @admin.action(description='Удалить значения параметра у изделий поддерева')
+    def subtree_clear_param(self, request, queryset):
+        return self.run_subtree_action(
+            request, queryset, SubtreeParamForm, self.subtree_clear_param,
+            'Значения параметра удалены',
+            lambda category, data: clear_param_value(category, data['param'])
+        )
+
+    @admin.action(description='Перенести параметр на уровень категорий')
+    def subtree_hoist_param(self, request, queryset):
+        return self.run_subtree_action(
+            request, queryset, SubtreeParamForm, self.subtree_hoist_param,
+            'Параметр перенесён на уровень категорий',
+            lambda category, data: hoist_param(category, data['param'])
+        )
+
+    @admin.action(description='Изменить цены изделий поддерева')
+    def subtree_reprice(self, request, queryset):
+        return self.run_subtree_action(
+            request, queryset, SubtreePriceForm, self.subtree_reprice,
+            'Цены изменены',
+            lambda category, data: adjust_prices(
+                category, percent=data['percent'], amount=data['amount']
+            )
+        )
 
     def get_form(self, request, obj=None, **kwargs):
         form = super().get_form(request, obj, **kwargs)
@@ -45,11 +270,26 @@ class CategoryAdmin(admin.ModelAdmin):
         )
         return form
 
+    def get_search_results(self, request, queryset, search_term):
+        queryset, may_have_duplicates = super().get_search_results(
+            request, queryset, search_term
+        )
+        # Автодополнение предлагает только допустимые для поля категории.
+        source = (request.GET.get('model_name'), request.GET.get('field_name'))
+        if source in (('enumvalue', 'category'), ('parameter', 'enum')):
+            queryset = queryset.filter(is_enum=True)
+        elif source == ('category', 'parent'):
+            queryset = queryset.filter(is_enum=False)
+        return queryset, may_have_duplicates
+
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(ScaleModeAdmin):
     list_display = ('name', 'category', 'amount', 'price')
+    list_select_related = ('category',)
+    changelist_only = ('name', 'amount', 'price', 'category__name')
     list_filter = ('category',)
+    scale_list_filter = (ProductSubtreeListFilter,)
     search_fields = ('name',)
     ordering = ('category', 'name')
     raw_id_fields = ('category',)
@@ -73,16 +313,18 @@ class EnumValueForm(forms.ModelForm):
 
 
 @admin.register(EnumValue)
-class EnumValueAdmin(admin.ModelAdmin):
+class EnumValueAdmin(ScaleModeAdmin):
     form = EnumValueForm
     list_display = ('category', 'code', 'priority', 'get_value')
+    list_select_related = ('category',)
     list_filter = ('category',)
+    scale_list_filter = (EnumCategoryListFilter,)
     search_fields = ('code', 'value_str')
     ordering = ('category', 'priority', 'code')
+    autocomplete_fields = ('category',)
 
     def get_value(self, obj):
-        return (obj.value_str or obj.value_int or
-                obj.value_real or obj.value_path)
+        return obj.display_value
 
     get_value.short_description = 'Значение'
 
@@ -111,12 +353,14 @@ class ParameterForm(forms.ModelForm):
 
 
 @admin.register(Parameter)
-class ParameterAdmin(admin.ModelAdmin):
+class ParameterAdmin(ScaleModeAdmin):
     form = ParameterForm
     list_display = ('name', 'name_short', 'data_type', 'measure', 'enum')
+    list_select_related = ('measure', 'enum')
     list_filter = ('data_type',)
     search_fields = ('name', 'name_short')
     ordering = ('name',)
+    autocomplete_fields = ('measure', 'enum')
 
     def get_form(self, request, obj=None, **kwargs):
         form = super().get_form(request, obj, **kwargs)
@@ -151,22 +395,42 @@ class ParameterValueForm(forms.ModelForm):
 
 
 @admin.register(ParameterValue)
-class ParameterValueAdmin(admin.ModelAdmin):
+class ParameterValueAdmin(ScaleModeAdmin):
     form = ParameterValueForm
     list_display = ('param', 'get_parent', 'get_value')
+    list_select_related = ('param', 'product', 'category')
+    changelist_only = ('param__name', 'product__name', 'category__name',
+                       'display_value')
     list_filter = ('param',)
     search_fields = ('param__name', 'value_str')
     raw_id_fields = ('product', 'category', 'param', 'value_enum')
 
+    def get_search_results(self, request, queryset, search_term):
+        if not getattr(settings, 'ADMIN_SCALE_MODE', False):
+            return super().get_search_results(request, queryset, search_term)
+        # В режиме больших таблиц параметры ищутся по справочнику в памяти,
+        # а строки значений отбираются по индексу param_id вместо
+        # LIKE '%...%' с JOIN; значение строки — только точное.
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        term_lower = term.lower()
+        param_ids = [
+            meta.id for meta in registry.get().params.values()
+            if term_lower in meta.name.lower() or
+            term_lower == meta.name_short.lower()
+        ]
+        return queryset.filter(
+            Q(param_id__in=param_ids) | Q(value_str=term)
+        ), False
+
     def get_parent(self, obj):
         return obj.product or obj.category
 
     get_parent.short_description = 'Объект'
 
     def get_value(self, obj):
-        return (obj.value_str or obj.value_int or
-                obj.value_real or obj.value_path or
-                (obj.value_enum.code if obj.value_enum else None))
+        return obj.display_value
 
     get_value.short_description = 'Значение'
 
@@ -180,8 +444,10 @@ class ParameterValueAdmin(admin.ModelAdmin):
 
 
 @admin.register(ParameterAggregate)
-class ParameterAggregateAdmin(admin.ModelAdmin):
+class ParameterAggregateAdmin(ScaleModeAdmin):
     list_display = ('parent_param', 'param')
+    list_select_related = ('parent_param', 'param')
+    changelist_only = ('parent_param__name', 'param__name')
     list_filter = ('parent_param',)
     search_fields = ('parent_param__name', 'param__name')
     raw_id_fields = ('parent_param', 'param')
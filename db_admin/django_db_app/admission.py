@@ -0,0 +1,264 @@
+"""Ограничение одновременных запросов к дорогим страницам.
+
+Маршруты `django_db_app` из `ADMISSION_ROUTES` относятся к классам
+стоимости `ADMISSION_CLASSES`; остальные страницы не ограничиваются.
+Для каждого класса задаются:
+
+* `limit` — сколько запросов класса выполняется одновременно;
+* `queue` — сколько запросов может ждать свободного места; если очередь
+  заполнена, запрос сразу получает 503 с `Retry-After`;
+* `timeout` — сколько секунд запрос ждёт в очереди до ответа 503;
+* `per_user` — сколько запросов класса (выполняемых и ждущих) может быть у
+  одного пользователя; сверх этого — 429 с `Retry-After`;
+* `retry_after` — значение заголовка `Retry-After`, секунды.
+
+Места — файлы в `ADMISSION_DIR`, занятые блокировкой `flock`, поэтому
+ограничения общие для всех процессов сервера на машине, а место
+завершившегося процесса освобождается системой. Без `fcntl` (Windows)
+ограничения действуют в пределах процесса. Ожидающий запрос опрашивает
+места, порядок обслуживания очереди не гарантируется.
+
+Место потоковой выгрузки освобождается после отправки ответа. Анонимные
+запросы занимают те же места класса, а ограничение `per_user` для них
+действует по адресу клиента (`REMOTE_ADDR`).
+
+Метрики: `catalog_admission_requests_total` по классу и итогу
+(`admitted` — сразу, `waited` — после ожидания, `rejected_queue`,
+`rejected_timeout`, `rejected_user`), `catalog_admission_released_total`
+(число выполняемых запросов — разность допущенных и освобождённых) и
+время ожидания `catalog_admission_wait_seconds`.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from .metrics import admission_released, admission_requests, admission_wait
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_CLASS = {
+    'limit': 4,
+    'queue': 16,
+    'timeout': 10,
+    'per_user': 2,
+    'retry_after': 5,
+}
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class FileSlots:
+    """Места на файловых блокировках, общие для процессов."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def acquire(self, group, size):
+        for index in range(size):
+            # Блокировка `flock` принадлежит открытому файлу, поэтому
+            # каждая попытка открывает файл заново.
+            fd = os.open(self.directory / f'{group}.{index}.lock',
+                         os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def release(self, handle):
+        # Закрытие файла снимает блокировку.
+        os.close(handle)
+
+
+class LocalSlots:
+    """Места в пределах процесса."""
+
+    def __init__(self):
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def acquire(self, group, size):
+        with self._lock:
+            for index in range(size):
+                if (group, index) not in self._held:
+                    self._held.add((group, index))
+                    return group, index
+        return None
+
+    def release(self, handle):
+        with self._lock:
+            self._held.discard(handle)
+
+
+class Ticket:
+    """Занятые запросом места; освобождаются один раз."""
+
+    def __init__(self, slots, cost_class, handles):
+        self.slots = slots
+        self.cost_class = cost_class
+        self.handles = handles
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            handles, self.handles = self.handles, []
+        if handles:
+            for handle in handles:
+                self.slots.release(handle)
+            admission_released.inc(self.cost_class)
+
+
+class Admission:
+    def __init__(self):
+        self._slots = None
+        self._slots_key = None
+        self._lock = threading.Lock()
+
+    @property
+    def slots(self):
+        directory = getattr(settings, 'ADMISSION_DIR', None)
+        key = directory if fcntl is not None else None
+        with self._lock:
+            if self._slots is None or self._slots_key != key:
+                self._slots = (FileSlots(directory) if key is not None
+                               else LocalSlots())
+                self._slots_key = key
+            return self._slots
+
+    def cost_class(self, route):
+        return getattr(settings, 'ADMISSION_ROUTES', {}).get(route)
+
+    def options(self, cost_class):
+        return {**DEFAULT_CLASS,
+                **getattr(settings, 'ADMISSION_CLASSES', {}).get(cost_class,
+                                                                 {})}
+
+    def admit(self, cost_class, user_key):
+        """Занимает место класса для пользователя или вызывает Rejected."""
+        options = self.options(cost_class)
+        retry_after = options['retry_after']
+        slots = self.slots
+        user = hashlib.sha256(str(user_key).encode()).hexdigest()[:16]
+
+        user_slot = slots.acquire(f'{cost_class}.user.{user}',
+                                  options['per_user'])
+        if user_slot is None:
+            admission_requests.inc(cost_class, 'rejected_user')
+            raise Rejected(429, 'Слишком много одновременных запросов '
+                                'этого пользователя.', retry_after)
+        handles = [user_slot]
+        try:
+            slot = slots.acquire(f'{cost_class}.run', options['limit'])
+            if slot is not None:
+                admission_requests.inc(cost_class, 'admitted')
+                handles.append(slot)
+                return Ticket(slots, cost_class, handles)
+
+            queued = slots.acquire(f'{cost_class}.queue', options['queue'])
+            if queued is None:
+                admission_requests.inc(cost_class, 'rejected_queue')
+                raise Rejected(503, 'Сервер перегружен, очередь заполнена.',
+                               retry_after)
+            try:
+                slot = self._wait(slots, cost_class, options)
+            finally:
+                slots.release(queued)
+            if slot is None:
+                admission_requests.inc(cost_class, 'rejected_timeout')
+                raise Rejected(503, 'Сервер перегружен, время ожидания '
+                                    'истекло.', retry_after)
+            admission_requests.inc(cost_class, 'waited')
+            handles.append(slot)
+            return Ticket(slots, cost_class, handles)
+        except BaseException:
+            slots.release(user_slot)
+            raise
+
+    @staticmethod
+    def _wait(slots, cost_class, options):
+        started = time.monotonic()
+        deadline = started + options['timeout']
+        delay = 0.005
+        slot = None
+        while slot is None and time.monotonic() < deadline:
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 0.1)
+            slot = slots.acquire(f'{cost_class}.run', options['limit'])
+        admission_wait.observe(time.monotonic() - started, cost_class)
+        return slot
+
+
+admission = Admission()
+
+
+class AdmissionMiddleware:
+    """Допускает запросы к дорогим страницам (см. описание модуля)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self._release(request)
+            raise
+        ticket = getattr(request, '_admission_ticket', None)
+        if ticket is not None:
+            if response.streaming:
+                # Потоковый ответ формируется при отправке; Django вызывает
+                # закрывающие функции ответа после неё.
+                response._resource_closers.append(ticket.release)
+            else:
+                ticket.release()
+        return response
+
+    @staticmethod
+    def _release(request):
+        ticket = getattr(request, '_admission_ticket', None)
+        if ticket is not None:
+            ticket.release()
+
+    @staticmethod
+    def client_key(request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user.pk
+        return f"addr:{request.META.get('REMOTE_ADDR', '')}"
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not getattr(settings, 'ADMISSION_ENABLED', False):
+            return None
+        match = request.resolver_match
+        if match is None or match.namespace != 'django_db_app':
+            return None
+        cost_class = admission.cost_class(match.url_name)
+        if cost_class is None:
+            return None
+        try:
+            request._admission_ticket = admission.admit(
+                cost_class, self.client_key(request)
+            )
+        except Rejected as e:
+            response = HttpResponse(str(e), status=e.status,
+                                    content_type='text/plain; charset=utf-8')
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        return None
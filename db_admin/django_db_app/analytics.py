@@ -0,0 +1,353 @@
+"""Статистика числовых параметров по поддеревьям категорий.
+
+Значения числовых параметров (`int`, `real` и перечислений с числовыми
+значениями) загружаются в массивы NumPy в базовых единицах (`value_num`,
+см. `units.py`): строка — порядковый номер изделия, столбец — параметр.
+Собственные значения изделий и значения категорий хранятся отдельно;
+значение изделия без собственного берётся из его категории, как в
+отчётах (`reports.py`). Поддерево категории задаётся маской по строкам,
+поэтому минимум, максимум, среднее, перцентили и гистограмма для любого
+поддерева считаются векторно, без запросов к базе. Статистика и значения
+выводятся в единице параметра, у перечислений — в единице
+категории-перечисления.
+
+При шардинге (`sharding.py`) изделия, категории и значения читаются со
+всех шардов, как в сводке (`rollup.py`).
+
+Построенная матрица хранится в процессе. Изменения значений и остатков
+применяются к ней на месте по сигналам (см. `signals.py`); появление и
+удаление изделий, изменение категорий и справочников сбрасывают её.
+Массовые операции (`bulk.py`) сбрасывают матрицу явно. Изменения из других
+процессов подхватываются не позже чем через `NUMERIC_ANALYTICS_TTL` секунд.
+"""
+
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import cache_invalidations, cache_requests
+from .models import Category, ParameterValue, Product
+from .registry import registry
+from .sharding import fan_out, merge_sorted
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def enum_number(values):
+    """Числовое значение элемента перечисления или None."""
+    _, value_int, value_real, _ = values
+    if value_int is not None:
+        return float(value_int)
+    if value_real is not None:
+        return float(value_real)
+    return None
+
+
+class NumericMatrix:
+    def __init__(self):
+        self.built_at = time.monotonic()
+        snapshot = registry.get()
+
+        numeric_enums = {enum.category_id
+                         for enum in snapshot.enums.values()
+                         if enum_number(enum.values) is not None}
+        self.params = sorted(
+            (meta for meta in snapshot.params.values()
+             if meta.data_type in ('int', 'real') or
+             (meta.data_type == 'enum' and meta.enum_id in numeric_enums)),
+            key=lambda meta: meta.id,
+        )
+        self.column = {meta.id: j for j, meta in enumerate(self.params)}
+        # Единицы значений: у перечислений — единица категории-перечисления,
+        # в базовой единице которой хранится `value_num` (см. `units.py`).
+        enum_measures = dict(Category.objects.filter(
+            is_enum=True
+        ).values_list('id', 'measure_id'))
+        measure_ids = [enum_measures.get(meta.enum_id)
+                       if meta.data_type == 'enum' else meta.measure_id
+                       for meta in self.params]
+        self.measures = [snapshot.measures.get(measure_id, '')
+                         for measure_id in measure_ids]
+        # Делители перевода из базовой единицы в единицу значений.
+        self.scale = np.array([snapshot.factors.get(measure_id, 1.0)
+                               for measure_id in measure_ids], dtype=float)
+
+        parents = {}
+        for categories in fan_out(Category.objects.all()):
+            for category_id, parent_id in categories.values_list(
+                    'id', 'parent_id'):
+                # Категории-перечисления повторяются в каждом шарде, их
+                # родитель задан только в `default`.
+                parents.setdefault(category_id, parent_id)
+        self.children = {}
+        for category_id, parent_id in parents.items():
+            self.children.setdefault(parent_id, []).append(category_id)
+        self.category_row = {category_id: i
+                             for i, category_id in enumerate(sorted(parents))}
+
+        products = np.array(
+            list(merge_sorted(
+                (part.order_by('pk').values_list('id', 'category_id',
+                                                 'amount')
+                 for part in fan_out(Product.objects.all())),
+                key=None,
+            )),
+            dtype=np.int64,
+        ).reshape(-1, 3)
+        self.product_ids = products[:, 0]
+        self.product_category = np.array(
+            [self.category_row[category_id] for category_id in products[:, 1]],
+            dtype=np.int64,
+        )
+        self.amount = products[:, 2]
+
+        shape = len(self.params)
+        self.own = np.full((len(self.product_ids), shape), np.nan)
+        self.inherited = np.full((len(self.category_row), shape), np.nan)
+        self._load(self.own, 'product_id', self.product_row)
+        self._load(self.inherited, 'category_id',
+                   lambda ids: np.array([self.category_row[i] for i in ids],
+                                        dtype=np.int64))
+
+    def product_row(self, product_ids):
+        return np.searchsorted(self.product_ids, product_ids)
+
+    def _load(self, target, owner, rows):
+        values = [
+            row for part in fan_out(ParameterValue.objects.filter(
+                param_id__in=self.column, **{f'{owner}__isnull': False}
+            )) for row in part.values_list(owner, 'param_id', 'value_num')
+        ]
+        if not values:
+            return
+        owners, params, numbers = zip(*values)
+        columns = np.array([self.column[param_id] for param_id in params],
+                           dtype=np.int64)
+        target[rows(np.array(owners, dtype=np.int64)), columns] = np.array(
+            numbers, dtype=float
+        )
+
+    # Выборки.
+
+    def resolved(self, columns, rows=None):
+        """Значения столбцов для строк `rows` с учётом наследования от
+        категорий."""
+        if rows is None:
+            rows = np.arange(len(self.product_ids))
+        own = self.own[np.ix_(rows, columns)]
+        categories = self.product_category[rows]
+        return np.where(np.isnan(own),
+                        self.inherited[:, columns][categories], own)
+
+    def subtree_mask(self, category_id):
+        ids = [category_id]
+        for current in ids:
+            ids.extend(self.children.get(current, ()))
+        rows = [self.category_row[i] for i in ids if i in self.category_row]
+        return np.isin(self.product_category, rows)
+
+    def stats(self, category_id, param_ids=None, bins=10,
+              percentiles=PERCENTILES):
+        """Статистика параметров по изделиям поддерева категории."""
+        params = (self.params if param_ids is None else
+                  [self.params[self.column[param_id]]
+                   for param_id in param_ids if param_id in self.column])
+        mask = self.subtree_mask(category_id)
+        total = int(mask.sum())
+        columns = [self.column[meta.id] for meta in params]
+        values = (self.resolved(columns, np.flatnonzero(mask)) /
+                  self.scale[columns])
+
+        results = []
+        for j, meta in enumerate(params):
+            column = values[:, j]
+            column = column[~np.isnan(column)]
+            result = {
+                'param_id': meta.id,
+                'name': meta.name,
+                'name_short': meta.name_short,
+                'measure': self.measures[columns[j]],
+                'count': int(column.size),
+                'missing': total - int(column.size),
+            }
+            if column.size:
+                counts, edges = np.histogram(column, bins=bins)
+                result.update({
+                    'min': float(column.min()),
+                    'max': float(column.max()),
+                    'mean': float(column.mean()),
+                    'std': float(column.std()),
+                    'percentiles': {
+                        str(p): float(v) for p, v in zip(
+                            percentiles, np.percentile(column, percentiles)
+                        )
+                    },
+                    'histogram': {
+                        'counts': counts.tolist(),
+                        'edges': edges.tolist(),
+                    },
+                })
+            results.append(result)
+        return {'category_id': category_id, 'products': total,
+                'params': results}
+
+    def similar(self, product_id, param_ids, category_id=None, k=10,
+                in_stock=False):
+        """Ближайшие к изделию изделия по числовым параметрам.
+
+        Каждый параметр нормируется стандартным отклонением по
+        кандидатам (изделиям поддерева `category_id`, по умолчанию всего
+        каталога). Расстояние считается по параметрам, заданным у обоих
+        изделий, и масштабируется на их долю среди параметров исходного
+        изделия (как nan-euclidean); изделия без общих параметров не
+        рассматриваются. Возвращает список `(product_id, distance, shared)`.
+        """
+        row = self.product_row(product_id)
+        if row >= len(self.product_ids) or self.product_ids[row] != product_id:
+            raise KeyError(product_id)
+        columns = [self.column[param_id] for param_id in param_ids
+                   if param_id in self.column]
+        target = self.resolved(columns, [row])[0]
+        present = ~np.isnan(target)
+        columns = [column for column, ok in zip(columns, present) if ok]
+        if not columns:
+            return []
+        target = target[present]
+
+        mask = (self.subtree_mask(category_id) if category_id is not None
+                else np.ones(len(self.product_ids), dtype=bool))
+        mask[row] = False
+        if in_stock:
+            mask &= self.amount > 0
+        candidates = np.flatnonzero(mask)
+        values = self.resolved(columns, candidates)
+
+        # Параметров мало, изделий много: считаем по столбцам.
+        squared = np.zeros(len(candidates))
+        shared = np.zeros(len(candidates), dtype=np.int64)
+        for column, origin in zip(np.ascontiguousarray(values.T), target):
+            present = ~np.isnan(column)
+            known = column[present]
+            scale = known.std() if known.size else 0.0
+            if not scale > 0:
+                scale = 1.0
+            diff = (column - origin) / scale
+            squared += np.where(present, diff * diff, 0.0)
+            shared += present
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distance = np.sqrt(squared * len(columns) / shared)
+        distance[shared == 0] = np.inf
+
+        k = min(k, int(np.sum(shared > 0)))
+        if k <= 0:
+            return []
+        nearest = np.argpartition(distance, k - 1)[:k]
+        nearest = nearest[np.argsort(distance[nearest], kind='stable')]
+        return [(int(self.product_ids[candidates[i]]), float(distance[i]),
+                 int(shared[i])) for i in nearest]
+
+    def product_values(self, product_ids, param_ids):
+        """Значения параметров изделий: `{product_id: {param_id: value}}`,
+        без отсутствующих значений."""
+        columns = [self.column[param_id] for param_id in param_ids
+                   if param_id in self.column]
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        rows = self.product_row(product_ids)
+        found = rows < len(self.product_ids)
+        found[found] = self.product_ids[rows[found]] == product_ids[found]
+        values = self.resolved(columns, rows[found]) / self.scale[columns]
+        return {
+            int(product_id): {
+                self.params[column].id: float(value)
+                for column, value in zip(columns, row) if value == value
+            }
+            for product_id, row in zip(product_ids[found], values)
+        }
+
+    # Изменения.
+
+    def set_value(self, product_id, category_id, param_id, number):
+        """Записывает значение; возвращает False, если ячейки нет."""
+        column = self.column.get(param_id)
+        if column is None:
+            return True
+        if product_id is not None:
+            row = self.product_row(product_id)
+            if (row >= len(self.product_ids) or
+                    self.product_ids[row] != product_id):
+                return False
+            self.own[row, column] = number
+        else:
+            row = self.category_row.get(category_id)
+            if row is None:
+                return False
+            self.inherited[row, column] = number
+        return True
+
+    def set_amount(self, product_id, amount):
+        row = self.product_row(product_id)
+        if (row >= len(self.product_ids) or
+                self.product_ids[row] != product_id):
+            return False
+        self.amount[row] = amount
+        return True
+
+
+class AnalyticsCache:
+    def __init__(self):
+        self._matrix = None
+        self._lock = threading.RLock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'NUMERIC_ANALYTICS_TTL', 300)
+
+    def get(self):
+        with self._lock:
+            matrix = self._matrix
+            if (matrix is None or
+                    time.monotonic() - matrix.built_at > self.ttl):
+                cache_requests.inc('analytics', 'miss')
+                matrix = self._matrix = NumericMatrix()
+            else:
+                cache_requests.inc('analytics', 'hit')
+            return matrix
+
+    def value_changed(self, old, new):
+        """Применяет изменение значения параметра.
+
+        `old` и `new` — кортежи `(product_id, category_id, param_id,
+        value_num)` до и после изменения;
+        `None` для созданного или удалённого значения. Запись идемпотентна,
+        поэтому повторное применение к уже учтённой матрице безопасно.
+        """
+        with self._lock:
+            matrix = self._matrix
+            if matrix is None:
+                return
+            applied = True
+            if old is not None:
+                applied = matrix.set_value(*old[:3], np.nan)
+            if new is not None and applied:
+                applied = matrix.set_value(
+                    *new[:3], np.nan if new[3] is None else new[3]
+                )
+            if not applied:
+                self.invalidate()
+
+    def amount_changed(self, product_id, amount):
+        with self._lock:
+            matrix = self._matrix
+            if matrix is not None and not matrix.set_amount(product_id,
+                                                            amount):
+                self.invalidate()
+
+    def invalidate(self):
+        cache_invalidations.inc('analytics')
+        with self._lock:
+            self._matrix = None
+
+
+analytics = AnalyticsCache()
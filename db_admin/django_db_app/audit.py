@@ -0,0 +1,349 @@
+"""Проверка целостности каталога.
+
+Инварианты, которые модели проверяют только для отдельного объекта
+(`clean()` моделей и форм, триггеры `sql/triggers.sql`), проверяются для
+всех строк. Массовые операции и прямой SQL их обходят, поэтому проверка
+читает каждую таблицу потоком порциями по первичному ключу (keyset
+pagination) и сверяет строки с картами справочников, построенными заранее,
+без запросов на отдельную строку. Ссылки значений на изделия проверяются
+одним запросом с анти-соединением: карта изделий не строится.
+
+Для полей значения «заполнено» означает NOT NULL, для строк — ещё и не
+пустую строку.
+"""
+
+import math
+import time
+from collections import Counter
+
+from django.db import router
+from django.db.models import Exists, OuterRef
+
+from .bulk import VALUE_COLUMNS
+from .models import (Category, EnumValue, Measure, Parameter,
+                     ParameterAggregate, ParameterValue, Product)
+from .registry import enum_display, format_value
+from .units import NUMERIC_TYPES, number
+
+CHECKS = {
+    'measure_base': 'Базовая единица не существует или сама не базовая, '
+                    'либо неверен множитель.',
+    'category_parent_missing': 'Родительская категория не существует.',
+    'category_measure_missing': 'Единица измерения категории не существует.',
+    'category_cycle': 'Категория входит в цикл иерархии.',
+    'category_enum_nested': 'Категория-перечисление вложена в '
+                            'категорию-перечисление.',
+    'enum_category_missing': 'Категория значения перечисления не существует.',
+    'enum_category_not_enum': 'Категория значения перечисления не является '
+                              'перечислением.',
+    'enum_value_count': 'Должно быть заполнено ровно одно поле значения.',
+    'enum_value_num': 'value_num не соответствует значению и единице '
+                      'категории.',
+    'enum_display_value': 'display_value не соответствует значению.',
+    'param_data_type': 'Неизвестный тип данных параметра.',
+    'param_enum_mismatch': "enum_id задан тогда и только тогда, когда тип "
+                           "данных 'enum'.",
+    'param_enum_not_enum': 'Перечисление параметра не является '
+                           'категорией-перечислением.',
+    'param_measure_missing': 'Единица измерения параметра не существует.',
+    'param_min_max': 'min_val больше max_val.',
+    'product_category_missing': 'Категория изделия не существует.',
+    'value_owner': 'Должно быть заполнено ровно одно из полей product и '
+                   'category.',
+    'value_owner_missing': 'Изделие или категория значения не существует.',
+    'value_param_missing': 'Параметр значения не существует.',
+    'value_count': 'Должно быть заполнено ровно одно поле значения.',
+    'value_type': 'Заполненное поле не соответствует типу параметра.',
+    'value_enum_missing': 'Значение перечисления не существует.',
+    'value_enum_category': 'Значение перечисления не принадлежит '
+                           'перечислению параметра.',
+    'value_range': 'Значение вне диапазона min_val..max_val параметра.',
+    'value_num': 'value_num не соответствует значению и единице '
+                 'параметра.',
+    'value_display': 'display_value не соответствует значению и типу '
+                     'параметра.',
+    'aggregate_param_missing': 'Параметр агрегата не существует.',
+}
+
+
+def _filled(value):
+    return value is not None and value != ''
+
+
+def _same_number(stored, expected):
+    if stored is None or expected is None:
+        return stored is expected
+    return math.isclose(stored, expected, rel_tol=1e-9)
+
+
+class CatalogAudit:
+    """Итерация по нарушениям; `scanned` и `found` — счётчики по таблицам
+    и видам нарушений."""
+
+    def __init__(self, chunk_size=5000, using=None):
+        self.chunk_size = chunk_size
+        self.db = using or router.db_for_read(ParameterValue)
+        self.scanned = Counter()
+        self.found = Counter()
+        self.duration = 0.0
+
+    def rows(self, model, *fields):
+        """Строки таблицы порциями по возрастанию первичного ключа."""
+        queryset = model.objects.using(self.db).order_by('pk')
+        last = None
+        while True:
+            chunk = queryset if last is None else queryset.filter(pk__gt=last)
+            chunk = list(chunk.values_list('pk', *fields)[:self.chunk_size])
+            if not chunk:
+                return
+            self.scanned[model._meta.db_table] += len(chunk)
+            yield from chunk
+            last = chunk[-1][0]
+
+    def violation(self, check, model, pk, **details):
+        self.found[check] += 1
+        return {
+            'check': check,
+            'table': model._meta.db_table,
+            'id': pk,
+            'message': CHECKS[check],
+            **details,
+        }
+
+    def __iter__(self):
+        started = time.perf_counter()
+        try:
+            yield from self.check_categories()
+            yield from self.check_enum_values()
+            yield from self.check_parameters()
+            yield from self.check_products()
+            yield from self.check_values()
+            yield from self.check_aggregates()
+        finally:
+            self.duration = time.perf_counter() - started
+
+    def check_categories(self):
+        self.measures = {pk: (base_id, factor) for pk, base_id, factor
+                         in self.rows(Measure, 'base_id', 'factor')}
+        for pk, (base_id, factor) in self.measures.items():
+            if base_id is None:
+                valid = factor == 1
+            else:
+                base = self.measures.get(base_id)
+                valid = factor > 0 and base is not None and base[0] is None
+            if not valid:
+                yield self.violation('measure_base', Measure, pk,
+                                     base_id=base_id, factor=factor)
+
+        self.categories = {}
+        self.category_measures = {}
+        for pk, parent_id, is_enum, measure_id in self.rows(
+                Category, 'parent_id', 'is_enum', 'measure_id'):
+            self.categories[pk] = (parent_id, is_enum)
+            self.category_measures[pk] = measure_id
+            if measure_id not in self.measures:
+                yield self.violation('category_measure_missing', Category, pk,
+                                     measure_id=measure_id)
+
+        categories = self.categories
+        for pk, (parent_id, is_enum) in categories.items():
+            if parent_id is None:
+                continue
+            if parent_id not in categories:
+                yield self.violation('category_parent_missing', Category, pk,
+                                     parent_id=parent_id)
+            elif is_enum and categories[parent_id][1]:
+                yield self.violation('category_enum_nested', Category, pk,
+                                     parent_id=parent_id)
+
+        # Подъём к корню с запоминанием пройденного: каждая категория
+        # посещается один раз.
+        state = {}
+        for start in categories:
+            path = []
+            pk = start
+            while pk in categories and pk not in state:
+                state[pk] = start
+                path.append(pk)
+                pk = categories[pk][0]
+            if pk in categories and state[pk] == start:
+                cycle = path[path.index(pk):]
+                for member in cycle:
+                    yield self.violation('category_cycle', Category, member,
+                                         cycle=cycle)
+
+    def check_enum_values(self):
+        categories = self.categories
+        self.enum_values = {}
+        self.enum_numbers = {}
+        self.enum_displays = {}
+        for pk, category_id, value_num, display, *values in self.rows(
+                EnumValue, 'category_id', 'value_num', 'display_value',
+                'value_str', 'value_int', 'value_real', 'value_path'):
+            self.enum_values[pk] = category_id
+            self.enum_numbers[pk] = value_num
+            self.enum_displays[pk] = display
+            if category_id not in categories:
+                yield self.violation('enum_category_missing', EnumValue, pk,
+                                     category_id=category_id)
+            elif not categories[category_id][1]:
+                yield self.violation('enum_category_not_enum', EnumValue, pk,
+                                     category_id=category_id)
+            if sum(map(_filled, values)) != 1:
+                yield self.violation('enum_value_count', EnumValue, pk)
+            expected = self.base_number(
+                values[1], values[2], self.category_measures.get(category_id)
+            )
+            if not _same_number(value_num, expected):
+                yield self.violation('enum_value_num', EnumValue, pk,
+                                     value_num=value_num, expected=expected)
+            expected = enum_display(values)
+            if display != expected:
+                yield self.violation('enum_display_value', EnumValue, pk,
+                                     display_value=display,
+                                     expected=expected)
+
+    def base_number(self, value_int, value_real, measure_id):
+        value = number(value_int, value_real)
+        if value is None:
+            return None
+        return value * self.measures.get(measure_id, (None, 1.0))[1]
+
+    def check_parameters(self):
+        categories = self.categories
+        self.params = {}
+        for pk, data_type, enum_id, measure_id, min_val, max_val in self.rows(
+                Parameter, 'data_type', 'enum_id', 'measure_id',
+                'min_val', 'max_val'):
+            self.params[pk] = (data_type, enum_id, min_val, max_val,
+                               measure_id)
+            if data_type not in VALUE_COLUMNS:
+                yield self.violation('param_data_type', Parameter, pk,
+                                     data_type=data_type)
+            if (data_type == 'enum') != (enum_id is not None):
+                yield self.violation('param_enum_mismatch', Parameter, pk,
+                                     data_type=data_type, enum_id=enum_id)
+            elif enum_id is not None and not categories.get(
+                    enum_id, (None, False))[1]:
+                yield self.violation('param_enum_not_enum', Parameter, pk,
+                                     enum_id=enum_id)
+            if measure_id is not None and measure_id not in self.measures:
+                yield self.violation('param_measure_missing', Parameter, pk,
+                                     measure_id=measure_id)
+            if (min_val is not None and max_val is not None and
+                    min_val > max_val):
+                yield self.violation('param_min_max', Parameter, pk,
+                                     min_val=min_val, max_val=max_val)
+
+    def check_products(self):
+        categories = self.categories
+        for pk, category_id in self.rows(Product, 'category_id'):
+            if category_id not in categories:
+                yield self.violation('product_category_missing', Product, pk,
+                                     category_id=category_id)
+
+    def check_values(self):
+        categories = self.categories
+        params = self.params
+        enum_values = self.enum_values
+        columns = ('value_enum_id', 'value_str', 'value_int', 'value_real',
+                   'value_path')
+        position = {column: i for i, column in enumerate(columns)}
+
+        for (pk, product_id, category_id, param_id, value_num, display,
+             *values) in self.rows(ParameterValue, 'product_id',
+                                   'category_id', 'param_id', 'value_num',
+                                   'display_value', *columns):
+            if (product_id is None) == (category_id is None):
+                yield self.violation('value_owner', ParameterValue, pk,
+                                     product_id=product_id,
+                                     category_id=category_id)
+            elif category_id is not None and category_id not in categories:
+                yield self.violation('value_owner_missing', ParameterValue,
+                                     pk, category_id=category_id)
+
+            filled = [column for column, value in zip(columns, values)
+                      if _filled(value)]
+            if len(filled) != 1:
+                yield self.violation('value_count', ParameterValue, pk,
+                                     filled=filled)
+
+            param = params.get(param_id)
+            if param is None:
+                yield self.violation('value_param_missing', ParameterValue,
+                                     pk, param_id=param_id)
+                continue
+            data_type, enum_id, min_val, max_val, measure_id = param
+            if data_type == 'enum':
+                expected = self.enum_numbers.get(values[0])
+            elif data_type in NUMERIC_TYPES:
+                expected = self.base_number(values[2], values[3], measure_id)
+            else:
+                expected = None
+            if not _same_number(value_num, expected):
+                yield self.violation('value_num', ParameterValue, pk,
+                                     value_num=value_num, expected=expected)
+            expected = format_value(
+                data_type, *values[1:],
+                enum_display=self.enum_displays.get(values[0])
+            )
+            if display != expected:
+                yield self.violation('value_display', ParameterValue, pk,
+                                     display_value=display,
+                                     expected=expected)
+
+            column = VALUE_COLUMNS.get(data_type)
+            if column is None:
+                continue
+            if column not in filled:
+                yield self.violation('value_type', ParameterValue, pk,
+                                     param_id=param_id, data_type=data_type,
+                                     filled=filled)
+                continue
+
+            value = values[position[column]]
+            if data_type == 'enum':
+                if value not in enum_values:
+                    yield self.violation('value_enum_missing',
+                                         ParameterValue, pk,
+                                         value_enum_id=value)
+                elif enum_values[value] != enum_id:
+                    yield self.violation('value_enum_category',
+                                         ParameterValue, pk,
+                                         value_enum_id=value,
+                                         enum_category_id=enum_values[value],
+                                         param_enum_id=enum_id)
+            elif data_type in ('int', 'real') and (
+                    (min_val is not None and value < min_val) or
+                    (max_val is not None and value > max_val)):
+                yield self.violation('value_range', ParameterValue, pk,
+                                     param_id=param_id, value=value,
+                                     min_val=min_val, max_val=max_val)
+
+        orphans = ParameterValue.objects.using(self.db).filter(
+            product_id__isnull=False
+        ).exclude(Exists(
+            Product.objects.filter(pk=OuterRef('product_id'))
+        )).order_by('pk').values_list('pk', 'product_id')
+        for pk, product_id in orphans.iterator(chunk_size=self.chunk_size):
+            yield self.violation('value_owner_missing', ParameterValue, pk,
+                                 product_id=product_id)
+
+    def check_aggregates(self):
+        params = self.params
+        for pk, parent_param_id, param_id in self.rows(
+                ParameterAggregate, 'parent_param_id', 'param_id'):
+            missing = [i for i in (parent_param_id, param_id)
+                       if i not in params]
+            if missing:
+                yield self.violation('aggregate_param_missing',
+                                     ParameterAggregate, pk,
+                                     param_ids=missing)
+
+    def summary(self):
+        return {
+            'rows': dict(self.scanned),
+            'violations': dict(self.found),
+            'total': sum(self.found.values()),
+            'duration_s': round(self.duration, 3),
+        }
@@ -0,0 +1,254 @@
+"""Массовые операции над поддеревом категорий.
+
+Каждая операция выполняется несколькими set-based запросами
+(UPDATE / INSERT ... SELECT / DELETE) в одной транзакции и возвращает
+словарь с количеством затронутых строк. `clean()` для отдельных строк
+не вызывается: значение проверяется один раз до начала операции.
+"""
+
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import connections, router, transaction
+from django.db.models import (Count, DecimalField, Exists, ExpressionWrapper,
+                              F, OuterRef, Value)
+from django.db.models.functions import Greatest, Round
+
+from . import display, units
+from .models import EnumValue, Parameter, ParameterValue, Product
+from .paramcache import param_cache
+from .rollup import rollups
+from .signals import invalidate_analytics
+
+VALUE_COLUMNS = {
+    'int': 'value_int',
+    'real': 'value_real',
+    'str': 'value_str',
+    'path': 'value_path',
+    'enum': 'value_enum_id',
+}
+
+
+def parse_value(param, raw_value):
+    """Возвращает `(column, value)` для записи значения параметра."""
+    column = VALUE_COLUMNS[param.data_type]
+    raw_value = str(raw_value).strip()
+    try:
+        if param.data_type == 'int':
+            value = int(raw_value)
+        elif param.data_type == 'real':
+            value = float(raw_value)
+        elif param.data_type == 'enum':
+            value = EnumValue.objects.get(category_id=param.enum_id,
+                                          code=raw_value).id
+        else:
+            value = raw_value
+    except (ValueError, EnumValue.DoesNotExist):
+        raise ValidationError(
+            f"Недопустимое значение «{raw_value}» для параметра "
+            f"«{param.name}» ({param.data_type})."
+        )
+
+    if param.data_type in ('int', 'real'):
+        if param.min_val is not None and value < param.min_val:
+            raise ValidationError(
+                f"Значение меньше минимального ({param.min_val})."
+            )
+        if param.max_val is not None and value > param.max_val:
+            raise ValidationError(
+                f"Значение больше максимального ({param.max_val})."
+            )
+    elif param.data_type in ('str', 'path'):
+        if not value:
+            raise ValidationError("Значение не может быть пустым.")
+        if len(value) > 128:
+            raise ValidationError("Значение длиннее 128 символов.")
+    return column, value
+
+
+def value_num(param, column, value, db):
+    """`value_num` значения параметра (см. `units.py`)."""
+    numbers = dict.fromkeys(('value_int', 'value_real', 'value_enum_id'))
+    if column in numbers:
+        numbers[column] = value
+    return units.param_value_num(param.id, using=db, **numbers)
+
+
+def display_value(param, column, value, db):
+    """`display_value` значения параметра (см. `display.py`)."""
+    return display.param_display_value(param.id, using=db,
+                                       **{column: value})
+
+
+def _subtree_products(category, db):
+    return Product.objects.using(db).filter(
+        category_id__in=category.get_subtree_ids()
+    )
+
+
+def set_param_value(category, param, raw_value):
+    """Задаёт значение параметра всем изделиям поддерева."""
+    column, value = parse_value(param, raw_value)
+    db = router.db_for_write(ParameterValue, instance=category)
+    connection = connections[db]
+    products = _subtree_products(category, db)
+
+    with transaction.atomic(using=db):
+        fields = {name: None for name in VALUE_COLUMNS.values()}
+        fields[column] = value
+        fields['value_num'] = number = value_num(param, column, value, db)
+        fields['display_value'] = text = display_value(param, column, value,
+                                                       db)
+        updated = ParameterValue.objects.using(db).filter(
+            param=param, product__in=products
+        ).update(**fields)
+
+        # Изделия без собственного значения получают его одним запросом.
+        missing = products.exclude(Exists(
+            ParameterValue.objects.filter(param=param,
+                                          product_id=OuterRef('pk'))
+        )).values('id')
+        missing_sql, missing_params = missing.query.get_compiler(
+            using=db
+        ).as_sql()
+        quote = connection.ops.quote_name
+        value_column = ParameterValue._meta.get_field(column).column
+        number_column = ParameterValue._meta.get_field('value_num').column
+        display_column = ParameterValue._meta.get_field(
+            'display_value'
+        ).column
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {quote(ParameterValue._meta.db_table)} '
+                f'(product_id, param_id, {quote(value_column)}, '
+                f'{quote(number_column)}, {quote(display_column)}) '
+                f'SELECT missing.id, %s, %s, %s, %s '
+                f'FROM ({missing_sql}) missing',
+                (param.id, value, number, text, *missing_params)
+            )
+            created = cursor.rowcount
+        # UPDATE и INSERT ... SELECT обходят сигналы значений.
+        transaction.on_commit(invalidate_analytics, using=db)
+        transaction.on_commit(
+            lambda: param_cache.evict_categories([category.id]), using=db
+        )
+
+    return {'updated': updated, 'created': created}
+
+
+def clear_param_value(category, param):
+    """Удаляет собственные значения параметра у изделий поддерева."""
+    db = router.db_for_write(ParameterValue, instance=category)
+    with transaction.atomic(using=db):
+        deleted, _ = ParameterValue.objects.using(db).filter(
+            param=param, product__in=_subtree_products(category, db)
+        ).delete()
+        transaction.on_commit(invalidate_analytics, using=db)
+        transaction.on_commit(
+            lambda: param_cache.evict_categories([category.id]), using=db
+        )
+    return {'deleted': deleted}
+
+
+def hoist_param(category, param):
+    """Переносит значения параметра с уровня изделий на уровень категорий.
+
+    Категория поддерева получает собственное значение, если оно задано у
+    всех её изделий и самое частое встречается хотя бы дважды; изделия,
+    значение которых совпадает со значением категории, его наследуют.
+    Изделия с другими значениями сохраняют их как переопределения.
+    """
+    db = router.db_for_write(ParameterValue, instance=category)
+    column = VALUE_COLUMNS[param.data_type]
+    ids = category.get_subtree_ids()
+    values = ParameterValue.objects.using(db).filter(param=param)
+    product_values = values.filter(product__category_id__in=ids)
+
+    with transaction.atomic(using=db):
+        has_value = set(values.filter(
+            category_id__in=ids
+        ).values_list('category_id', flat=True))
+        product_counts = dict(Product.objects.using(db).filter(
+            category_id__in=ids
+        ).order_by().values('category_id').annotate(
+            total=Count('id')
+        ).values_list('category_id', 'total'))
+
+        covered = {}
+        best = {}
+        for category_id, value, total in product_values.order_by().values(
+                'product__category_id', column
+        ).annotate(total=Count('id')).values_list(
+                'product__category_id', column, 'total'):
+            covered[category_id] = covered.get(category_id, 0) + total
+            if total > best.get(category_id, (None, 0))[1]:
+                best[category_id] = (value, total)
+
+        # Новое значение категории не должно появиться у изделий,
+        # у которых параметра не было.
+        new_values = [
+            ParameterValue(category_id=category_id, param=param,
+                           value_num=value_num(param, column, value, db),
+                           display_value=display_value(param, column, value,
+                                                       db),
+                           **{column: value})
+            for category_id, (value, total) in best.items()
+            if category_id not in has_value and total >= 2 and
+            covered[category_id] == product_counts.get(category_id)
+        ]
+        ParameterValue.objects.using(db).bulk_create(new_values)
+
+        duplicates = product_values.filter(Exists(
+            ParameterValue.objects.filter(
+                param=param,
+                category_id=OuterRef('product__category_id'),
+                **{column: OuterRef(column)}
+            )
+        ))
+        deleted, _ = duplicates.delete()
+        transaction.on_commit(invalidate_analytics, using=db)
+        transaction.on_commit(
+            lambda: param_cache.evict_categories([category.id]), using=db
+        )
+
+    return {'created': len(new_values), 'deleted': deleted}
+
+
+def adjust_prices(category, percent=None, amount=None):
+    """Изменяет цены изделий поддерева на процент и/или сумму.
+
+    Цена округляется до копеек и не опускается ниже нуля.
+    """
+    if percent is None and amount is None:
+        raise ValidationError("Укажите процент или сумму изменения цены.")
+    try:
+        percent = Decimal(str(percent)) if percent is not None else None
+        amount = Decimal(str(amount)) if amount is not None else None
+    except InvalidOperation:
+        raise ValidationError("Некорректное изменение цены.")
+
+    output = DecimalField(max_digits=11, decimal_places=2)
+    price = F('price')
+    if percent is not None:
+        price = ExpressionWrapper(price * (1 + percent / 100),
+                                  output_field=output)
+    if amount is not None:
+        price = ExpressionWrapper(price + amount, output_field=output)
+
+    db = router.db_for_write(Product, instance=category)
+    with transaction.atomic(using=db):
+        updated = _subtree_products(category, db).update(
+            price=Greatest(Round(price, 2), Value(Decimal(0)),
+                           output_field=output)
+        )
+        # UPDATE обходит сигналы изделий, поэтому сводка пересчитывается.
+        transaction.on_commit(rollups.invalidate, using=db)
+
+    return {'updated': updated}
+
+
+def resolve_param(name_short):
+    try:
+        return Parameter.objects.get(name_short=name_short)
+    except Parameter.DoesNotExist:
+        raise ValidationError(f"Параметр «{name_short}» не найден.")
@@ -0,0 +1,226 @@
+"""Журнал изменений каталога (change data capture).
+
+Каждое создание, изменение и удаление строк `Measure`, `Category`,
+`Product`, `EnumValue`, `Parameter`, `ParameterValue` и
+`ParameterAggregate` записывается в `CatalogChange` триггером базы данных,
+то есть в той же транзакции и независимо от того, выполнено ли оно через
+ORM, массовой операцией (`bulk.py`) или прямым SQL. Номер записи `seq`
+монотонно растёт и не используется повторно.
+
+Потребитель хранит последний полученный `seq` и запрашивает изменения
+после него порциями (`changes_since`, `/changes/`, команда
+`catalog_changes since`), применяя их по порядку как upsert по
+`(model, id)` или удаление.
+
+Сжатие (`compact`) удаляет записи, перекрытые более поздней записью того
+же объекта, и старые записи об удалении. Потребитель, отставший дальше
+удалённых записей об удалении (`horizon()`), получает `ChangeLogCompacted`
+и должен заново загрузить каталог целиком.
+
+В SQLite запись сериализуется, поэтому порядок `seq` совпадает с порядком
+фиксации транзакций. В PostgreSQL параллельные транзакции могут
+зафиксироваться не в порядке `seq`; потребителю стоит отставать от
+последнего `seq` на время самой длинной транзакции записи.
+
+Триггеры есть только для SQLite и PostgreSQL (`VENDORS`); на других СУБД
+миграции их не создают (с предупреждением в журнале), а `changes_since`
+сообщает, что журнал недоступен (`ChangeLogUnavailable`).
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Exists, Max, OuterRef
+from django.utils import timezone
+
+from .models import CatalogChange
+
+TRACKED_MODELS = ('Measure', 'Category', 'Product', 'EnumValue',
+                  'Parameter', 'ParameterValue', 'ParameterAggregate')
+VENDORS = ('sqlite', 'postgresql')
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeLogCompacted(Exception):
+    """Запрошенные изменения удалены сжатием журнала."""
+
+
+class ChangeLogUnavailable(Exception):
+    """Журнал изменений не ведётся в базе данных этой СУБД."""
+
+
+# Триггеры. Функции принимают `apps` миграции и вызываются из
+# `RunPython`; в SQLite список столбцов фиксируется при создании триггера,
+# поэтому миграции, меняющие столбцы этих таблиц, пересоздают триггеры.
+
+def _trigger_name(table, operation):
+    return f'catalog_change_{table}_{operation}'
+
+
+def create_change_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor not in VENDORS:
+        logger.warning('Журнал изменений не поддерживается для %s: '
+                       'триггеры не созданы.', connection.vendor)
+        return
+    quote = connection.ops.quote_name
+    log_table = quote(
+        apps.get_model('django_db_app', 'CatalogChange')._meta.db_table
+    )
+    columns = '(model, object_id, operation, data)'
+
+    if connection.vendor == 'postgresql':
+        schema_editor.execute(f'''
+            CREATE OR REPLACE FUNCTION catalog_change_log() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    INSERT INTO {log_table} {columns}
+                    VALUES (TG_ARGV[0], OLD.id, 'delete', NULL);
+                    RETURN OLD;
+                END IF;
+                INSERT INTO {log_table} {columns}
+                VALUES (TG_ARGV[0], NEW.id,
+                        CASE TG_OP WHEN 'INSERT' THEN 'create'
+                                   ELSE 'update' END,
+                        to_jsonb(NEW));
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        ''')
+
+    for name in TRACKED_MODELS:
+        model = apps.get_model('django_db_app', name)
+        table = model._meta.db_table
+        label = model._meta.model_name
+        if connection.vendor == 'postgresql':
+            trigger = quote(_trigger_name(table, 'log'))
+            schema_editor.execute(
+                f'DROP TRIGGER IF EXISTS {trigger} ON {quote(table)}'
+            )
+            schema_editor.execute(
+                f'CREATE TRIGGER {trigger} '
+                f'AFTER INSERT OR UPDATE OR DELETE ON {quote(table)} '
+                f"FOR EACH ROW EXECUTE FUNCTION catalog_change_log('{label}')"
+            )
+            continue
+
+        row = ', '.join(
+            f"'{field.column}', NEW.{quote(field.column)}"
+            for field in model._meta.local_concrete_fields
+        )
+        for operation, event, source, data in (
+                ('create', 'INSERT', 'NEW', f'json_object({row})'),
+                ('update', 'UPDATE', 'NEW', f'json_object({row})'),
+                ('delete', 'DELETE', 'OLD', 'NULL')):
+            trigger = quote(_trigger_name(table, operation))
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            schema_editor.execute(
+                f'CREATE TRIGGER {trigger} AFTER {event} ON {quote(table)} '
+                f'BEGIN INSERT INTO {log_table} {columns} '
+                f"VALUES ('{label}', {source}.id, '{operation}', {data}); "
+                f'END'
+            )
+
+
+def drop_change_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor not in VENDORS:
+        return
+    quote = connection.ops.quote_name
+    for name in TRACKED_MODELS:
+        table = apps.get_model('django_db_app', name)._meta.db_table
+        if connection.vendor == 'postgresql':
+            schema_editor.execute(
+                f'DROP TRIGGER IF EXISTS {quote(_trigger_name(table, "log"))} '
+                f'ON {quote(table)}'
+            )
+            continue
+        for operation in ('create', 'update', 'delete'):
+            schema_editor.execute(
+                f'DROP TRIGGER IF EXISTS '
+                f'{quote(_trigger_name(table, operation))}'
+            )
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('DROP FUNCTION IF EXISTS catalog_change_log()')
+
+
+# Чтение и сжатие.
+
+def horizon():
+    """Наименьший `seq`, начиная с которого журнал полон."""
+    marker = CatalogChange.objects.filter(
+        operation='compact'
+    ).order_by('-seq').first()
+    return marker.data['through'] if marker else 0
+
+
+def batch_size(limit=None):
+    maximum = getattr(settings, 'CATALOG_CHANGES_BATCH_SIZE', 1000)
+    return maximum if limit is None else max(1, min(limit, maximum))
+
+
+def serialize(change):
+    return {
+        'seq': change.seq,
+        'model': change.model,
+        'id': change.object_id,
+        'operation': change.operation,
+        'data': change.data,
+        'changed_at': change.changed_at.isoformat(),
+    }
+
+
+def changes_since(since, limit=None):
+    """Порция изменений после `since`: `(changes, next_seq, has_more)`."""
+    vendor = connections[router.db_for_read(CatalogChange)].vendor
+    if vendor not in VENDORS:
+        raise ChangeLogUnavailable(
+            f'Журнал изменений не поддерживается для {vendor}.'
+        )
+    through = horizon()
+    if since < through:
+        raise ChangeLogCompacted(
+            f'Изменения до {through} удалены сжатием журнала; '
+            f'требуется полная загрузка каталога.'
+        )
+    limit = batch_size(limit)
+    rows = list(CatalogChange.objects.filter(seq__gt=since).exclude(
+        operation='compact'
+    ).order_by('seq')[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_seq = rows[-1].seq if rows else since
+    return [serialize(change) for change in rows], next_seq, has_more
+
+
+def compact(tombstone_days=None):
+    """Сжимает журнал; возвращает число удалённых записей по видам."""
+    if tombstone_days is None:
+        tombstone_days = getattr(settings, 'CATALOG_CHANGES_TOMBSTONE_DAYS',
+                                 30)
+    db = router.db_for_write(CatalogChange)
+    changes = CatalogChange.objects.using(db)
+    with transaction.atomic(using=db):
+        superseded, _ = changes.filter(Exists(
+            CatalogChange.objects.filter(
+                model=OuterRef('model'), object_id=OuterRef('object_id'),
+                seq__gt=OuterRef('seq'),
+            )
+        )).delete()
+
+        tombstones = changes.filter(
+            operation='delete',
+            changed_at__lt=timezone.now() - timedelta(days=tombstone_days),
+        )
+        through = tombstones.aggregate(through=Max('seq'))['through']
+        removed = 0
+        if through is not None:
+            removed, _ = tombstones.filter(seq__lte=through).delete()
+            # Горизонт хранится единственной служебной записью журнала.
+            changes.filter(operation='compact').delete()
+            changes.create(model='', object_id=0, operation='compact',
+                           data={'through': through})
+    return {'superseded': superseded, 'tombstones': removed}
@@ -0,0 +1,24 @@
+"""Служебные запросы к базе данных, общие для админки и метрик."""
+
+from django.db import connections
+
+
+def estimate_row_count(model, using):
+    """Быстрая оценка числа строк таблицы или None."""
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class '
+                'WHERE oid = %s::regclass', [table]
+            )
+        elif connection.vendor == 'sqlite':
+            # Первичный ключ совпадает с rowid: максимум берётся по индексу.
+            cursor.execute(
+                f'SELECT MAX(_rowid_) FROM {connection.ops.quote_name(table)}'
+            )
+        else:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row and row[0] is not None and row[0] >= 0 else None
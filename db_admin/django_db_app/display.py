@@ -0,0 +1,131 @@
+"""Отображаемые значения параметров.
+
+`display_value` хранит значение строкой так, как его выводят отчёты
+(`registry.format_value`):
+
+* у `EnumValue` — первое заполненное поле значения;
+* у `ParameterValue` — поле, соответствующее типу параметра, для
+  перечислений — `display_value` элемента перечисления. Значение в поле
+  другого типа не выводится (NULL).
+
+Отчёты, страница параметров изделия и админка читают только этот столбец:
+без ветвления по типу параметра и без соединения с `EnumValue`. Для
+отбора и сортировки числовых значений служит `value_num` (`units.py`).
+
+Поле заполняется, как `value_num`: при сохранении через ORM
+(`signals.py`) и массовыми операциями (`bulk.py`); при смене типа
+параметра и изменении значения элемента перечисления затронутые значения
+пересчитываются (`refresh`) во всех базах каталога порциями по
+`BATCH_SIZE` строк. Прямой SQL поле не обновляет — после него выполняется
+`refresh()`.
+"""
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+
+from . import sharding
+from .models import EnumValue, Parameter, ParameterValue
+from .registry import VALUE_FIELDS, enum_display, format_value
+
+BATCH_SIZE = 2000
+
+
+def enum_display_value(enum):
+    """`display_value` элемента перечисления."""
+    return enum_display([getattr(enum, name) for name in VALUE_FIELDS])
+
+
+def param_display_value(param_id, value_str=None, value_int=None,
+                        value_real=None, value_path=None, value_enum_id=None,
+                        using=DEFAULT_DB_ALIAS):
+    """`display_value` значения параметра."""
+    data_type = Parameter.objects.using(using).filter(
+        pk=param_id
+    ).values_list('data_type', flat=True).first()
+    enum = None
+    if data_type == 'enum' and value_enum_id is not None:
+        enum = EnumValue.objects.using(using).filter(
+            pk=value_enum_id
+        ).values_list('display_value', flat=True).first()
+    return format_value(data_type, value_str, value_int, value_real,
+                        value_path, enum_display=enum)
+
+
+# Пересчёт. Функции с `apps` вызываются из миграций.
+
+def _update(queryset, fields, display):
+    """Обновляет `display_value` строк `queryset`, которое `display`
+    вычисляет по полям `fields`, порциями по первичному ключу; возвращает
+    число изменённых строк."""
+    model = queryset.model
+    queryset = queryset.order_by('pk')
+    last = None
+    updated = 0
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = list(chunk.values_list(
+            'pk', 'display_value', *fields
+        )[:BATCH_SIZE])
+        if not rows:
+            return updated
+        stale = []
+        for pk, stored, *values in rows:
+            value = display(values)
+            if value != stored:
+                stale.append(model(pk=pk, display_value=value))
+        model.objects.using(queryset.db).bulk_update(stale,
+                                                     ['display_value'])
+        updated += len(stale)
+        last = rows[-1][0]
+
+
+def _refresh(models, source, targets, param_ids=None, enum_ids=None):
+    Parameter, EnumValue, ParameterValue = models
+    data_types = dict(
+        Parameter.objects.using(source).values_list('id', 'data_type')
+    )
+    enums = {pk: enum_display(values) for pk, *values in
+             EnumValue.objects.using(source).values_list('id',
+                                                         *VALUE_FIELDS)}
+
+    def value_display(row):
+        param_id, enum_id, *values = row
+        return format_value(data_types.get(param_id), *values,
+                            enum_display=enums.get(enum_id))
+
+    changed = Q()
+    if param_ids is not None:
+        changed |= Q(param_id__in=param_ids)
+    if enum_ids is not None:
+        changed |= Q(value_enum_id__in=enum_ids)
+    for alias in targets:
+        with transaction.atomic(using=alias):
+            items = EnumValue.objects.using(alias)
+            if enum_ids is not None:
+                items = items.filter(pk__in=enum_ids)
+            _update(items, VALUE_FIELDS, enum_display)
+            values = ParameterValue.objects.using(alias)
+            if param_ids is not None or enum_ids is not None:
+                values = values.filter(changed)
+            _update(values, ('param_id', 'value_enum_id', *VALUE_FIELDS),
+                    value_display)
+
+
+def fill_display_values(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    _refresh([apps.get_model('django_db_app', name) for name in (
+        'Parameter', 'EnumValue', 'ParameterValue'
+    )], alias, [alias])
+
+
+def refresh(param_ids=None, enum_ids=None):
+    """Пересчитывает `display_value` значений параметров `param_ids`,
+    элементов перечислений `enum_ids` и значений, ссылающихся на них
+    (None — всех), во всех базах каталога.
+
+    Справочники читаются из `default`: их копии в шардах обновляются
+    только после фиксации.
+    """
+    _refresh((Parameter, EnumValue, ParameterValue), DEFAULT_DB_ALIAS,
+             sharding.shards() if sharding.enabled() else [DEFAULT_DB_ALIAS],
+             param_ids, enum_ids)
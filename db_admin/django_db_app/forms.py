@@ -41,3 +41,36 @@ class ParentParamForm(forms.Form):
             )
 
         return parent_param_id
+
+
+class ReportFormatForm(forms.Form):
+    LAYOUTS = [
+        ('tall', 'Параметры строками'),
+        ('wide', 'Параметры столбцами'),
+    ]
+    FORMATS = [
+        ('html', 'HTML'),
+        ('csv', 'CSV'),
+        ('json', 'JSON'),
+    ]
+
+    layout = forms.ChoiceField(
+        choices=LAYOUTS,
+        label='Вид отчёта',
+        required=False,
+    )
+    format = forms.ChoiceField(
+        choices=FORMATS,
+        label='Формат',
+        required=False,
+    )
+
+    def get_layout(self):
+        if self.is_valid():
+            return self.cleaned_data['layout'] or 'tall'
+        return 'tall'
+
+    def get_format(self):
+        if self.is_valid():
+            return self.cleaned_data['format'] or 'html'
+        return 'html'
@@ -0,0 +1,346 @@
+"""Фоновые выгрузки отчётов.
+
+Полные отчёты и выгрузки строятся дольше таймаута прокси, поэтому их можно
+поставить в очередь (`POST /jobs/`, см. `ExportJobCreateView`). Очередь —
+таблица `ExportJob` в базе, отдельного брокера нет: выгрузки выполняет
+процесс `manage.py export_jobs worker` в `EXPORT_JOBS_CONCURRENCY`
+потоков; процессов может быть несколько, задание достаётся одному из них
+условным UPDATE.
+
+Пока выгрузка с теми же видом, параметрами, раскладкой и форматом ждёт
+или выполняется, новая не создаётся — возвращается существующая (уникальный
+частичный индекс `export_job_active_key`). Во время выполнения в задании
+обновляется число выгруженных изделий (`rows` из `total`), готовый файл
+хранится в `EXPORT_JOBS_DIR` `EXPORT_JOBS_KEEP` секунд.
+
+Выполняющий процесс отмечает свои задания раз в
+`EXPORT_JOBS_POLL_INTERVAL` секунд; задания без отметки дольше
+`EXPORT_JOBS_STALE_AFTER` секунд (процесс завершился) возвращаются в
+очередь. Если заданы реплики (`replicas.py`), выгрузка читает реплику,
+в которой уже есть изменения по момент постановки в очередь. Большие
+выгрузки строятся частями в нескольких процессах (`parallel.py`).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import (DatabaseError, IntegrityError, connections,
+                       transaction)
+from django.utils import timezone
+
+from . import parallel
+from .metrics import export_jobs, flush
+from .models import Category, ExportJob, ParameterAggregate, Product
+from .replicas import reading
+from .reports import (Pivot, ReportQuery, iter_pivot_csv, iter_pivot_json,
+                      iter_rows_csv, iter_rows_json)
+from .sharding import fan_out
+
+logger = logging.getLogger(__name__)
+
+
+# Виды выгрузок: параметры задания -> (изделия, параметры, пустое значение),
+# как в соответствующих страницах отчётов.
+
+def _products_with_params(params):
+    category = Category.objects.get(pk=params['category'])
+    return (Product.objects.filter(category_id__in=category.get_subtree_ids()),
+            None, None)
+
+
+def _all_products_with_params(params):
+    return Product.objects.all(), None, ''
+
+
+def _products_with_aggregate_params(params):
+    param_ids = list(ParameterAggregate.objects.filter(
+        parent_param_id=params['parent_param_id']
+    ).order_by('pk').values_list('param_id', flat=True))
+    return Product.objects.all(), param_ids, None
+
+
+KINDS = {
+    'products_with_params': _products_with_params,
+    'all_products_with_params': _all_products_with_params,
+    'products_with_aggregate_params': _products_with_aggregate_params,
+}
+
+EXPORTERS = {
+    ('tall', 'csv'): iter_rows_csv,
+    ('tall', 'json'): iter_rows_json,
+    ('wide', 'csv'): iter_pivot_csv,
+    ('wide', 'json'): iter_pivot_json,
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'json': 'application/json; charset=utf-8',
+}
+
+
+def export_dir():
+    return Path(getattr(settings, 'EXPORT_JOBS_DIR',
+                        settings.BASE_DIR / 'exports'))
+
+
+def job_path(job):
+    return export_dir() / job.file_name
+
+
+def job_key(kind, params, layout, export_format):
+    payload = json.dumps([kind, params, layout, export_format],
+                         sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def submit(kind, params, layout='tall', export_format='csv', user=None):
+    """Ставит выгрузку в очередь.
+
+    Возвращает `(job, created)`; если такая же выгрузка уже ждёт или
+    выполняется, возвращается она и `created` ложно.
+    """
+    if kind not in KINDS:
+        raise ValueError(f'Неизвестный вид выгрузки: {kind}.')
+    if (layout, export_format) not in EXPORTERS:
+        raise ValueError(f'Неподдерживаемая выгрузка: {layout}, '
+                         f'{export_format}.')
+    key = job_key(kind, params, layout, export_format)
+    active = ExportJob.objects.filter(key=key, status__in=ExportJob.ACTIVE)
+    # Одновременная постановка той же выгрузки отклоняется индексом;
+    # найденная выгрузка могла тут же завершиться, тогда попытка повторяется.
+    for _ in range(3):
+        job = active.first()
+        if job is not None:
+            return job, False
+        try:
+            with transaction.atomic():
+                job = ExportJob.objects.create(
+                    kind=kind, params=params, layout=layout,
+                    format=export_format, key=key,
+                    created_by=user if user and user.is_authenticated
+                    else None,
+                )
+        except IntegrityError:
+            continue
+        export_jobs.inc(kind, 'submitted')
+        return job, True
+    raise RuntimeError('Не удалось поставить выгрузку в очередь.')
+
+
+def claim(worker):
+    """Забирает самое раннее задание из очереди или возвращает None."""
+    pending = ExportJob.objects.filter(status=ExportJob.PENDING)
+    while True:
+        pk = pending.order_by('pk').values_list('pk', flat=True).first()
+        if pk is None:
+            return None
+        now = timezone.now()
+        # Задание достаётся тому, чей UPDATE выполнится первым.
+        if pending.filter(pk=pk).update(status=ExportJob.RUNNING,
+                                        worker=worker, started_at=now,
+                                        heartbeat_at=now, rows=0, error=''):
+            return ExportJob.objects.get(pk=pk)
+
+
+def requeue_stale():
+    """Возвращает в очередь задания процессов, переставших отмечаться."""
+    stale_after = getattr(settings, 'EXPORT_JOBS_STALE_AFTER', 60)
+    return ExportJob.objects.filter(
+        status=ExportJob.RUNNING,
+        heartbeat_at__lt=timezone.now() - timedelta(seconds=stale_after),
+    ).update(status=ExportJob.PENDING, worker='', started_at=None)
+
+
+def cleanup():
+    """Удаляет задания с истёкшим сроком хранения вместе с файлами."""
+    expired = ExportJob.objects.filter(
+        status__in=(ExportJob.DONE, ExportJob.FAILED),
+        expires_at__lt=timezone.now(),
+    )
+    removed = 0
+    for job in expired.iterator():
+        if job.file_name:
+            job_path(job).unlink(missing_ok=True)
+        job.delete()
+        removed += 1
+    return removed
+
+
+class JobLost(Exception):
+    """Задание возвращено в очередь или процесс останавливается."""
+
+
+class _TrackedQuery(ReportQuery):
+    """Запрос отчёта, сообщающий число выданных изделий."""
+
+    def __init__(self, *args, progress, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.progress = progress
+        self.rows = 0
+
+    def __iter__(self):
+        for header in super().__iter__():
+            self.rows += 1
+            self.progress(self.rows)
+            yield header
+
+
+class Worker:
+    """Рабочий процесс очереди выгрузок.
+
+    Выгрузки выполняются в потоках; ход выполнения и отметки заданий
+    записывает основной поток (`maintain`). Поток выгрузки во время чтения
+    отчёта в базу не пишет: в SQLite запись из соединения с открытым
+    курсором чтения может взаимно заблокироваться с записью другого
+    соединения. В режиме журнала по умолчанию (не WAL) запись всё равно
+    ждёт окончания чтения, поэтому `EXPORT_JOBS_STALE_AFTER` должен
+    превышать длительность самой долгой выгрузки.
+    """
+
+    def __init__(self, concurrency=None, name=None):
+        self.concurrency = concurrency or getattr(
+            settings, 'EXPORT_JOBS_CONCURRENCY', 2
+        )
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        # job_id -> число выгруженных изделий для выполняемых заданий.
+        self._rows = {}
+        # Задания, возвращённые в очередь другим процессом.
+        self._lost = set()
+
+    @property
+    def poll_interval(self):
+        return getattr(settings, 'EXPORT_JOBS_POLL_INTERVAL', 1)
+
+    def run(self, once=False):
+        """Выполняет задания до остановки; при `once` — пока очередь не
+        опустеет."""
+        self.maintain()
+        threads = [
+            threading.Thread(target=self._loop, args=(once,),
+                             name=f'export-worker-{index}', daemon=True)
+            for index in range(self.concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(self.poll_interval / len(threads))
+                self.maintain()
+        finally:
+            # Выполняемые задания прерываются и возвращаются в очередь.
+            self.stopping.set()
+            for thread in threads:
+                thread.join()
+            ExportJob.objects.filter(
+                status=ExportJob.RUNNING, worker=self.name
+            ).update(status=ExportJob.PENDING, worker='', started_at=None)
+            flush(force=True)
+
+    def maintain(self):
+        try:
+            now = timezone.now()
+            for job_id, rows in list(self._rows.items()):
+                if not ExportJob.objects.filter(
+                        pk=job_id, worker=self.name, status=ExportJob.RUNNING
+                ).update(rows=rows, heartbeat_at=now):
+                    self._lost.add(job_id)
+            requeue_stale()
+            cleanup()
+        except DatabaseError:
+            # Например, база занята; повторится на следующем цикле.
+            logger.exception('Обслуживание очереди выгрузок не выполнено.')
+        flush()
+
+    def _loop(self, once):
+        try:
+            while not self.stopping.is_set():
+                job = claim(self.name)
+                if job is None:
+                    if once:
+                        return
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                self._rows[job.pk] = 0
+                try:
+                    self.execute(job)
+                finally:
+                    self._rows.pop(job.pk, None)
+                    self._lost.discard(job.pk)
+        finally:
+            connections.close_all()
+
+    def execute(self, job):
+        running = ExportJob.objects.filter(pk=job.pk, worker=self.name,
+                                           status=ExportJob.RUNNING)
+
+        def progress(rows):
+            if self.stopping.is_set() or job.pk in self._lost:
+                raise JobLost
+            self._rows[job.pk] = rows
+
+        job.file_name = f'{job.pk}-{job.kind}.{job.format}'
+        path = job_path(job)
+        partial = path.with_name(path.name + '.part')
+        started = time.perf_counter()
+        try:
+            with reading(job.created_at.timestamp()):
+                products, param_ids, empty = KINDS[job.kind](job.params)
+                total = sum(part.count() for part in fan_out(products))
+                running.update(total=total)
+                if job.layout == 'wide':
+                    empty = ''
+                if parallel.applies(products, total):
+                    chunks = parallel.iter_export(
+                        products, job.layout, job.format,
+                        param_ids=param_ids, empty=empty, name=job.kind,
+                        progress=progress,
+                    )
+                else:
+                    query = _TrackedQuery(products, param_ids=param_ids,
+                                          empty=empty, name=job.kind,
+                                          progress=progress)
+                    source = Pivot(query) if job.layout == 'wide' else query
+                    chunks = EXPORTERS[job.layout, job.format](source)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(partial, 'w', encoding='utf-8', newline='') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+            os.replace(partial, path)
+        except JobLost:
+            partial.unlink(missing_ok=True)
+            logger.info('Выгрузка %s прервана.', job.pk)
+            return
+        except Exception as e:
+            partial.unlink(missing_ok=True)
+            logger.exception('Выгрузка %s завершилась ошибкой.', job.pk)
+            self.finish(running, ExportJob.FAILED, job.kind, error=str(e))
+            return
+
+        if not self.finish(running, ExportJob.DONE, job.kind,
+                           rows=self._rows[job.pk],
+                           file_name=job.file_name):
+            path.unlink(missing_ok=True)
+            return
+        logger.info('Выгрузка %s готова за %.1f с.', job.pk,
+                    time.perf_counter() - started)
+
+    def finish(self, running, status, kind, **fields):
+        now = timezone.now()
+        keep = getattr(settings, 'EXPORT_JOBS_KEEP', 24 * 3600)
+        finished = running.update(
+            status=status, finished_at=now,
+            expires_at=now + timedelta(seconds=keep), **fields
+        )
+        if finished:
+            export_jobs.inc(kind, status)
+        return finished
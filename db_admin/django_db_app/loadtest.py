@@ -0,0 +1,450 @@
+"""Нагрузочное тестирование страниц каталога.
+
+Генератор нагрузки работает в одном процессе на asyncio и не требует
+внешних сервисов и библиотек: HTTP/1.1 с keep-alive реализован поверх
+`asyncio.open_connection`. Клиент входит через `auth/login/` и затем
+повторяет смесь запросов к страницам каталога и спискам админки, выбирая
+их случайно с заданными весами (`ENDPOINTS`, `DEFAULT_MIX`).
+
+Режимы:
+
+* замкнутый — `concurrency` виртуальных пользователей отправляют
+  запросы один за другим без пауз;
+* открытый — запросы отправляются с частотой `rate` в секунду независимо
+  от ответов, одновременно выполняется не больше `concurrency`. Задержка
+  считается от запланированного момента отправки, поэтому ожидание
+  свободного соединения в неё входит.
+
+Результат (`LoadTest.result()`) содержит пропускную способность и
+перцентили задержки по каждой странице и сохраняется в JSON для сравнения
+прогонов (`compare`), например WSGI и ASGI или разного числа рабочих
+процессов.
+"""
+
+import asyncio
+import math
+import random
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode, urlsplit
+
+from .models import Category, ParameterAggregate, Product
+
+PERCENTILES = (50, 95, 99)
+
+
+# Страница — функция `(rng, ids) -> (method, path, form)`; атрибут `source`
+# называет список идентификаторов из `sample_ids()`, которые ей нужны.
+
+def _admin(model):
+    def request(rng, ids):
+        return 'GET', f'/admin/django_db_app/{model}/', None
+    request.source = None
+    return request
+
+
+def _get(path, key=None, source=None):
+    def request(rng, ids):
+        if key is None:
+            return 'GET', path, None
+        query = urlencode({key: rng.choice(ids[source])})
+        return 'GET', f'{path}?{query}', None
+    request.source = source
+    return request
+
+
+def _post(path, key, source):
+    def request(rng, ids):
+        return 'POST', path, {key: rng.choice(ids[source])}
+    request.source = source
+    return request
+
+
+ENDPOINTS = {
+    'classifier': _get('/classifier/'),
+    'descendants_by_category': _post('/descendants_by_category/',
+                                     'category', 'categories'),
+    'products_with_params': _post('/products_with_params/',
+                                  'category', 'categories'),
+    'product_params': _get('/product_params/', 'product', 'products'),
+    'products_with_aggregate_params': _get(
+        '/products_with_aggregate_params/', 'parent_param_id', 'aggregates'
+    ),
+    'admin_category': _admin('category'),
+    'admin_product': _admin('product'),
+    'admin_parametervalue': _admin('parametervalue'),
+}
+
+DEFAULT_MIX = {
+    'classifier': 2,
+    'descendants_by_category': 2,
+    'products_with_params': 1,
+    'product_params': 4,
+    'products_with_aggregate_params': 1,
+    'admin_category': 1,
+    'admin_product': 1,
+    'admin_parametervalue': 1,
+}
+
+
+def sample_ids(limit=1000, using=None, seed=0):
+    """Идентификаторы для параметров запросов, не больше `limit` каждого
+    вида."""
+    rng = random.Random(seed)
+
+    def pick(queryset):
+        ids = list(queryset.using(using).values_list('pk', flat=True))
+        return rng.sample(ids, min(limit, len(ids)))
+
+    return {
+        'categories': pick(Category.objects.filter(is_enum=False)),
+        'products': pick(Product.objects.all()),
+        'aggregates': pick(ParameterAggregate.objects.order_by().values(
+            'parent_param_id'
+        ).distinct().values_list('parent_param_id', flat=True)),
+    }
+
+
+def percentile(ordered, p):
+    """Перцентиль по рангу для отсортированного списка."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class HTTPError(Exception):
+    """Ошибка протокола или неожиданный ответ сервера."""
+
+
+class Connection:
+    """Соединение HTTP/1.1 с keep-alive."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    @classmethod
+    async def open(cls, host, port, ssl):
+        return cls(*await asyncio.open_connection(host, port, ssl=ssl))
+
+    async def request(self, method, target, headers, body=b''):
+        """Отправляет запрос; возвращает `(status, headers, body)`."""
+        lines = [f'{method} {target} HTTP/1.1']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        if body:
+            lines.append(f'Content-Length: {len(body)}')
+        self.writer.write('\r\n'.join(lines).encode('latin-1') +
+                          b'\r\n\r\n' + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise HTTPError('Соединение закрыто сервером.')
+        version, status, *_ = status_line.decode('latin-1').split(' ', 2)
+        response_headers = []
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers.append((name.strip().lower(), value.strip()))
+        fields = dict(response_headers)
+
+        if method == 'HEAD' or status in ('204', '304'):
+            content = b''
+        elif 'chunked' in fields.get('transfer-encoding', ''):
+            parts = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while await self.reader.readline() not in (b'\r\n', b''):
+                        pass
+                    break
+                parts.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            content = b''.join(parts)
+        elif 'content-length' in fields:
+            content = await self.reader.readexactly(
+                int(fields['content-length'])
+            )
+        else:
+            content = await self.reader.read()
+            self.closed = True
+
+        connection = fields.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and
+                                     connection != 'keep-alive'):
+            self.closed = True
+        return int(status), response_headers, content
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, latency, status=None, size=0):
+        self.latencies.append(latency)
+        key = str(status) if status is not None else 'exception'
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        self.bytes += size
+        if status is None or status >= 300:
+            self.errors += 1
+
+    def result(self, duration):
+        ordered = sorted(self.latencies)
+        requests = len(ordered)
+        latency = {'mean': sum(ordered) / requests * 1000 if requests
+                   else None,
+                   'max': ordered[-1] * 1000 if requests else None}
+        for p in PERCENTILES:
+            value = percentile(ordered, p)
+            latency[f'p{p}'] = value * 1000 if value is not None else None
+        return {
+            'requests': requests,
+            'errors': self.errors,
+            'statuses': self.statuses,
+            'throughput_rps': requests / duration if duration else 0.0,
+            'bytes': self.bytes,
+            'latency_ms': {key: round(value, 3) if value is not None else None
+                           for key, value in latency.items()},
+        }
+
+
+class LoadTest:
+    """Прогон нагрузки; `await run()`, затем `result()`.
+
+    `mix` — веса страниц из `ENDPOINTS`, `ids` — результат `sample_ids()`.
+    Ответы со статусом 3xx и выше считаются ошибками: перенаправление на
+    страницу входа означает, что сессия не действует.
+    """
+
+    def __init__(self, url, username, password, ids, mix=None,
+                 concurrency=10, rate=None, duration=30.0, warmup=5.0,
+                 timeout=30.0, seed=0):
+        parts = urlsplit(url)
+        self.url = url.rstrip('/')
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = parts.scheme == 'https'
+        self.netloc = parts.netloc
+        self.username = username
+        self.password = password
+        self.ids = ids
+        self.mix = dict(mix or DEFAULT_MIX)
+        unknown = set(self.mix) - set(ENDPOINTS)
+        if unknown:
+            raise ValueError(f"Неизвестные страницы: {', '.join(unknown)}.")
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.cookies = {}
+        self.idle = []
+        self.stats = {name: EndpointStats() for name in self.mix}
+        self.server = None
+        self.started_at = None
+        self.elapsed = 0.0
+
+    # Соединения и cookie.
+
+    async def acquire(self):
+        while self.idle:
+            connection = self.idle.pop()
+            if not connection.closed:
+                return connection
+        return await Connection.open(self.host, self.port, self.ssl)
+
+    def release(self, connection):
+        if connection.closed:
+            connection.close()
+        else:
+            self.idle.append(connection)
+
+    def headers(self, path, form=False):
+        headers = {
+            'Host': self.netloc,
+            'User-Agent': 'catalog-load-test',
+            'Accept': 'text/html,application/json',
+            'Referer': self.url + path,
+        }
+        if self.cookies:
+            headers['Cookie'] = '; '.join(
+                f'{name}={value}' for name, value in self.cookies.items()
+            )
+        if form:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['X-CSRFToken'] = self.cookies.get('csrftoken', '')
+        return headers
+
+    async def fetch(self, method, path, form=None):
+        body = urlencode(form).encode() if form is not None else b''
+        connection = await self.acquire()
+        try:
+            status, headers, content = await asyncio.wait_for(
+                connection.request(method, path,
+                                   self.headers(path, form is not None),
+                                   body),
+                self.timeout,
+            )
+        except BaseException:
+            connection.close()
+            raise
+        self.release(connection)
+        for name, value in headers:
+            if name == 'set-cookie':
+                cookie, _, _ = value.partition(';')
+                key, _, cookie_value = cookie.partition('=')
+                self.cookies[key.strip()] = cookie_value.strip()
+            elif name == 'server' and self.server is None:
+                self.server = value
+        return status, content
+
+    async def login(self):
+        status, _ = await self.fetch('GET', '/auth/login/')
+        if status != 200 or 'csrftoken' not in self.cookies:
+            raise HTTPError(f'Страница входа вернула {status}.')
+        status, _ = await self.fetch('POST', '/auth/login/', {
+            'username': self.username,
+            'password': self.password,
+        })
+        if status != 302 or 'sessionid' not in self.cookies:
+            raise HTTPError('Не удалось войти: проверьте имя и пароль.')
+
+    # Нагрузка.
+
+    def choose(self):
+        names = list(self.mix)
+        name = self.rng.choices(names, weights=[self.mix[n] for n in names])[0]
+        return name, ENDPOINTS[name](self.rng, self.ids)
+
+    async def call(self, name, method, path, form, scheduled, measure_from):
+        try:
+            status, content = await self.fetch(method, path, form)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                HTTPError, ValueError):
+            status, content = None, b''
+        finished = time.perf_counter()
+        if scheduled >= measure_from:
+            self.stats[name].record(finished - scheduled, status,
+                                    len(content))
+
+    async def closed_loop(self, measure_from, end):
+        async def user():
+            while time.perf_counter() < end:
+                name, (method, path, form) = self.choose()
+                await self.call(name, method, path, form,
+                                time.perf_counter(), measure_from)
+
+        await asyncio.gather(*(user() for _ in range(self.concurrency)))
+
+    async def open_loop(self, measure_from, end):
+        slots = asyncio.Semaphore(self.concurrency)
+        interval = 1 / self.rate
+        tasks = set()
+
+        async def send(name, request, scheduled):
+            async with slots:
+                await self.call(name, *request, scheduled, measure_from)
+
+        scheduled = time.perf_counter()
+        while scheduled < end:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name, request = self.choose()
+            task = asyncio.create_task(send(name, request, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            scheduled += interval
+        await asyncio.gather(*tasks)
+
+    async def run(self):
+        await self.login()
+        self.started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        measure_from = started + self.warmup
+        end = measure_from + self.duration
+        try:
+            if self.rate:
+                await self.open_loop(measure_from, end)
+            else:
+                await self.closed_loop(measure_from, end)
+        finally:
+            for connection in self.idle:
+                connection.close()
+            self.idle.clear()
+        self.elapsed = time.perf_counter() - measure_from
+
+    def result(self, label=''):
+        duration = self.elapsed
+        endpoints = {name: stats.result(duration)
+                     for name, stats in self.stats.items()}
+        requests = sum(e['requests'] for e in endpoints.values())
+        errors = sum(e['errors'] for e in endpoints.values())
+        latencies = sorted(latency for stats in self.stats.values()
+                           for latency in stats.latencies)
+        return {
+            'label': label,
+            'started_at': self.started_at.isoformat()
+            if self.started_at else None,
+            'config': {
+                'url': self.url,
+                'server': self.server,
+                'mode': 'open' if self.rate else 'closed',
+                'concurrency': self.concurrency,
+                'rate': self.rate,
+                'duration_s': self.duration,
+                'warmup_s': self.warmup,
+                'mix': self.mix,
+            },
+            'totals': {
+                'requests': requests,
+                'errors': errors,
+                'duration_s': round(duration, 3),
+                'throughput_rps': requests / duration if duration else 0.0,
+                'latency_ms': {
+                    f'p{p}': round(percentile(latencies, p) * 1000, 3)
+                    if latencies else None
+                    for p in PERCENTILES
+                },
+            },
+            'endpoints': endpoints,
+        }
+
+
+def compare(base, other):
+    """Строки сравнения двух результатов: пропускная способность и
+    перцентили по страницам и в целом."""
+    def change(old, new):
+        if old in (None, 0) or new is None:
+            return ''
+        return f' ({(new - old) / old * 100:+.0f}%)'
+
+    def line(name, old, new):
+        parts = [f"{name}: rps {old['throughput_rps']:.1f} → "
+                 f"{new['throughput_rps']:.1f}"
+                 f"{change(old['throughput_rps'], new['throughput_rps'])}"]
+        for p in PERCENTILES:
+            a, b = old['latency_ms'][f'p{p}'], new['latency_ms'][f'p{p}']
+            if a is not None and b is not None:
+                parts.append(f'p{p} {a:.1f} → {b:.1f} мс{change(a, b)}')
+        if old.get('errors') or new.get('errors'):
+            parts.append(f"ошибки {old['errors']} → {new['errors']}")
+        return ', '.join(parts)
+
+    lines = [line('всего', base['totals'], other['totals'])]
+    for name in base['endpoints']:
+        if name in other['endpoints']:
+            lines.append(line(name, base['endpoints'][name],
+                              other['endpoints'][name]))
+    return lines
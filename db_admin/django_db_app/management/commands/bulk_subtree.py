@@ -0,0 +1,74 @@
+"""Массовые операции над поддеревом категорий.
+
+Примеры:
+```bash
+py manage.py bulk_subtree set-param --category 4 --param l --value 50
+py manage.py bulk_subtree clear-param --category 4 --param l
+py manage.py bulk_subtree hoist-param --category 4 --param l
+py manage.py bulk_subtree reprice --category 4 --percent 10
+py manage.py bulk_subtree reprice --category 4 --amount -5
+```
+"""
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from ...bulk import (adjust_prices, clear_param_value, hoist_param,
+                     resolve_param, set_param_value)
+from ...models import Category
+
+
+class Command(BaseCommand):
+    help = 'Массовые операции над изделиями поддерева категорий.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        for name, help_text in (
+                ('set-param', 'Задать значение параметра всем изделиям.'),
+                ('clear-param', 'Удалить значения параметра у изделий.'),
+                ('hoist-param', 'Перенести одинаковые значения параметра '
+                                'на уровень категорий.')):
+            subparser = operations.add_parser(name, help=help_text)
+            subparser.add_argument('--category', type=int, required=True)
+            subparser.add_argument('--param', required=True,
+                                   help='Краткое имя параметра.')
+            if name == 'set-param':
+                subparser.add_argument('--value', required=True)
+
+        reprice = operations.add_parser('reprice',
+                                        help='Изменить цены изделий.')
+        reprice.add_argument('--category', type=int, required=True)
+        reprice.add_argument('--percent', help='Изменение в процентах.')
+        reprice.add_argument('--amount', help='Изменение на сумму.')
+
+    def handle(self, *args, **options):
+        try:
+            category = Category.objects.get(pk=options['category'])
+        except Category.DoesNotExist:
+            raise CommandError(
+                f"Категория с ID {options['category']} не существует."
+            )
+
+        operation = options['operation']
+        try:
+            if operation == 'reprice':
+                result = adjust_prices(category, percent=options['percent'],
+                                       amount=options['amount'])
+            else:
+                param = resolve_param(options['param'])
+                if operation == 'set-param':
+                    result = set_param_value(category, param,
+                                             options['value'])
+                elif operation == 'clear-param':
+                    result = clear_param_value(category, param)
+                else:
+                    result = hoist_param(category, param)
+        except ValidationError as e:
+            raise CommandError('; '.join(e.messages))
+
+        summary = ', '.join(f'{key}: {value}'
+                            for key, value in result.items())
+        self.stdout.write(self.style.SUCCESS(
+            f'{operation} ({category.name}) — {summary}'
+        ))
@@ -0,0 +1,62 @@
+"""Журнал изменений каталога.
+
+Примеры:
+```bash
+py manage.py catalog_changes since 0
+py manage.py catalog_changes since 1500 --limit 100
+py manage.py catalog_changes compact
+py manage.py catalog_changes compact --tombstone-days 7
+```
+
+`since` выводит изменения после заданного номера по одному JSON-объекту
+на строку, запрашивая их порциями до конца журнала.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...changes import (ChangeLogCompacted, ChangeLogUnavailable,
+                         changes_since, compact)
+
+
+class Command(BaseCommand):
+    help = 'Выгрузка и сжатие журнала изменений каталога.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        since = operations.add_parser(
+            'since', help='Вывести изменения после заданного номера.'
+        )
+        since.add_argument('seq', type=int)
+        since.add_argument('--limit', type=int,
+                           help='Размер порции (не больше '
+                                'CATALOG_CHANGES_BATCH_SIZE).')
+
+        compact_parser = operations.add_parser(
+            'compact', help='Сжать журнал изменений.'
+        )
+        compact_parser.add_argument(
+            '--tombstone-days', type=int,
+            help='Возраст записей об удалении, после которого они удаляются.'
+        )
+
+    def handle(self, *args, **options):
+        if options['operation'] == 'compact':
+            result = compact(options['tombstone_days'])
+            summary = ', '.join(f'{key}: {value}'
+                                for key, value in result.items())
+            self.stdout.write(self.style.SUCCESS(f'compact — {summary}'))
+            return
+
+        seq = options['seq']
+        has_more = True
+        while has_more:
+            try:
+                changes, seq, has_more = changes_since(seq, options['limit'])
+            except (ChangeLogCompacted, ChangeLogUnavailable) as e:
+                raise CommandError(str(e))
+            for change in changes:
+                self.stdout.write(json.dumps(change, ensure_ascii=False))
+        self.stderr.write(f'next: {seq}')
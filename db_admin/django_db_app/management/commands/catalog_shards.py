@@ -0,0 +1,109 @@
+"""Обслуживание шардов каталога.
+
+Примеры:
+```bash
+py manage.py migrate --database catalog_1
+py manage.py catalog_shards init
+py manage.py catalog_shards status
+py manage.py catalog_shards move 12 catalog_1
+py manage.py catalog_shards sync
+```
+
+`init` сдвигает счётчики идентификаторов шардов в их диапазоны, копирует
+в шарды справочники и закрепляет за `default` уже существующие
+категории. `sync` повторно копирует справочники (после массовых операций
+над ними) и удаляет из шардов поддеревья, размещённые в других шардах.
+`move` переносит поддерево категории верхнего уровня в другой шард; на
+время переноса записи в поддерево следует остановить.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from ... import sharding
+from ...models import Category, ParameterValue, Product
+from ...paramcache import param_cache
+from ...rollup import rollups
+from ...signals import invalidate_analytics
+
+
+class Command(BaseCommand):
+    help = 'Инициализация, синхронизация и перенос шардов каталога.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        operations.add_parser('init', help='Подготовить шарды.')
+        operations.add_parser('sync', help='Синхронизировать справочники.')
+        operations.add_parser('status', help='Показать содержимое шардов.')
+
+        move = operations.add_parser(
+            'move', help='Перенести поддерево категории верхнего уровня.'
+        )
+        move.add_argument('category_id', type=int)
+        move.add_argument('shard')
+        move.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Шардинг выключен: в CATALOG_SHARDS меньше '
+                               'двух баз.')
+        operation = options['operation']
+        if operation == 'status':
+            return self.status()
+
+        if operation == 'move':
+            if options['shard'] not in sharding.shards():
+                raise CommandError(f"Неизвестный шард: {options['shard']}.")
+            try:
+                result = sharding.move_subtree(
+                    options['category_id'], options['shard'],
+                    options['batch_size']
+                )
+            except (Category.DoesNotExist, ValueError) as e:
+                raise CommandError(str(e))
+            # Перенос обходит сигналы.
+            rollups.invalidate()
+            param_cache.invalidate()
+            invalidate_analytics()
+            self.write_result(operation, result)
+            return
+
+        if operation == 'init':
+            for alias in sharding.shards()[1:]:
+                sharding.init_shard(alias)
+            placement = sharding.directory.get(refresh=True)
+            unplaced = [
+                pk for pk in Category.objects.using(DEFAULT_DB_ALIAS).filter(
+                    is_enum=False
+                ).values_list('pk', flat=True)
+                if pk not in placement
+            ]
+            sharding.directory.place(unplaced, DEFAULT_DB_ALIAS)
+            self.write_result('init', {'placed': len(unplaced)})
+
+        for alias in sharding.shards()[1:]:
+            self.write_result(f'sync {alias}', sharding.sync_shard(alias))
+
+    def status(self):
+        placement = sharding.directory.get(refresh=True)
+        for alias in sharding.shards():
+            counts = {
+                'categories': Category.objects.using(alias).filter(
+                    is_enum=False
+                ).count(),
+                'placed': sum(1 for shard in placement.values()
+                              if shard == alias),
+                'products': Product.objects.using(alias).count(),
+                'values': ParameterValue.objects.using(alias).count(),
+            }
+            self.stdout.write(f'{alias} — {self.summary(counts)}')
+
+    @staticmethod
+    def summary(result):
+        return ', '.join(f'{key}: {value}' for key, value in result.items())
+
+    def write_result(self, operation, result):
+        self.stdout.write(self.style.SUCCESS(
+            f'{operation} — {self.summary(result)}'
+        ))
@@ -0,0 +1,107 @@
+"""Фоновые выгрузки отчётов.
+
+Примеры:
+```bash
+py manage.py export_jobs worker
+py manage.py export_jobs worker --concurrency 4
+py manage.py export_jobs worker --once
+py manage.py export_jobs list --status running
+py manage.py export_jobs cleanup
+py manage.py export_jobs bench --workers 1 2 4 8 --fill 200000
+```
+
+`worker` выполняет выгрузки из очереди (см. `jobs.py`) до остановки
+(Ctrl+C); прерванные выгрузки возвращаются в очередь. С `--once` процесс
+завершается, когда очередь пуста. `cleanup` удаляет выгрузки с истёкшим
+сроком хранения; рабочий процесс делает это сам. `bench` сравнивает
+время последовательной и параллельной (`parallel.py`) выгрузки всех
+изделий и проверяет, что они совпадают; с `--fill` он сначала добавляет
+синтетический каталог, поэтому запускайте его на копии базы.
+"""
+
+import logging
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import localtime
+
+from ...jobs import Worker, cleanup, requeue_stale
+from ...models import ExportJob
+from ...utils.benchmarks import bench_parallel_reports, fill_bench_data
+
+
+class Command(BaseCommand):
+    help = 'Выполнение, просмотр и очистка фоновых выгрузок.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        worker = operations.add_parser('worker',
+                                       help='Выполнять выгрузки из очереди.')
+        worker.add_argument('--concurrency', type=int,
+                            help='Число потоков (по умолчанию '
+                                 'EXPORT_JOBS_CONCURRENCY).')
+        worker.add_argument('--once', action='store_true',
+                            help='Завершиться, когда очередь пуста.')
+
+        list_parser = operations.add_parser('list', help='Список выгрузок.')
+        list_parser.add_argument('--status',
+                                 choices=[key for key, _ in
+                                          ExportJob.STATUSES])
+        list_parser.add_argument('--limit', type=int, default=50)
+
+        operations.add_parser('cleanup',
+                              help='Удалить выгрузки с истёкшим сроком.')
+
+        bench = operations.add_parser('bench',
+                                      help='Замер параллельной выгрузки.')
+        bench.add_argument('--workers', type=int, nargs='+',
+                           default=[1, 2, 4, 8])
+        bench.add_argument('--layout', choices=['tall', 'wide'],
+                           default='tall')
+        bench.add_argument('--format', choices=['csv', 'json'],
+                           default='csv')
+        bench.add_argument('--fill', type=int, metavar='PRODUCTS',
+                           help='Сначала добавить синтетический каталог.')
+
+    def handle(self, *args, **options):
+        operation = options['operation']
+        if operation == 'worker':
+            if options['verbosity'] > 0:
+                logging.basicConfig(level=logging.INFO,
+                                    format='%(asctime)s %(message)s')
+            worker = Worker(concurrency=options['concurrency'])
+            self.stdout.write(f'{worker.name}: {worker.concurrency} '
+                              f'потоков.')
+            try:
+                worker.run(once=options['once'])
+            except KeyboardInterrupt:
+                self.stdout.write('Остановлен.')
+            return
+
+        if operation == 'bench':
+            if options['fill']:
+                fill_bench_data(products=options['fill'])
+            bench_parallel_reports(workers=options['workers'],
+                                   layout=options['layout'],
+                                   export_format=options['format'])
+            return
+
+        if operation == 'cleanup':
+            requeued = requeue_stale()
+            removed = cleanup()
+            self.stdout.write(self.style.SUCCESS(
+                f'cleanup — removed: {removed}, requeued: {requeued}'
+            ))
+            return
+
+        jobs = ExportJob.objects.order_by('-pk')
+        if options['status']:
+            jobs = jobs.filter(status=options['status'])
+        for job in jobs[:options['limit']]:
+            total = f"/{job.total}" if job.total is not None else ''
+            self.stdout.write(
+                f'{job.pk}\t{job.status}\t{job.kind}\t'
+                f'{job.layout}.{job.format}\t{job.rows}{total}\t'
+                f'{localtime(job.created_at):%Y-%m-%d %H:%M}'
+                + (f'\t{job.error}' if job.error else '')
+            )
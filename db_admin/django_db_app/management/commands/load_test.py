@@ -0,0 +1,152 @@
+"""Нагрузочное тестирование запущенного сервера.
+
+Примеры:
+```bash
+py manage.py load_test run --url http://127.0.0.1:8000 --user admin
+py manage.py load_test run --concurrency 32 --duration 60 --label gunicorn-4 --output gunicorn-4.json
+py manage.py load_test run --rate 50 --mix product_params=3 --mix classifier=1 --output rate50.json
+py manage.py load_test compare gunicorn-4.json uvicorn-4.json
+```
+
+`run` входит под пользователем `--user` (пароль — `--password` или
+переменная окружения `LOAD_TEST_PASSWORD`, иначе запрашивается), выполняет
+смесь запросов (`--mix страница=вес`, по умолчанию `DEFAULT_MIX` из
+`loadtest.py`) и выводит пропускную способность и p50/p95/p99 по
+страницам. Без `--rate` нагрузка замкнутая: `--concurrency` пользователей
+без пауз; с `--rate` — заданное число запросов в секунду.
+
+Идентификаторы категорий, изделий и агрегатов для запросов берутся из
+базы `--database`, поэтому сервер должен работать с той же базой или её
+копией. Списки админки требуют пользователя с правом входа в админку.
+
+`compare` сравнивает два сохранённых результата по страницам.
+"""
+
+import asyncio
+import getpass
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...loadtest import (DEFAULT_MIX, ENDPOINTS, PERCENTILES, HTTPError,
+                         LoadTest, compare, sample_ids)
+
+
+def _weight(value):
+    name, _, weight = value.partition('=')
+    try:
+        return name, float(weight or 1)
+    except ValueError:
+        raise CommandError(f'Неверный вес: {value}.')
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочное тестирование страниц каталога и сравнение прогонов.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        run = operations.add_parser('run', help='Выполнить прогон.')
+        run.add_argument('--url', default='http://127.0.0.1:8000')
+        run.add_argument('--user', default='admin')
+        run.add_argument('--password')
+        run.add_argument('--concurrency', type=int, default=10,
+                         help='Пользователи (без --rate) или предел '
+                              'одновременных запросов (с --rate).')
+        run.add_argument('--rate', type=float,
+                         help='Запросов в секунду (открытая нагрузка).')
+        run.add_argument('--duration', type=float, default=30,
+                         help='Длительность измерения, секунды.')
+        run.add_argument('--warmup', type=float, default=5,
+                         help='Прогрев до начала измерения, секунды.')
+        run.add_argument('--timeout', type=float, default=30)
+        run.add_argument('--mix', action='append', type=_weight,
+                         metavar='PAGE=WEIGHT',
+                         help=f"Вес страницы; страницы: "
+                              f"{', '.join(ENDPOINTS)}.")
+        run.add_argument('--seed', type=int, default=0)
+        run.add_argument('--label', default='',
+                         help='Метка прогона, например конфигурация '
+                              'сервера.')
+        run.add_argument('--output', help='Сохранить результат в JSON.')
+        run.add_argument('--database', default=None)
+
+        compare_parser = operations.add_parser(
+            'compare', help='Сравнить два сохранённых прогона.'
+        )
+        compare_parser.add_argument('base')
+        compare_parser.add_argument('other')
+
+    def handle(self, *args, **options):
+        if options['operation'] == 'compare':
+            results = []
+            for path in (options['base'], options['other']):
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        results.append(json.load(f))
+                except (OSError, ValueError) as e:
+                    raise CommandError(f'{path}: {e}')
+            for line in compare(*results):
+                self.stdout.write(line)
+            return
+
+        mix = dict(options['mix'] or DEFAULT_MIX)
+        unknown = set(mix) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f"Неизвестные страницы: {', '.join(unknown)}.")
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency должен быть положительным.')
+        if options['rate'] is not None and not options['rate'] > 0:
+            raise CommandError('--rate должен быть положительным.')
+
+        ids = sample_ids(using=options['database'], seed=options['seed'])
+        for name in list(mix):
+            source = ENDPOINTS[name].source
+            if source is not None and not ids[source]:
+                self.stderr.write(f'{name}: нет данных ({source}), '
+                                  f'страница исключена.')
+                del mix[name]
+        if not mix:
+            raise CommandError('Смесь запросов пуста.')
+
+        password = (options['password'] or
+                    os.environ.get('LOAD_TEST_PASSWORD') or
+                    getpass.getpass(f"Пароль {options['user']}: "))
+        test = LoadTest(
+            options['url'], options['user'], password, ids, mix=mix,
+            concurrency=options['concurrency'], rate=options['rate'],
+            duration=options['duration'], warmup=options['warmup'],
+            timeout=options['timeout'], seed=options['seed'],
+        )
+        try:
+            asyncio.run(test.run())
+        except (OSError, HTTPError) as e:
+            raise CommandError(f'{options["url"]}: {e}')
+        result = test.result(options['label'])
+
+        totals = result['totals']
+        self.stdout.write(
+            f"{result['config']['server'] or 'сервер'}: "
+            f"{totals['requests']} запросов за {totals['duration_s']:.1f} с, "
+            f"{totals['throughput_rps']:.1f} в секунду, "
+            f"ошибок {totals['errors']}"
+        )
+        for name, stats in result['endpoints'].items():
+            latency = stats['latency_ms']
+            percentiles = ', '.join(
+                f'p{p} {latency[f"p{p}"]:.1f}' for p in PERCENTILES
+                if latency[f'p{p}'] is not None
+            )
+            self.stdout.write(
+                f"  {name}: {stats['requests']} "
+                f"({stats['throughput_rps']:.1f}/с), {percentiles} мс"
+                + (f", ошибок {stats['errors']}" if stats['errors'] else '')
+            )
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(
+                f"Результат сохранён в {options['output']}."
+            ))
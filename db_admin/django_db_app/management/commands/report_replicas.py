@@ -0,0 +1,80 @@
+"""Реплики для отчётов.
+
+Примеры:
+```bash
+py manage.py report_replicas refresh
+py manage.py report_replicas refresh --watch
+py manage.py report_replicas refresh reports --watch --interval 30
+py manage.py report_replicas status
+```
+
+`refresh` заменяет копии SQLite из `DATABASE_REPLICAS` свежими копиями
+основных баз (см. `replicas.py`); с `--watch` повторяет это каждые
+`REPLICA_REFRESH_INTERVAL` секунд до остановки. Реплики PostgreSQL
+обновляются потоковой репликацией и пропускаются. `status` показывает
+отставание реплик.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from ... import replicas
+
+
+class Command(BaseCommand):
+    help = 'Обновление копий SQLite и состояние реплик для отчётов.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        refresh = operations.add_parser('refresh',
+                                        help='Обновить копии SQLite.')
+        refresh.add_argument('aliases', nargs='*',
+                             help='Реплики; по умолчанию все.')
+        refresh.add_argument('--watch', action='store_true',
+                             help='Обновлять до остановки.')
+        refresh.add_argument('--interval', type=float,
+                             help='Секунды между обновлениями.')
+
+        operations.add_parser('status', help='Показать отставание реплик.')
+
+    def handle(self, *args, **options):
+        if not replicas.enabled():
+            raise CommandError('Реплики не заданы: DATABASE_REPLICAS пуст.')
+        if options['operation'] == 'status':
+            return self.status()
+
+        aliases = options['aliases'] or list(replicas.replicas().values())
+        unknown = set(aliases) - set(replicas.replicas().values())
+        if unknown:
+            raise CommandError(f"Неизвестные реплики: "
+                               f"{', '.join(sorted(unknown))}.")
+        aliases = [alias for alias in aliases
+                   if connections[alias].vendor == 'sqlite']
+        if not aliases:
+            raise CommandError('Нет реплик SQLite.')
+        interval = options['interval'] or getattr(
+            settings, 'REPLICA_REFRESH_INTERVAL', 10
+        )
+        while True:
+            for alias in aliases:
+                started = time.perf_counter()
+                replicas.refresh_replica(alias)
+                self.stdout.write(
+                    f'{alias}: {time.perf_counter() - started:.2f} s'
+                )
+            if not options['watch']:
+                return
+            time.sleep(interval)
+
+    def status(self):
+        for primary, alias in replicas.replicas().items():
+            as_of = replicas.status.as_of(alias)
+            if as_of is None:
+                self.stdout.write(f'{alias} ({primary}): недоступна')
+            else:
+                self.stdout.write(f'{alias} ({primary}): отставание '
+                                  f'{time.time() - as_of:.1f} s')
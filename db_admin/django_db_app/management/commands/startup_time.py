@@ -0,0 +1,147 @@
+"""Время от запуска процесса до первого ответа и ленивость импортов.
+
+Примеры:
+```bash
+py manage.py startup_time
+py manage.py startup_time --runs 5 --path / --path /auth/login/
+```
+
+Команда несколько раз запускает отдельный процесс с WSGI-приложением
+(`db_admin.wsgi`, сервер `wsgiref`) без прогрева и с прогревом
+(`warmup.py`) и измеряет время от запуска до первого ответа на первый из
+путей `--path`, а затем время первого запроса к каждому пути. Выводятся
+медианы по запускам.
+
+Затем проверяется, что `django.setup()` (то есть любая команда
+`manage.py` и импорт приложения до первого запроса) не загружает модули
+из `LAZY_MODULES`: представления, формы, отчёты и NumPy загружаются при
+первом разрешении маршрута или при прогреве. Если какой-то из них
+загружен, команда завершается с ошибкой.
+"""
+
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+LAZY_MODULES = ('numpy', 'django_db_app.analytics', 'django_db_app.views',
+                'django_db_app.forms', 'django_db_app.reports')
+
+SERVER = '''
+import sys
+from django.conf import settings
+settings.WARMUP_ON_STARTUP = sys.argv[2] == '1'
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+from db_admin.wsgi import application
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+make_server('127.0.0.1', int(sys.argv[1]), application,
+            handler_class=QuietHandler).serve_forever()
+'''
+
+IMPORTS = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+print(json.dumps({'setup': time.perf_counter() - started,
+                  'modules': sorted(sys.modules)}))
+'''
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _get(url, timeout=30):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+    except urllib.error.HTTPError as e:
+        # Перенаправление на вход или 4xx — тоже ответ.
+        e.read()
+
+
+class Command(BaseCommand):
+    help = ('Время от запуска процесса до первого ответа с прогревом и без '
+            'и проверка ленивых импортов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=3)
+        parser.add_argument('--path', action='append', dest='paths',
+                            help='Путь для запроса (можно несколько); '
+                                 'по умолчанию / и /auth/login/.')
+        parser.add_argument('--timeout', type=float, default=60,
+                            help='Предельное время запуска, секунды.')
+
+    def measure(self, warm, paths, timeout):
+        port = _free_port()
+        base = f'http://127.0.0.1:{port}'
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, '-c', SERVER, str(port), '1' if warm else '0'],
+            cwd=settings.BASE_DIR,
+        )
+        try:
+            while True:
+                if server.poll() is not None:
+                    raise CommandError('Сервер завершился при запуске.')
+                if time.perf_counter() - started > timeout:
+                    raise CommandError('Сервер не ответил вовремя.')
+                try:
+                    with socket.create_connection(('127.0.0.1', port),
+                                                  timeout=0.05):
+                        break
+                except OSError:
+                    time.sleep(0.01)
+            result = {'listening': time.perf_counter() - started}
+            for path in paths:
+                request_started = time.perf_counter()
+                _get(base + path)
+                result[path] = time.perf_counter() - request_started
+            result['first_response'] = (result['listening'] +
+                                        result[paths[0]])
+            return result
+        finally:
+            server.terminate()
+            server.wait()
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or ['/', '/auth/login/']
+        for warm in (False, True):
+            runs = [self.measure(warm, paths, options['timeout'])
+                    for _ in range(options['runs'])]
+            label = 'с прогревом' if warm else 'без прогрева'
+            self.stdout.write(f'{label} (медиана по {len(runs)} запускам):')
+            for key in ('listening', 'first_response', *paths):
+                median = statistics.median(run[key] for run in runs)
+                self.stdout.write(f'  {key}: {median * 1000:.1f} мс')
+
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORTS], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        self.stdout.write(f"django.setup(): {report['setup'] * 1000:.1f} мс")
+        eager = [name for name in LAZY_MODULES if name in report['modules']]
+        if eager:
+            raise CommandError(
+                f"При django.setup() загружены модули: {', '.join(eager)}."
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Ленивые модули не загружены: {', '.join(LAZY_MODULES)}."
+        ))
@@ -0,0 +1,57 @@
+"""Резервирование остатков.
+
+Примеры:
+```bash
+py manage.py stock_reservations expire
+py manage.py stock_reservations bench
+py manage.py stock_reservations bench --clients 1 8 32 --duration 10 --products 50
+```
+
+`expire` возвращает остатки резервов с истёкшим сроком (см. `stock.py`);
+сервер делает это сам при резервировании, команда нужна, если резервов
+долго не было. `bench` измеряет пропускную способность резервирования
+при одновременных клиентах и проверяет, что остатки не уходят в минус;
+он создаёт и затем удаляет синтетические изделия, поэтому запускайте его
+на копии базы.
+"""
+
+from django.core.management.base import BaseCommand
+
+from ... import stock
+from ...utils.benchmarks import bench_stock_reservations
+
+
+class Command(BaseCommand):
+    help = 'Возврат просроченных резервов и замер резервирования остатков.'
+
+    def add_arguments(self, parser):
+        operations = parser.add_subparsers(dest='operation', required=True)
+
+        operations.add_parser('expire',
+                              help='Вернуть остатки просроченных резервов.')
+
+        bench = operations.add_parser('bench',
+                                      help='Замер при одновременных '
+                                           'клиентах.')
+        bench.add_argument('--clients', type=int, nargs='+',
+                           default=[1, 8, 32])
+        bench.add_argument('--duration', type=float, default=5,
+                           help='Длительность прогона, секунды.')
+        bench.add_argument('--products', type=int, default=20,
+                           help='Число изделий, за которые идёт '
+                                'конкуренция.')
+        bench.add_argument('--amount', type=int, default=1000,
+                           help='Начальный остаток изделия.')
+        bench.add_argument('--items', type=int, default=3,
+                           help='Изделий в одном резерве.')
+
+    def handle(self, *args, **options):
+        if options['operation'] == 'expire':
+            expired = stock.expire()
+            self.stdout.write(self.style.SUCCESS(f'expired: {expired}'))
+            return
+        bench_stock_reservations(
+            clients=options['clients'], duration=options['duration'],
+            products=options['products'], amount=options['amount'],
+            items=min(options['items'], options['products']),
+        )
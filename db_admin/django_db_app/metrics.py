@@ -0,0 +1,505 @@
+"""Метрики приложения в текстовом формате Prometheus (`/metrics`).
+
+Наблюдения записываются в хранилище текущего потока, поэтому на горячем
+пути нет блокировок; при выдаче хранилища всех потоков суммируются.
+Хранилище завершившегося потока переносится в общее хранилище процесса.
+Собираются:
+
+* длительность запросов по имени маршрута `django_db_app` (гистограмма;
+  потоковые ответы — до выдачи последней порции);
+* число и длительность SQL-запросов;
+* число строк в отчётах по изделиям;
+* попадания, промахи, сбросы и вытеснения кэшей (`registry`, `rollup`,
+  `analytics`, `product_params`);
+* число строк в таблицах каталога (считается при выдаче);
+* время от запуска процесса до первого ответа и длительность прогрева
+  (`warmup.py`);
+* допуск запросов к дорогим страницам и время ожидания (`admission.py`);
+* фоновые выгрузки (`jobs.py`);
+* операции резервирования остатков и размер их пакетов (`stock.py`);
+* выбор реплики для отчётов и её отставание (`replicas.py`).
+
+Если задан `METRICS_MULTIPROCESS_DIR`, каждый процесс сохраняет свои
+накопленные значения в отдельный файл этого каталога после ответа на
+запрос (и на цикле обслуживания исполнителя выгрузок), но не чаще чем раз в
+`METRICS_FLUSH_INTERVAL` секунд, а также при завершении; `/metrics`
+сохраняет значения своего процесса и суммирует все файлы. Простаивающий
+процесс файл не обновляет — его значения не меняются. Файлы
+завершившихся процессов не удаляются, чтобы счётчики не убывали; каталог
+очищается при развёртывании.
+"""
+
+import atexit
+import json
+import math
+import os
+import threading
+import time
+import uuid
+import weakref
+from pathlib import Path
+
+from django.conf import settings
+
+from .db import estimate_row_count
+
+# Границы корзин гистограмм, секунды.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+ROW_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+STARTUP_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+BATCH_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250)
+
+
+class _Store:
+    """Накопленные значения одного потока."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        for key, value in other.counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, (buckets, total, count) in other.histograms.items():
+            _merge_histogram(self.histograms, key, buckets, total, count)
+
+
+class _ThreadMark:
+    """Метка потока: хранится только в его локальных данных и удаляется
+    при его завершении."""
+
+
+_local = threading.local()
+# Значения завершившихся потоков.
+_retired = _Store()
+_stores = [_retired]
+_stores_lock = threading.Lock()
+
+
+def _store():
+    store = getattr(_local, 'store', None)
+    if store is None:
+        store = _local.store = _Store()
+        _local.mark = mark = _ThreadMark()
+        weakref.finalize(mark, _retire, store)
+        with _stores_lock:
+            _stores.append(store)
+    return store
+
+
+def _retire(store):
+    with _stores_lock:
+        # Хранилища родителя в дочернем процессе уже не учитываются.
+        if any(known is store for known in _stores):
+            _retired.merge(store)
+            _stores.remove(store)
+
+
+def _reset_after_fork():
+    # Дочерний процесс не должен повторно отдавать наблюдения родителя.
+    global _stores, _stores_lock, _flush_lock, _process_id, _retired
+    _retired = _Store()
+    _stores = [_retired]
+    _stores_lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _local.__dict__.clear()
+    _process_id = _new_process_id()
+
+
+def _new_process_id():
+    return f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+_process_id = _new_process_id()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+METRICS = {}
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        METRICS[name] = self
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        counters = _store().counters
+        key = (self.name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        histograms = _store().histograms
+        key = (self.name, labels)
+        state = histograms.get(key)
+        if state is None:
+            # Счётчики по корзинам (последняя — +Inf), сумма, количество.
+            state = histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+
+http_request_duration = Histogram(
+    'catalog_http_request_duration_seconds',
+    'Длительность обработки запроса по имени маршрута.',
+    ('view', 'method'),
+)
+db_queries = Counter(
+    'catalog_db_queries_total',
+    'Число SQL-запросов по имени маршрута.',
+    ('view', 'alias'),
+)
+db_query_duration = Histogram(
+    'catalog_db_query_duration_seconds',
+    'Длительность SQL-запросов.',
+    ('alias',),
+    buckets=QUERY_BUCKETS,
+)
+report_rows = Histogram(
+    'catalog_report_rows',
+    'Число изделий в построенном отчёте.',
+    ('report',),
+    buckets=ROW_BUCKETS,
+)
+cache_requests = Counter(
+    'catalog_cache_requests_total',
+    'Обращения к кэшам процесса.',
+    ('cache', 'result'),
+)
+cache_invalidations = Counter(
+    'catalog_cache_invalidations_total',
+    'Сбросы кэшей процесса.',
+    ('cache',),
+)
+cache_evictions = Counter(
+    'catalog_cache_evictions_total',
+    'Записи, вытесненные из кэшей процесса по ограничению размера.',
+    ('cache',),
+)
+export_jobs = Counter(
+    'catalog_export_jobs_total',
+    'Фоновые выгрузки по виду и итогу (submitted, done, failed).',
+    ('kind', 'status'),
+)
+admission_requests = Counter(
+    'catalog_admission_requests_total',
+    'Решения о допуске запросов к дорогим страницам по классу стоимости.',
+    ('class', 'result'),
+)
+admission_released = Counter(
+    'catalog_admission_released_total',
+    'Завершённые допущенные запросы по классу стоимости.',
+    ('class',),
+)
+admission_wait = Histogram(
+    'catalog_admission_wait_seconds',
+    'Время ожидания места в очереди допуска.',
+    ('class',),
+)
+stock_operations = Counter(
+    'catalog_stock_operations_total',
+    'Операции резервирования остатков по виду и итогу (ok, rejected).',
+    ('operation', 'result'),
+)
+stock_batch_size = Histogram(
+    'catalog_stock_batch_size',
+    'Число операций резервирования в одной транзакции.',
+    buckets=BATCH_BUCKETS,
+)
+replica_reads = Counter(
+    'catalog_replica_reads_total',
+    'Выбор базы для чтения отчётов по реплике и итогу (replica, lag, '
+    'recent_write, unavailable).',
+    ('replica', 'result'),
+)
+replica_lag = Histogram(
+    'catalog_replica_lag_seconds',
+    'Отставание реплики при проверке её состояния.',
+    ('replica',),
+    buckets=STARTUP_BUCKETS,
+)
+startup_duration = Histogram(
+    'catalog_startup_seconds',
+    'Длительность прогрева и время от запуска процесса до первого ответа.',
+    ('stage',),
+    buckets=STARTUP_BUCKETS,
+)
+
+
+def process_age():
+    """Секунды с запуска процесса (Linux) или с загрузки модуля."""
+    try:
+        with open('/proc/self/stat', encoding='ascii') as stat:
+            # Поля после имени процесса; starttime — 22-е поле.
+            fields = stat.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', encoding='ascii') as uptime:
+            system_uptime = float(uptime.read().split()[0])
+        return system_uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _imported_at
+
+
+_imported_at = time.monotonic()
+
+
+def current_view():
+    return getattr(_local, 'view', '')
+
+
+def query_wrapper(execute, sql, params, many, context):
+    """Обёртка выполнения SQL (устанавливается для каждого соединения)."""
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        alias = context['connection'].alias
+        db_query_duration.observe(time.perf_counter() - started, alias)
+        db_queries.inc(current_view(), alias)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+# Сбор значений.
+
+def _local_samples():
+    counters = {}
+    histograms = {}
+    # Под блокировкой: перенос хранилища завершившегося потока не должен
+    # попасть в выборку дважды.
+    with _stores_lock:
+        for store in _stores:
+            for key, value in list(store.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, (buckets, total, count) in list(
+                    store.histograms.items()):
+                _merge_histogram(histograms, key, buckets, total, count)
+    return counters, histograms
+
+
+def _merge_histogram(histograms, key, buckets, total, count):
+    state = histograms.get(key)
+    if state is None:
+        histograms[key] = [list(buckets), total, count]
+        return
+    for i, value in enumerate(buckets):
+        state[0][i] += value
+    state[1] += total
+    state[2] += count
+
+
+def multiprocess_dir():
+    directory = getattr(settings, 'METRICS_MULTIPROCESS_DIR', None)
+    return Path(directory) if directory else None
+
+
+_flush_lock = threading.Lock()
+_flushed_at = 0.0
+
+
+def flush(force=False):
+    """Сохраняет значения процесса в каталог многопроцессного режима."""
+    global _flushed_at
+    directory = multiprocess_dir()
+    if directory is None:
+        return
+    interval = getattr(settings, 'METRICS_FLUSH_INTERVAL', 5)
+    if not force and time.monotonic() - _flushed_at < interval:
+        return
+    if not _flush_lock.acquire(blocking=force):
+        return
+    try:
+        counters, histograms = _local_samples()
+        data = {
+            'counters': [[name, list(labels), value]
+                         for (name, labels), value in counters.items()],
+            'histograms': [[name, list(labels), *state]
+                           for (name, labels), state in histograms.items()],
+        }
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'metrics-{_process_id}.json'
+        temp = path.with_suffix('.tmp')
+        with open(temp, 'w', encoding='utf-8') as output:
+            json.dump(data, output)
+        os.replace(temp, path)
+        _flushed_at = time.monotonic()
+    finally:
+        _flush_lock.release()
+
+
+atexit.register(flush, force=True)
+
+
+def collect():
+    """Суммарные значения всех потоков (и процессов)."""
+    directory = multiprocess_dir()
+    if directory is None:
+        return _local_samples()
+    flush(force=True)
+    counters = {}
+    histograms = {}
+    for path in directory.glob('metrics-*.json'):
+        try:
+            with open(path, encoding='utf-8') as source:
+                data = json.load(source)
+        except (OSError, ValueError):
+            continue
+        for name, labels, value in data['counters']:
+            key = (name, tuple(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total, count in data['histograms']:
+            _merge_histogram(histograms, (name, tuple(labels)),
+                             buckets, total, count)
+    return counters, histograms
+
+
+def table_sizes():
+    """Число строк в таблицах каталога (оценка для больших таблиц)."""
+    from django.apps import apps
+    from django.db import router
+
+    sizes = {}
+    for model in apps.get_app_config('django_db_app').get_models():
+        estimate = estimate_row_count(model, router.db_for_read(model))
+        if estimate is None or estimate < getattr(
+                settings, 'ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000):
+            estimate = model._default_manager.count()
+        sizes[model._meta.db_table] = estimate
+    return sizes
+
+
+# Текстовый формат.
+
+def _format_number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in (*zip(names, values), *extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render():
+    counters, histograms = collect()
+    lines = []
+    for metric in METRICS.values():
+        lines.append(f'# HELP {metric.name} {_escape(metric.documentation)}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        if metric.kind == 'counter':
+            for (name, labels), value in sorted(counters.items()):
+                if name == metric.name:
+                    lines.append(f'{name}{_labels(metric.labelnames, labels)} '
+                                 f'{_format_number(value)}')
+            continue
+        for (name, labels), (buckets, total, count) in sorted(
+                histograms.items()):
+            if name != metric.name:
+                continue
+            cumulative = 0
+            bounds = [*map(_format_number, metric.buckets), '+Inf']
+            for bound, value in zip(bounds, buckets):
+                cumulative += value
+                label_text = _labels(metric.labelnames, labels,
+                                     (('le', bound),))
+                lines.append(f'{name}_bucket{label_text} {cumulative}')
+            label_text = _labels(metric.labelnames, labels)
+            lines.append(f'{name}_sum{label_text} {_format_number(total)}')
+            lines.append(f'{name}_count{label_text} {count}')
+
+    lines.append('# HELP catalog_table_rows Число строк в таблице каталога.')
+    lines.append('# TYPE catalog_table_rows gauge')
+    for table, size in sorted(table_sizes().items()):
+        lines.append(f'catalog_table_rows{{table="{table}"}} {size}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """Измеряет длительность запросов к маршрутам `django_db_app`."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.responded = False
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        _local.view = ''
+        response = None
+        try:
+            response = self.get_response(request)
+            return response
+        finally:
+            view = current_view()
+            _local.view = ''
+            if response is not None and response.streaming:
+                # Потоковый ответ формируется после выхода из middleware.
+                response.streaming_content = self._stream(
+                    response.streaming_content, view, request.method, started
+                )
+            else:
+                self._finish(view, request.method, started)
+
+    def _stream(self, chunks, view, method, started):
+        chunks = iter(chunks)
+        try:
+            while True:
+                # SQL-запросы порций относятся к маршруту запроса.
+                _local.view = view
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    _local.view = ''
+                yield chunk
+        finally:
+            self._finish(view, method, started)
+
+    def _finish(self, view, method, started):
+        if view:
+            http_request_duration.observe(time.perf_counter() - started,
+                                          view, method)
+        if not self.responded:
+            self.responded = True
+            startup_duration.observe(process_age(), 'first_response')
+        flush()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is not None and match.namespace == 'django_db_app':
+            _local.view = match.url_name
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-19 02:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_db_app', '0002_initial_data'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='parametervalue',
+            index=models.Index(fields=['value_str'], name='django_db_a_value_s_1b0239_idx'),
+        ),
+    ]
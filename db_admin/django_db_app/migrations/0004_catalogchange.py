@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-19 02:25
+
+import django.db.models.functions.datetime
+from django.db import migrations, models
+
+from django_db_app.changes import create_change_triggers, drop_change_triggers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_db_app', '0003_parametervalue_value_str_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('model', models.CharField(max_length=32)),
+                ('object_id', models.BigIntegerField()),
+                ('operation', models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete'), ('compact', 'Compact')], max_length=8)),
+                ('data', models.JSONField(blank=True, null=True)),
+                ('changed_at', models.DateTimeField(db_default=django.db.models.functions.datetime.Now())),
+            ],
+            options={
+                'indexes': [models.Index(fields=['model', 'object_id', 'seq'], name='django_db_a_model_954591_idx')],
+            },
+        ),
+        migrations.RunPython(create_change_triggers, drop_change_triggers),
+    ]
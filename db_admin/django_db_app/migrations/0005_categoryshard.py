@@ -0,0 +1,20 @@
+# Generated by Django 5.2 on 2026-10-19 02:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_db_app', '0004_catalogchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryShard',
+            fields=[
+                ('category_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=64)),
+            ],
+        ),
+    ]
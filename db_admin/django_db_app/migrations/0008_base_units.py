@@ -0,0 +1,48 @@
+# Generated by Django 5.2 on 2026-10-19 03:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from django_db_app.changes import create_change_triggers, drop_change_triggers
+from django_db_app.units import fill_base_values
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_db_app', '0007_stockreservation'),
+    ]
+
+    operations = [
+        # Триггеры журнала в SQLite ссылаются на столбцы таблиц, поэтому
+        # пересоздаются после изменения столбцов. Заполнение новых столбцов
+        # выполняется без триггеров: это не изменение каталога, и
+        # потребителям журнала не передаётся.
+        migrations.RunPython(drop_change_triggers, create_change_triggers),
+        migrations.AddField(
+            model_name='enumvalue',
+            name='value_num',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='measure',
+            name='base',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='derived', to='django_db_app.measure'),
+        ),
+        migrations.AddField(
+            model_name='measure',
+            name='factor',
+            field=models.FloatField(default=1),
+        ),
+        migrations.AddField(
+            model_name='parametervalue',
+            name='value_num',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='parametervalue',
+            index=models.Index(fields=['param', 'value_num'], name='django_db_a_param_i_7c927d_idx'),
+        ),
+        migrations.RunPython(fill_base_values, migrations.RunPython.noop),
+        migrations.RunPython(create_change_triggers, drop_change_triggers),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-19 03:34
+
+from django.db import migrations, models
+
+from django_db_app.changes import create_change_triggers, drop_change_triggers
+from django_db_app.display import fill_display_values
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_db_app', '0008_base_units'),
+    ]
+
+    operations = [
+        # Триггеры журнала в SQLite ссылаются на столбцы таблиц, поэтому
+        # пересоздаются после изменения столбцов. Заполнение новых столбцов
+        # выполняется без триггеров: это не изменение каталога, и
+        # потребителям журнала не передаётся.
+        migrations.RunPython(drop_change_triggers, create_change_triggers),
+        migrations.AddField(
+            model_name='enumvalue',
+            name='display_value',
+            field=models.CharField(blank=True, editable=False, max_length=128, null=True),
+        ),
+        migrations.AddField(
+            model_name='parametervalue',
+            name='display_value',
+            field=models.CharField(blank=True, editable=False, max_length=128, null=True),
+        ),
+        migrations.RunPython(fill_display_values, migrations.RunPython.noop),
+        migrations.RunPython(create_change_triggers, drop_change_triggers),
+    ]
@@ -1,10 +1,43 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Now
 from django.core.exceptions import ValidationError
 
 
 class Measure(models.Model):
+    """Единица измерения.
+
+    Производная единица ссылается на базовую (`base`) и задаёт множитель
+    перевода в неё: значение в базовой единице = значение * `factor`
+    (мм -> м: 0.001). Единицы с общей базовой совместимы (см. `units.py`).
+    """
     name = models.CharField(max_length=64)
     name_short = models.CharField(max_length=16, unique=True)
+    base = models.ForeignKey('self',
+                             on_delete=models.RESTRICT,
+                             null=True, blank=True,
+                             related_name='derived')
+    factor = models.FloatField(default=1)
+
+    def clean(self):
+        if self.factor is None or not self.factor > 0:
+            raise ValidationError('Множитель должен быть положительным.')
+        if self.base_id is None:
+            if self.factor != 1:
+                raise ValidationError(
+                    'Множитель базовой единицы должен быть равен 1.'
+                )
+            return
+        if self.base_id == self.pk or self.base.base_id is not None:
+            raise ValidationError(
+                'Базовой может быть только единица без базовой единицы.'
+            )
+        if self.pk is not None and self.derived.exists():
+            raise ValidationError(
+                'Единица, на которую ссылаются другие, должна быть базовой.'
+            )
 
     def __str(self):
         return self.name
@@ -22,6 +55,21 @@ class Category(models.Model):
                                 on_delete=models.SET_DEFAULT,
                                 default=1)
 
+    def get_subtree_ids(self):
+        # Идентификаторы категории и всех её потомков за один запрос.
+        children = {}
+        for category_id, parent_id in Category.objects.using(
+                self._state.db).values_list('id', 'parent_id'):
+            children.setdefault(parent_id, []).append(category_id)
+        ids = [self.id]
+        seen = {self.id}
+        for category_id in ids:
+            for child_id in children.get(category_id, ()):
+                if child_id not in seen:
+                    seen.add(child_id)
+                    ids.append(child_id)
+        return ids
+
     def __str__(self):
         return self.name
 
@@ -47,6 +95,11 @@ class EnumValue(models.Model):
     value_int = models.IntegerField(null=True, blank=True)
     value_real = models.FloatField(null=True, blank=True)
     value_path = models.CharField(max_length=128, null=True, blank=True)
+    # Числовое значение в базовой единице категории (см. `units.py`).
+    value_num = models.FloatField(null=True, blank=True, editable=False)
+    # Значение строкой для вывода (см. `display.py`).
+    display_value = models.CharField(max_length=128, null=True, blank=True,
+                                     editable=False)
 
     class Meta:
         unique_together = ('category', 'code')
@@ -119,12 +172,23 @@ class ParameterValue(models.Model):
     value_int = models.IntegerField(null=True, blank=True)
     value_real = models.FloatField(null=True, blank=True)
     value_path = models.CharField(max_length=128, null=True, blank=True)
+    # Числовое значение в базовой единице (см. `units.py`).
+    value_num = models.FloatField(null=True, blank=True, editable=False)
+    # Значение строкой для вывода (см. `display.py`).
+    display_value = models.CharField(max_length=128, null=True, blank=True,
+                                     editable=False)
 
     class Meta:
         unique_together = [
             ('param', 'product'),
             ('param', 'category'),
         ]
+        indexes = [
+            # Точный поиск по строковому значению в админке.
+            models.Index(fields=['value_str']),
+            # Отбор по диапазону и сортировка числовых значений.
+            models.Index(fields=['param', 'value_num']),
+        ]
 
     def clean(self):
         # Проверка, что только одно поле
@@ -148,8 +212,7 @@ class ParameterValue(models.Model):
             )
 
     def __str__(self):
-        value = f"{self.value_str or self.value_int or self.value_real}"
-        return f"{self.param.name} - {value}"
+        return f"{self.param.name} - {self.display_value}"
 
 
 class ParameterAggregate(models.Model):
@@ -165,3 +228,155 @@ class ParameterAggregate(models.Model):
 
     def __str__(self):
         return f"{self.parent_param.name} -> {self.param.name}"
+
+
+class CatalogChange(models.Model):
+    """Запись журнала изменений каталога.
+
+    Журнал заполняется триггерами базы данных (миграция
+    `0004_catalogchange`) в той же транзакции, что и само изменение,
+    включая массовые операции и прямой SQL. `data` — строка таблицы после
+    изменения (для удаления — NULL).
+    """
+    OPERATIONS = [
+        ('create', 'Create'),
+        ('update', 'Update'),
+        ('delete', 'Delete'),
+        ('compact', 'Compact'),
+    ]
+
+    seq = models.BigAutoField(primary_key=True)
+    model = models.CharField(max_length=32)
+    object_id = models.BigIntegerField()
+    operation = models.CharField(max_length=8, choices=OPERATIONS)
+    data = models.JSONField(null=True, blank=True)
+    changed_at = models.DateTimeField(db_default=Now())
+
+    class Meta:
+        indexes = [
+            # Поиск более поздних записей того же объекта при сжатии.
+            models.Index(fields=['model', 'object_id', 'seq']),
+        ]
+
+    def __str__(self):
+        return f"{self.seq}: {self.operation} {self.model} {self.object_id}"
+
+
+class CategoryShard(models.Model):
+    """Шард поддерева категории при шардинге каталога (`sharding.py`).
+
+    Хранится только в `default`; категории-перечисления не размещаются:
+    они есть в каждом шарде.
+    """
+    category_id = models.BigIntegerField(primary_key=True)
+    shard = models.CharField(max_length=64)
+
+    def __str__(self):
+        return f"{self.category_id} -> {self.shard}"
+
+
+class ExportJob(models.Model):
+    """Фоновая выгрузка отчёта (см. `jobs.py`).
+
+    `key` — отпечаток вида, параметров, раскладки и формата; ожидающая или
+    выполняемая выгрузка с тем же ключом может быть только одна.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    ]
+    ACTIVE = (PENDING, RUNNING)
+
+    kind = models.CharField(max_length=64)
+    params = models.JSONField(default=dict, blank=True)
+    layout = models.CharField(max_length=8)
+    format = models.CharField(max_length=8)
+    key = models.CharField(max_length=64)
+    status = models.CharField(max_length=8, choices=STATUSES,
+                              default=PENDING)
+    rows = models.IntegerField(default=0)
+    total = models.IntegerField(null=True, blank=True)
+    file_name = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=128, blank=True)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                   on_delete=models.SET_NULL,
+                                   null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['key'],
+                condition=models.Q(status__in=['pending', 'running']),
+                name='export_job_active_key',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return f"{self.pk}: {self.kind}.{self.format} ({self.status})"
+
+
+class StockReservation(models.Model):
+    """Резерв остатков изделий (см. `stock.py`).
+
+    Остатки `Product.amount` уменьшаются при резервировании; отменённый
+    или просроченный резерв их возвращает, подтверждённый — нет.
+    """
+    ACTIVE = 'active'
+    COMMITTED = 'committed'
+    RELEASED = 'released'
+    EXPIRED = 'expired'
+    STATUSES = [
+        (ACTIVE, 'Действует'),
+        (COMMITTED, 'Подтверждён'),
+        (RELEASED, 'Отменён'),
+        (EXPIRED, 'Просрочен'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4,
+                          editable=False)
+    status = models.CharField(max_length=9, choices=STATUSES,
+                              default=ACTIVE)
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL,
+                                   on_delete=models.SET_NULL,
+                                   null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Поиск просроченных резервов.
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.pk} ({self.status})"
+
+
+class StockReservationItem(models.Model):
+    reservation = models.ForeignKey(StockReservation,
+                                    on_delete=models.CASCADE,
+                                    related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('reservation', 'product')
+
+    def __str__(self):
+        return f"{self.product_id} x {self.quantity}"
@@ -0,0 +1,189 @@
+"""Параллельное построение выгрузок отчётов.
+
+Разрешение значений и форматирование строк выгрузки — работа Python,
+которая в одном процессе занимает одно ядро. При `PARALLEL_REPORTS_WORKERS`
+больше единицы выгрузка не меньше `PARALLEL_REPORTS_MIN_PRODUCTS` изделий
+делится на диапазоны идентификаторов по `PARALLEL_REPORTS_CHUNK_SIZE`
+изделий. Каждый диапазон читается со своим соединением и форматируется
+(`reports.EXPORT_ROWS`) в процессе пула `ProcessPoolExecutor`, а готовые
+части выдаются потоком в порядке диапазонов, поэтому выгрузка совпадает
+с последовательной побайтно. Одновременно в работе не больше двух частей
+на процесс пула.
+
+Пул создаётся при первой выгрузке и живёт до завершения процесса; его
+процессы запускаются через `fork` (где он есть), наследуя настройки и
+загруженный Django, и не закрывают соединения родителя. Части читают те
+же базы, что выбраны блоком чтения реплик (`replicas.py`).
+"""
+
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+
+from .metrics import report_rows
+from .replicas import chosen, reading
+from .reports import (EXPORT_ROWS, EXPORT_SEPARATORS, Pivot, ReportQuery,
+                      export_frame)
+from .sharding import fan_out, merge_sorted, shards
+
+
+def workers():
+    return getattr(settings, 'PARALLEL_REPORTS_WORKERS', 0) or 0
+
+
+def applies(products, total=None):
+    """Строится ли выгрузка изделий `products` (их `total`) параллельно."""
+    if workers() < 2:
+        return False
+    if total is None:
+        total = sum(part.count() for part in fan_out(products))
+    return total >= getattr(settings, 'PARALLEL_REPORTS_MIN_PRODUCTS', 20000)
+
+
+# Процессы пула.
+
+# Соединения, унаследованные от родителя: их закрытие в дочернем процессе
+# разорвало бы соединение родителя.
+_inherited = []
+
+
+def _start_worker():
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        # Процесс запущен без fork.
+        django.setup()
+    for connection in connections.all(initialized_only=True):
+        if connection.connection is not None:
+            _inherited.append(connection.connection)
+            connection.connection = None
+
+
+def _export_part(products, layout, export_format, param_ids, empty, columns,
+                 aliases, name):
+    try:
+        with (reading(aliases=aliases) if aliases is not None
+              else nullcontext()):
+            query = ReportQuery(products, param_ids=param_ids, empty=empty,
+                                name=name)
+            source = Pivot(query, columns) if layout == 'wide' else query
+            return EXPORT_SEPARATORS[export_format].join(
+                EXPORT_ROWS[layout, export_format](source)
+            )
+    finally:
+        close_old_connections()
+
+
+class ReportPool:
+    def __init__(self):
+        self._executor = None
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        size = workers()
+        with self._lock:
+            if self._executor is None or self._size != size:
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                method = ('fork' if 'fork' in
+                          multiprocessing.get_all_start_methods()
+                          else 'spawn')
+                self._executor = ProcessPoolExecutor(
+                    max_workers=size,
+                    mp_context=multiprocessing.get_context(method),
+                    initializer=_start_worker,
+                )
+                self._size = size
+            return self._executor
+
+    def reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+pool = ReportPool()
+
+
+# Выгрузка.
+
+def split(products, chunk_size):
+    """Диапазоны `(первый pk, последний pk, число изделий)` по
+    `chunk_size` изделий всех шардов."""
+    ranges = []
+    first = last = None
+    count = 0
+    for pk in merge_sorted(
+            (part.order_by('pk').values_list('pk', flat=True).iterator()
+             for part in fan_out(products)), key=None):
+        if first is None:
+            first = pk
+        last = pk
+        count += 1
+        if count == chunk_size:
+            ranges.append((first, last, count))
+            first, count = None, 0
+    if first is not None:
+        ranges.append((first, last, count))
+    return ranges
+
+
+def iter_export(products, layout, export_format, param_ids=None, empty=None,
+                name='report', progress=None):
+    """Порции выгрузки, как `reports.iter_export`, построенные частями в
+    процессах пула; `progress` получает число выгруженных изделий."""
+    columns = None
+    if layout == 'wide':
+        columns = ReportQuery(products, param_ids=param_ids, empty=empty,
+                              name=name).columns()
+    head, tail = export_frame(layout, export_format, columns)
+    aliases = chosen(list(dict.fromkeys([DEFAULT_DB_ALIAS, *shards()])))
+    ranges = iter(split(products, getattr(
+        settings, 'PARALLEL_REPORTS_CHUNK_SIZE', 5000
+    )))
+
+    executor = pool.get()
+    pending = deque()
+
+    def submit(first, last, count):
+        pending.append((executor.submit(
+            _export_part, products.filter(pk__gte=first, pk__lte=last),
+            layout, export_format, param_ids, empty, columns, aliases, name,
+        ), count))
+
+    yield from head
+    done = 0
+    separator = ''
+    try:
+        for part in islice(ranges, 2 * workers()):
+            submit(*part)
+        while pending:
+            future, count = pending.popleft()
+            text = future.result()
+            part = next(ranges, None)
+            if part is not None:
+                submit(*part)
+            done += count
+            if progress is not None:
+                progress(done)
+            if text:
+                yield separator + text
+                separator = EXPORT_SEPARATORS[export_format]
+    except BrokenProcessPool:
+        pool.reset(executor)
+        raise
+    finally:
+        for future, _ in pending:
+            future.cancel()
+    if tail:
+        yield tail
+    report_rows.observe(done, name)
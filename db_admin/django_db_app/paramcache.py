@@ -0,0 +1,237 @@
+"""Кэш разрешённых параметров изделий.
+
+Страница параметров изделия (`ProductParamsView`) показывает собственные
+значения изделия и не переопределённые значения его категории, как отчёты
+(`reports.py`). Разрешённый список (названия, типы, коды перечислений и
+единицы измерения из реестра `registry.py`) хранится в ограниченном
+LRU-кэше процесса по идентификатору изделия: не больше
+`PRODUCT_PARAMS_CACHE_SIZE` записей, каждая не дольше
+`PRODUCT_PARAMS_CACHE_TTL` секунд. Если задан `PRODUCT_PARAMS_CACHE_ALIAS`,
+записи дополнительно хранятся в этом кэше Django и разделяются
+процессами.
+
+Сброс точечный (см. `signals.py`): изменение значения изделия сбрасывает
+это изделие, значения категории — изделия её поддерева, перенос и
+удаление изделия — само изделие. Массовые операции (`bulk.py`) сбрасывают
+изделия затронутого поддерева, изменение справочников — весь кэш.
+Запись, загруженная одновременно со сбросом, в кэш не попадает.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Q
+
+from .metrics import cache_evictions, cache_invalidations, cache_requests
+from .models import Category, Parameter, ParameterValue, Product
+from .registry import registry
+from .sharding import fan_out
+
+KEY_PREFIX = 'product-params'
+VERSION_KEY = f'{KEY_PREFIX}:version'
+
+
+class ResolvedParam:
+    """Параметр изделия с разрешённым значением.
+
+    `value` — отображаемое значение, как в отчётах (`display_value`, см.
+    `display.py`); `enum_code` задан только для перечислений.
+    """
+
+    __slots__ = ('param_id', 'name', 'name_short', 'data_type',
+                 'data_type_display', 'value', 'enum_code', 'measure',
+                 'inherited')
+
+    def __init__(self, param_id, name, name_short, data_type,
+                 data_type_display, value, enum_code, measure, inherited):
+        self.param_id = param_id
+        self.name = name
+        self.name_short = name_short
+        self.data_type = data_type
+        self.data_type_display = data_type_display
+        self.value = value
+        self.enum_code = enum_code
+        self.measure = measure
+        self.inherited = inherited
+
+    @property
+    def is_enum(self):
+        return self.enum_code is not None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+def resolve_params(product_id, category_id, using=None):
+    """Загружает разрешённые параметры изделия одним запросом из базы
+    `using` (по умолчанию — `default`)."""
+    data_types = {key: str(label) for key, label in
+                  Parameter._meta.get_field('data_type').flatchoices}
+    rows = ParameterValue.objects.db_manager(using).filter(
+        Q(product_id=product_id) | Q(category_id=category_id)
+    ).order_by('pk').values_list('product_id', 'param_id', 'value_enum_id',
+                                 'display_value')
+    # Собственные значения первыми, затем значения категории.
+    rows = sorted(rows, key=lambda row: row[0] is None)
+
+    snapshot = registry.get()
+    if any(row[1] not in snapshot.params or
+           (row[2] is not None and row[2] not in snapshot.enums)
+           for row in rows):
+        # Запись создана позже загрузки реестра.
+        snapshot = registry.refresh(snapshot)
+
+    result = []
+    own = set()
+    for owner, param_id, enum_id, value in rows:
+        inherited = owner is None
+        if inherited and param_id in own:
+            continue
+        own.add(param_id)
+        meta = snapshot.params[param_id]
+        enum_code = None
+        if enum_id is not None:
+            enum = snapshot.enums.get(enum_id)
+            enum_code = enum.code if enum else ''
+        result.append(ResolvedParam(
+            param_id, meta.name, meta.name_short, meta.data_type,
+            data_types.get(meta.data_type, meta.data_type), value,
+            enum_code, meta.measure, inherited,
+        ))
+    return result
+
+
+class ProductParamsCache:
+    def __init__(self):
+        # product_id -> (loaded_at, category_id, params) в порядке
+        # последнего обращения.
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # Увеличивается при каждом сбросе; загрузка, во время которой был
+        # сброс, не сохраняется.
+        self._epoch = 0
+
+    @property
+    def size(self):
+        return getattr(settings, 'PRODUCT_PARAMS_CACHE_SIZE', 10000)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'PRODUCT_PARAMS_CACHE_TTL', 300)
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'PRODUCT_PARAMS_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    @property
+    def active(self):
+        """Есть ли что сбрасывать: записи процесса или общий кэш."""
+        return bool(self._entries) or self.shared is not None
+
+    def get(self, product):
+        """Разрешённые параметры изделия `product` (экземпляр Product)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(product.pk)
+            if (entry is not None and entry[1] == product.category_id and
+                    now - entry[0] <= self.ttl):
+                self._entries.move_to_end(product.pk)
+                cache_requests.inc('product_params', 'hit')
+                return entry[2]
+            epoch = self._epoch
+
+        shared = self.shared
+        key = f'{KEY_PREFIX}:{product.pk}'
+        version = 0
+        if shared is not None:
+            found = shared.get_many([VERSION_KEY, key])
+            version = found.get(VERSION_KEY, 0)
+            entry = found.get(key)
+            if (entry is not None and entry[0] == version and
+                    entry[1] == product.category_id):
+                cache_requests.inc('product_params', 'shared_hit')
+                self._store(product, entry[2], now, epoch)
+                return entry[2]
+
+        cache_requests.inc('product_params', 'miss')
+        params = resolve_params(product.pk, product.category_id,
+                                product._state.db)
+        if self._store(product, params, now, epoch) and shared is not None:
+            shared.set(key, (version, product.category_id, params), self.ttl)
+        return params
+
+    def _store(self, product, params, loaded_at, epoch):
+        with self._lock:
+            if self._epoch != epoch:
+                return False
+            self._entries[product.pk] = (loaded_at, product.category_id,
+                                         params)
+            self._entries.move_to_end(product.pk)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                cache_evictions.inc('product_params')
+            return True
+
+    def evict(self, product_ids):
+        """Сбрасывает изделия."""
+        product_ids = set(product_ids) - {None}
+        if not product_ids:
+            return
+        with self._lock:
+            self._epoch += 1
+            for product_id in product_ids:
+                self._entries.pop(product_id, None)
+        cache_invalidations.inc('product_params', amount=len(product_ids))
+        shared = self.shared
+        if shared is not None:
+            shared.delete_many([f'{KEY_PREFIX}:{product_id}'
+                                for product_id in product_ids])
+
+    def evict_categories(self, category_ids):
+        """Сбрасывает изделия поддеревьев категорий."""
+        category_ids = set(category_ids) - {None}
+        if not category_ids:
+            return
+        for categories in fan_out(Category.objects.filter(
+                pk__in=list(category_ids))):
+            for category in categories:
+                category_ids.update(category.get_subtree_ids())
+        with self._lock:
+            self._epoch += 1
+            product_ids = [product_id for product_id, entry
+                           in self._entries.items()
+                           if entry[1] in category_ids]
+        if self.shared is not None:
+            product_ids = [
+                product_id
+                for products in fan_out(Product.objects.filter(
+                    category_id__in=category_ids
+                ))
+                for product_id in products.values_list('pk', flat=True)
+            ]
+        self.evict(product_ids)
+
+    def invalidate(self):
+        cache_invalidations.inc('product_params')
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+        shared = self.shared
+        if shared is not None:
+            # Записи общего кэша с прежней версией не используются.
+            shared.add(VERSION_KEY, 0, None)
+            try:
+                shared.incr(VERSION_KEY)
+            except ValueError:
+                shared.set(VERSION_KEY, 1, None)
+
+
+param_cache = ProductParamsCache()
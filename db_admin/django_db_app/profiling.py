@@ -0,0 +1,288 @@
+"""Профилирование отдельных запросов по требованию.
+
+Сотрудник (`is_staff`) включает профилирование параметром `?_profile=1`
+или заголовком `X-Profile: 1`. Запрос выполняется под семплирующим
+профилировщиком (отдельный поток снимает стек обработчика каждые
+`PROFILING_INTERVAL` секунд) и `tracemalloc`. Результат сохраняется в
+`PROFILING_DIR`:
+
+* `<id>.folded` — стеки в формате collapsed stacks (flamegraph.pl,
+  speedscope); корневой кадр — фаза: `query`, `build` или `render`;
+* `<id>.json` — сводка: длительность, время по фазам, число и время
+  SQL-запросов, пиковая память и основные места выделения памяти.
+
+Фазы отмечаются контекстным менеджером `phase()`; SQL-запросы отмечаются
+автоматически, кадры шаблонизатора внутри `build` относятся к `render`.
+Потоковые ответы (выгрузки, таблицы отчётов) при профилировании
+формируются целиком до возврата ответа, в фазе `render`.
+Одновременно профилируется один запрос, не чаще `PROFILING_RATE_LIMIT`
+раз в минуту на процесс.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, deque
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+_local = threading.local()
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Отмечает фазу обработки запроса; без профилирования ничего не делает."""
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    previous = profile.phase
+    profile.phase = name
+    try:
+        yield
+    finally:
+        profile.phase = previous
+
+
+def _path_prefixes():
+    prefixes = {str(settings.BASE_DIR)}
+    prefixes.update(path for path in sys.path
+                    if path and 'site-packages' in path)
+    return sorted(prefixes, key=len, reverse=True)
+
+
+def _describe_frame(code, prefixes):
+    """Подпись кадра и признак того, что это код шаблонизатора."""
+    filename = code.co_filename
+    render = (f'django{os.sep}template' in filename or
+              'jinja2' in filename)
+    for prefix in prefixes:
+        if filename.startswith(prefix):
+            filename = filename[len(prefix):].lstrip(os.sep)
+            break
+    return f'{code.co_name} ({filename}:{code.co_firstlineno})', render
+
+
+class Profile:
+    def __init__(self, request, interval):
+        self.id = f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        self.request = request
+        self.interval = interval
+        self.phase = 'build'
+        self.samples = Counter()
+        self.query_count = 0
+        self.query_time = 0.0
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True,
+                                         name=f'profile-{self.id}')
+
+    def _sample(self):
+        prefixes = _path_prefixes()
+        frames = {}
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            render = False
+            while frame is not None:
+                code = frame.f_code
+                described = frames.get(code)
+                if described is None:
+                    described = frames[code] = _describe_frame(code,
+                                                               prefixes)
+                stack.append(described[0])
+                render = render or described[1]
+                frame = frame.f_back
+            current = self.phase
+            if current == 'build' and render:
+                current = 'render'
+            stack.append(current)
+            self.samples[tuple(reversed(stack))] += 1
+
+    def _query_wrapper(self, execute, sql, params, many, context):
+        previous = self.phase
+        self.phase = 'query'
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += time.perf_counter() - started
+            self.query_count += 1
+            self.phase = previous
+
+    @contextlib.contextmanager
+    def run(self):
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        _local.profile = self
+        self.started = time.time()
+        started = time.perf_counter()
+        self._sampler.start()
+        try:
+            with contextlib.ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(
+                        connection.execute_wrapper(self._query_wrapper)
+                    )
+                yield self
+        finally:
+            self.duration = time.perf_counter() - started
+            self._stop.set()
+            self._sampler.join()
+            _local.profile = None
+            _, self.memory_peak = tracemalloc.get_traced_memory()
+            self.allocations = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            )).statistics('lineno')[:20]
+            if not tracing:
+                tracemalloc.stop()
+
+    def summary(self, response):
+        phases = Counter()
+        for stack, count in self.samples.items():
+            phases[stack[0]] += count
+        user = getattr(self.request, 'user', None)
+        return {
+            'id': self.id,
+            'method': self.request.method,
+            'path': self.request.get_full_path(),
+            'url_name': getattr(self.request.resolver_match, 'view_name',
+                                None),
+            'user': getattr(user, 'username', None),
+            'status': response.status_code,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(self.started)),
+            'duration_ms': round(self.duration * 1000, 1),
+            'interval_ms': round(self.interval * 1000, 3),
+            'samples': sum(phases.values()),
+            'phases_ms': {
+                name: round(count * self.interval * 1000, 1)
+                for name, count in phases.most_common()
+            },
+            'queries': {
+                'count': self.query_count,
+                'duration_ms': round(self.query_time * 1000, 1),
+            },
+            'memory': {
+                'peak_bytes': self.memory_peak,
+                'top': [
+                    {
+                        'site': f'{stat.traceback[0].filename}:'
+                                f'{stat.traceback[0].lineno}',
+                        'size_bytes': stat.size,
+                        'count': stat.count,
+                    }
+                    for stat in self.allocations
+                ],
+            },
+        }
+
+    def save(self, directory, response):
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / f'{self.id}.folded', 'w',
+                  encoding='utf-8') as folded:
+            for stack, count in self.samples.most_common():
+                folded.write(f'{";".join(stack)} {count}\n')
+        with open(directory / f'{self.id}.json', 'w',
+                  encoding='utf-8') as summary:
+            json.dump(self.summary(response), summary, ensure_ascii=False,
+                      indent=2)
+
+
+def profile_dir():
+    return Path(getattr(settings, 'PROFILING_DIR',
+                        settings.BASE_DIR / 'profiles'))
+
+
+def list_profiles(limit=None):
+    """Сводки сохранённых профилей, от новых к старым."""
+    profiles = []
+    for path in sorted(profile_dir().glob('*.json'), reverse=True):
+        if limit is not None and len(profiles) >= limit:
+            break
+        try:
+            with open(path, encoding='utf-8') as summary:
+                profiles.append(json.load(summary))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def _prune(directory, keep):
+    summaries = sorted(directory.glob('*.json'), reverse=True)
+    for path in summaries[keep:]:
+        for stale in (path, path.with_suffix('.folded')):
+            with contextlib.suppress(OSError):
+                stale.unlink()
+
+
+class ProfilingMiddleware:
+    """Профилирует запрос сотрудника по `?_profile=1` / `X-Profile: 1`."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._lock = threading.Lock()
+        self._recent = deque()
+
+    def _wants_profile(self, request):
+        if not getattr(settings, 'PROFILING_ENABLED', False):
+            return False
+        if (request.GET.get('_profile') != '1' and
+                request.headers.get('X-Profile') != '1'):
+            return False
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_staff)
+
+    def _acquire(self):
+        # Не более одного профиля одновременно и PROFILING_RATE_LIMIT
+        # профилей за последние 60 секунд.
+        if not self._lock.acquire(blocking=False):
+            return False
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 60:
+            self._recent.popleft()
+        if len(self._recent) >= getattr(settings, 'PROFILING_RATE_LIMIT', 6):
+            self._lock.release()
+            return False
+        self._recent.append(now)
+        return True
+
+    def __call__(self, request):
+        if not self._wants_profile(request) or not self._acquire():
+            return self.get_response(request)
+        try:
+            profile = Profile(request,
+                              getattr(settings, 'PROFILING_INTERVAL', 0.005))
+            with profile.run():
+                response = self.get_response(request)
+                if hasattr(response, 'render') and callable(response.render):
+                    with phase('render'):
+                        response.render()
+                if response.streaming:
+                    # Потоковый ответ формируется после выхода из
+                    # middleware; под профилировщиком он формируется здесь
+                    # целиком, чтобы вывод попал в профиль.
+                    with phase('render'):
+                        content = b''.join(response.streaming_content)
+                    response.streaming_content = [content]
+            directory = profile_dir()
+            profile.save(directory, response)
+            _prune(directory, getattr(settings, 'PROFILING_KEEP', 50))
+            response['X-Profile-Id'] = profile.id
+            return response
+        finally:
+            self._lock.release()
@@ -0,0 +1,164 @@
+"""Реестр метаданных каталога.
+
+Справочники `Measure`, `Parameter`, `EnumValue` и `ParameterAggregate`
+малы и меняются редко, поэтому загружаются один раз на процесс и
+разделяются всеми запросами. Отчёты читают из базы только идентификаторы
+и отображаемые значения (`display.py`), а названия, типы, единицы
+измерения и коды перечислений берут из реестра.
+
+Реестр сбрасывается сигналами сохранения и удаления этих моделей
+(см. `signals.py`). Изменения, сделанные другими процессами, подхватываются
+не позже чем через `METADATA_REGISTRY_TTL` секунд.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+from .metrics import cache_invalidations, cache_requests
+from .models import EnumValue, Measure, Parameter, ParameterAggregate
+
+VALUE_FIELDS = ('value_str', 'value_int', 'value_real', 'value_path')
+
+
+def format_value(data_type, value_str, value_int, value_real, value_path,
+                 enum_display=None, empty=None):
+    """Приводит значение параметра к строке по его типу данных."""
+    if data_type == 'int':
+        value = value_int
+    elif data_type == 'real':
+        value = value_real
+    elif data_type == 'str':
+        value = value_str
+    elif data_type == 'path':
+        value = value_path
+    elif data_type == 'enum':
+        value = enum_display
+    else:
+        value = None
+    if value is None:
+        return empty
+    return value if isinstance(value, str) else str(value)
+
+
+def enum_display(values):
+    """Приводит значение элемента перечисления (поля `VALUE_FIELDS`) к
+    строке: первое заполненное поле."""
+    value = next((v for v in values if v is not None), None)
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+class ParamMeta:
+    __slots__ = ('id', 'name', 'name_short', 'data_type', 'measure',
+                 'measure_id', 'enum_id')
+
+    def __init__(self, id, name, name_short, data_type, measure,
+                 measure_id=None, enum_id=None):
+        self.id = id
+        self.name = name
+        self.name_short = name_short
+        self.data_type = data_type
+        self.measure = measure
+        self.measure_id = measure_id
+        self.enum_id = enum_id
+
+
+class EnumMeta:
+    __slots__ = ('id', 'category_id', 'code', 'priority', 'values')
+
+    def __init__(self, id, category_id, code, priority, values):
+        self.id = id
+        self.category_id = category_id
+        self.code = code
+        self.priority = priority
+        self.values = values
+
+
+class Snapshot:
+    """Неизменяемый снимок справочников на момент загрузки."""
+
+    def __init__(self):
+        self.loaded_at = time.monotonic()
+
+        self.measures = {}
+        # Множители перевода единиц в базовые (см. `units.py`).
+        self.factors = {}
+        for measure_id, name_short, factor in Measure.objects.values_list(
+                'id', 'name_short', 'factor'):
+            self.measures[measure_id] = name_short
+            self.factors[measure_id] = factor
+        self.params = {
+            row[0]: ParamMeta(row[0], row[1], row[2], row[3],
+                              self.measures.get(row[4], ''), row[4], row[5])
+            for row in Parameter.objects.values_list(
+                'id', 'name', 'name_short', 'data_type',
+                'measure_id', 'enum_id'
+            )
+        }
+        self.params_by_name = {
+            meta.name_short: meta for meta in self.params.values()
+        }
+
+        # Значения перечислений упорядочены по приоритету внутри категории.
+        self.enums = {}
+        self.enums_by_category = {}
+        for row in EnumValue.objects.order_by(
+                'category_id', 'priority', 'code'
+        ).values_list('id', 'category_id', 'code', 'priority',
+                      *VALUE_FIELDS):
+            meta = EnumMeta(row[0], row[1], row[2], row[3], row[4:])
+            self.enums[meta.id] = meta
+            self.enums_by_category.setdefault(meta.category_id, []).append(
+                meta
+            )
+
+        self.aggregates = {}
+        for parent_id, param_id in ParameterAggregate.objects.order_by(
+                'pk'
+        ).values_list('parent_param_id', 'param_id'):
+            self.aggregates.setdefault(parent_id, []).append(param_id)
+
+
+class MetadataRegistry:
+    def __init__(self):
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'METADATA_REGISTRY_TTL', 300)
+
+    def get(self):
+        """Возвращает актуальный снимок, загружая его при необходимости."""
+        snapshot = self._snapshot
+        if (snapshot is None or
+                time.monotonic() - snapshot.loaded_at > self.ttl):
+            with self._lock:
+                snapshot = self._snapshot
+                if (snapshot is None or
+                        time.monotonic() - snapshot.loaded_at > self.ttl):
+                    cache_requests.inc('registry', 'miss')
+                    snapshot = self._snapshot = Snapshot()
+                    return snapshot
+        cache_requests.inc('registry', 'hit')
+        return snapshot
+
+    def refresh(self, stale):
+        """Перезагружает снимок, если он всё ещё равен `stale`.
+
+        Используется, когда в данных встретился идентификатор, которого
+        нет в снимке (запись создана другим процессом).
+        """
+        with self._lock:
+            if self._snapshot is stale or self._snapshot is None:
+                cache_requests.inc('registry', 'refresh')
+                self._snapshot = Snapshot()
+            return self._snapshot
+
+    def invalidate(self):
+        cache_invalidations.inc('registry')
+        self._snapshot = None
+
+
+registry = MetadataRegistry()
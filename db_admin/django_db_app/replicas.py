@@ -0,0 +1,334 @@
+"""Чтение отчётов из реплик.
+
+Реплики задаются словарём `DATABASE_REPLICAS` «основная база -> реплика»
+(псевдонимы из `DATABASES`), например `{'default': 'reports'}`; без него
+модуль ни на что не влияет. Реплика — копия файла SQLite, которую
+обновляет `manage.py report_replicas refresh --watch` (`refresh_replica`),
+или реплика PostgreSQL с потоковой репликацией.
+
+Страницы отчётов, выгрузки и API чтения (`ReplicaReadMixin`, фоновые
+выгрузки в `jobs.py`) выполняются в блоке `reading()`. В нём
+`ReplicaRouter` направляет запросы без объекта-подсказки к данным
+каталога (`REPLICA_MODELS`) в реплику, а `sharding.fan_out()` — запросы
+к шардам в их реплики. Справочники, которые кэшируются в процессе
+(`registry.py`), сеансы и пользователи по-прежнему читаются из основной
+базы, запись всегда идёт в неё.
+
+Реплика используется, только если её состояние `as_of` (момент, по
+который в ней есть все изменения) отстаёт от текущего времени не больше
+чем на `REPLICA_MAX_LAG` секунд и не раньше последней записи клиента:
+`ReplicaMiddleware` отмечает в сеансе время запроса, выполнившего запись
+в основную базу, а выгрузка — время постановки в очередь. Иначе блок
+читает основную базу. Состояние реплики проверяется не чаще раза в
+`REPLICA_CHECK_INTERVAL` секунд; база выбирается один раз на блок, так что
+отчёт целиком читается из одной базы.
+
+Метрики: `catalog_replica_reads_total` по реплике и итогу (`replica`;
+`lag`, `recent_write`, `unavailable` — чтение из основной базы) и
+отставание `catalog_replica_lag_seconds`.
+"""
+
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from contextlib import ExitStack, closing, contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from .metrics import replica_lag, replica_reads
+
+# Данные каталога, которые читаются из реплики. Справочники (`Measure`,
+# `Parameter`, `EnumValue`) загружает реестр метаданных, общий для всех
+# запросов процесса, поэтому они читаются из основной базы.
+REPLICA_MODELS = ('category', 'product', 'parametervalue',
+                  'parameteraggregate')
+
+# Таблица состояния в копии SQLite.
+STATE_TABLE = 'replica_state'
+
+# Отметка последней записи клиента в сеансе.
+SESSION_KEY = '_catalog_written_at'
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLAC')
+
+
+def replicas():
+    """Словарь `основная база -> реплика`."""
+    return dict(getattr(settings, 'DATABASE_REPLICAS', None) or {})
+
+
+def enabled():
+    return bool(replicas())
+
+
+def primary_of(alias):
+    for primary, replica in replicas().items():
+        if replica == alias:
+            return primary
+    raise ValueError(f'{alias} не является репликой.')
+
+
+# Состояние реплик.
+
+def _as_of(alias):
+    """Момент (секунды эпохи), по который в реплике есть все изменения."""
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'SELECT as_of FROM {STATE_TABLE}')
+            row = cursor.fetchone()
+            return row[0] if row else None
+        if connection.vendor == 'postgresql':
+            # На простаивающей основной базе время последней применённой
+            # транзакции не растёт, и реплика считается отстающей.
+            cursor.execute(
+                'SELECT CASE WHEN pg_is_in_recovery() '
+                'THEN EXTRACT(EPOCH FROM pg_last_xact_replay_timestamp()) '
+                'ELSE EXTRACT(EPOCH FROM now()) END'
+            )
+            value = cursor.fetchone()[0]
+            return float(value) if value is not None else None
+    raise NotImplementedError(
+        f'Состояние реплики не поддерживается для {connection.vendor}.'
+    )
+
+
+class ReplicaStatus:
+    """Кэш состояния реплик процесса."""
+
+    def __init__(self):
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        return getattr(settings, 'REPLICA_CHECK_INTERVAL', 2)
+
+    def as_of(self, alias):
+        """`as_of` реплики или None, если она недоступна."""
+        with self._lock:
+            checked_at, position = self._positions.get(alias, (None, None))
+            if (checked_at is not None and
+                    time.monotonic() - checked_at <= self.interval):
+                return position
+        try:
+            position = _as_of(alias)
+        except DatabaseError:
+            position = None
+        finally:
+            if connections[alias].vendor == 'sqlite':
+                # Копия заменяется новым файлом; открытое соединение
+                # продолжало бы читать прежний.
+                connections[alias].close()
+        if position is not None:
+            replica_lag.observe(max(time.time() - position, 0), alias)
+        with self._lock:
+            self._positions[alias] = (time.monotonic(), position)
+        return position
+
+    def invalidate(self):
+        with self._lock:
+            self._positions.clear()
+
+
+status = ReplicaStatus()
+
+
+# Выбор базы.
+
+class _Reads:
+    """Блок чтения: минимальное требуемое `as_of` и выбранные базы."""
+
+    def __init__(self, since, aliases=None):
+        self.since = since
+        self.aliases = dict(aliases or {})
+        self.used = set()
+
+    def alias_for(self, primary):
+        alias = self.aliases.get(primary)
+        if alias is None:
+            alias = self.aliases[primary] = self._choose(primary)
+        if alias != primary:
+            self.used.add(alias)
+        return alias
+
+    def _choose(self, primary):
+        replica = replicas().get(primary)
+        if replica is None:
+            return primary
+        position = status.as_of(replica)
+        max_lag = getattr(settings, 'REPLICA_MAX_LAG', 30)
+        if position is None:
+            result = 'unavailable'
+        elif time.time() - position > max_lag:
+            result = 'lag'
+        elif self.since is not None and position < self.since:
+            result = 'recent_write'
+        else:
+            result = 'replica'
+        replica_reads.inc(replica, result)
+        return replica if result == 'replica' else primary
+
+
+_reads = contextvars.ContextVar('catalog_replica_reads', default=None)
+
+
+@contextmanager
+def reading(since=None, aliases=None):
+    """Блок чтения отчёта: данные каталога читаются из реплики, в которой
+    есть изменения по момент `since` (секунды эпохи), если такая есть.
+
+    `aliases` — базы, уже выбранные блоком другого процесса (`chosen()`).
+    """
+    if not enabled():
+        yield
+        return
+    reads = _Reads(since, aliases)
+    token = _reads.set(reads)
+    try:
+        yield
+    finally:
+        _reads.reset(token)
+        for alias in reads.used:
+            if connections[alias].vendor == 'sqlite':
+                connections[alias].close()
+
+
+def read_alias(alias):
+    """База для чтения данных каталога из `alias` в текущем блоке."""
+    reads = _reads.get()
+    return alias if reads is None else reads.alias_for(alias)
+
+
+def chosen(aliases):
+    """Базы для чтения из `aliases` в текущем блоке или None вне блока."""
+    reads = _reads.get()
+    if reads is None:
+        return None
+    return {alias: reads.alias_for(alias) for alias in aliases}
+
+
+def _bind(reads, chunks):
+    # Потоковый ответ формируется после выхода из представления, поэтому
+    # каждая порция читается в том же блоке.
+    chunks = iter(chunks)
+    while True:
+        token = _reads.set(reads)
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            _reads.reset(token)
+        yield chunk
+
+
+class ReplicaReadMixin:
+    """Представление читает данные каталога из реплики (см. описание
+    модуля)."""
+
+    def dispatch(self, request, *args, **kwargs):
+        session = getattr(request, 'session', None)
+        since = session.get(SESSION_KEY) if session is not None else None
+        with reading(since):
+            response = super().dispatch(request, *args, **kwargs)
+            if not getattr(response, 'is_rendered', True):
+                response.render()
+            reads = _reads.get()
+        if reads is not None and response.streaming:
+            response.streaming_content = _bind(reads,
+                                               response.streaming_content)
+        return response
+
+
+class ReplicaRouter:
+    """Маршрутизатор чтения из реплик; ставится перед `ShardRouter`."""
+
+    def db_for_read(self, model, **hints):
+        if (_reads.get() is None or
+                model._meta.app_label != 'django_db_app' or
+                model._meta.model_name not in REPLICA_MODELS or
+                hints.get('instance') is not None):
+            return None
+        alias = read_alias(DEFAULT_DB_ALIAS)
+        return alias if alias != DEFAULT_DB_ALIAS else None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Объект из реплики связывается с объектами её основной базы.
+        primaries = {replica: primary
+                     for primary, replica in replicas().items()}
+        db1, db2 = (primaries.get(obj._state.db, obj._state.db)
+                    for obj in (obj1, obj2))
+        if db1 == db2 and obj1._state.db != obj2._state.db:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Реплика — копия основной базы.
+        return False if db in replicas().values() else None
+
+
+class ReplicaMiddleware:
+    """Отмечает в сеансе время запросов, выполнивших запись в основную
+    базу, чтобы следующие отчёты клиента видели эти изменения."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not enabled():
+            return self.get_response(request)
+        written = []
+
+        def watch(execute, sql, params, many, context):
+            if not written and sql.lstrip()[:6].upper() in WRITE_STATEMENTS:
+                written.append(True)
+            return execute(sql, params, many, context)
+
+        readonly = set(replicas().values())
+        with ExitStack() as stack:
+            for alias in connections:
+                if alias not in readonly:
+                    stack.enter_context(
+                        connections[alias].execute_wrapper(watch)
+                    )
+            response = self.get_response(request)
+        if written and hasattr(request, 'session'):
+            request.session[SESSION_KEY] = time.time()
+        return response
+
+
+# Обновление копий SQLite (команда `report_replicas`).
+
+def refresh_replica(alias):
+    """Заменяет копию SQLite `alias` свежей копией основной базы через
+    резервное копирование SQLite; возвращает её `as_of`."""
+    primary = connections[primary_of(alias)]
+    replica = connections[alias]
+    if primary.vendor != 'sqlite' or replica.vendor != 'sqlite':
+        raise NotImplementedError('Обновляются только копии SQLite.')
+    target = Path(replica.settings_dict['NAME'])
+    partial = target.with_name(target.name + '.part')
+    partial.unlink(missing_ok=True)
+    # Копия согласована на момент начала чтения, который не раньше `as_of`.
+    as_of = time.time()
+    with closing(sqlite3.connect(primary.settings_dict['NAME'])) as source, \
+            closing(sqlite3.connect(partial)) as copy:
+        source.backup(copy)
+        # Копия читается без журнала WAL основной базы.
+        copy.execute('PRAGMA journal_mode = DELETE')
+        copy.execute(f'DROP TABLE IF EXISTS {STATE_TABLE}')
+        copy.execute(f'CREATE TABLE {STATE_TABLE} (as_of REAL NOT NULL)')
+        copy.execute(f'INSERT INTO {STATE_TABLE} (as_of) VALUES (?)',
+                     (as_of,))
+        copy.commit()
+    os.replace(partial, target)
+    status.invalidate()
+    return as_of
@@ -0,0 +1,403 @@
+"""Отчёты «изделия и их параметры».
+
+Отчёт хранится компактно: на каждое изделие приходится один заголовок
+`ProductRow` со списком пар `(param_id, value)`, а метаданные параметров
+(`ParamMeta`) берутся из реестра (`registry.py`) и разделяются всеми
+строками.
+Шаблоны и выгрузки читают отчёт через `ReportRow` — лёгкое представление
+пары (изделие, параметр) с теми же именами полей, что были у словарей.
+
+Широкий вид (`Pivot`) строит одну строку на изделие со столбцами-параметрами.
+Оба вида читают изделия потоком через `ReportQuery` и выгружаются в CSV
+и JSON порциями, не собирая весь отчёт в памяти. Строки выгрузки
+(`EXPORT_ROWS`) форматируются отдельно от её начала и конца
+(`export_frame`), поэтому большие выгрузки можно строить частями в
+нескольких процессах (`parallel.py`).
+"""
+
+import csv
+import json
+from operator import attrgetter
+
+from .metrics import report_rows
+from .models import ParameterValue
+from .registry import registry
+from .sharding import fan_out, merge_sorted
+
+
+class ProductRow:
+    __slots__ = ('category_id', 'category', 'product_id', 'product',
+                 'amount', 'measure', 'price', 'params')
+
+    def __init__(self, category_id, category, product_id, product,
+                 amount, measure, price):
+        self.category_id = category_id
+        self.category = category
+        self.product_id = product_id
+        self.product = product
+        self.amount = amount
+        self.measure = measure
+        self.price = price
+        self.params = []
+
+
+class ReportRow:
+    """Строка отчёта (изделие, параметр) без копирования данных."""
+
+    __slots__ = ('header', 'meta', 'param_value')
+
+    def __init__(self, header, meta, param_value):
+        self.header = header
+        self.meta = meta
+        self.param_value = param_value
+
+    category_id = property(lambda self: self.header.category_id)
+    category = property(lambda self: self.header.category)
+    product_id = property(lambda self: self.header.product_id)
+    product = property(lambda self: self.header.product)
+    amount = property(lambda self: self.header.amount)
+    measure = property(lambda self: self.header.measure)
+    price = property(lambda self: self.header.price)
+    param_id = property(lambda self: self.meta.id)
+    param_name = property(lambda self: self.meta.name_short)
+    param_type = property(lambda self: self.meta.data_type)
+    param_measure = property(lambda self: self.meta.measure)
+
+    def as_dict(self):
+        return {
+            'category_id': self.category_id,
+            'category': self.category,
+            'product_id': self.product_id,
+            'product': self.product,
+            'amount': self.amount,
+            'measure': self.measure,
+            'price': self.price,
+            'param_id': self.param_id,
+            'param_name': self.param_name,
+            'param_type': self.param_type,
+            'param_value': self.param_value,
+            'param_measure': self.param_measure,
+        }
+
+
+class Report:
+    def __init__(self, products, params):
+        self.products = products  # Список ProductRow.
+        self.params = params      # param_id -> ParamMeta.
+
+    def __iter__(self):
+        params = self.params
+        for header in self.products:
+            for param_id, value in header.params:
+                yield ReportRow(header, params[param_id], value)
+
+    def __bool__(self):
+        return any(header.params for header in self.products)
+
+
+class ReportQuery:
+    """Источник строк отчёта по изделиям из `products` (QuerySet).
+
+    Параметры категорий загружаются при создании, метаданные параметров
+    берутся из реестра, значения — из `display_value` (`display.py`);
+    изделия и их собственные значения читаются потоком порциями по
+    `chunk_size` при каждой итерации.
+
+    Параметры изделия идут первыми, за ними — параметры его категории,
+    не переопределённые на уровне изделия. `param_ids` ограничивает отчёт
+    заданными параметрами, `empty` подставляется вместо пустых значений.
+    `name` — имя отчёта в метриках (`catalog_report_rows`).
+    """
+
+    value_columns = ('param_id', 'display_value')
+
+    def __init__(self, products, param_ids=None, empty=None,
+                 chunk_size=2000, name='report'):
+        self.products = products.order_by('pk')
+        self.name = name
+        self.param_ids = param_ids
+        self.empty = empty
+        self.chunk_size = chunk_size
+
+        # При шардинге (`sharding.py`) каждый шард читается отдельно, а
+        # изделия сливаются по возрастанию pk.
+        self.parts = []
+        category_values = []
+        for part in fan_out(self.products):
+            values = ParameterValue.objects.using(part.db)
+            product_values = values.filter(product__in=part)
+            part_category_values = values.filter(
+                category__in=part.values('category_id')
+            )
+            if param_ids is not None:
+                product_values = product_values.filter(
+                    param_id__in=param_ids
+                )
+                part_category_values = part_category_values.filter(
+                    param_id__in=param_ids
+                )
+            self.parts.append((part, product_values))
+            category_values.append(part_category_values)
+
+        self.snapshot = registry.get()
+        self.params = self.snapshot.params
+        self.strings = {}
+        self.deleted = set()
+
+        # Унаследованные пары разрешаются один раз на категорию
+        # и разделяются всеми её изделиями.
+        self.inherited = {}
+        for values in category_values:
+            for row in values.order_by('pk').values_list(
+                    'category_id', *self.value_columns):
+                pair = self.resolve(row[1:])
+                if pair is not None:
+                    self.inherited.setdefault(row[0], []).append(pair)
+
+    def resolve(self, row):
+        """Пара `(param_id, value)` или None для удалённого параметра."""
+        param_id, value = row
+        if param_id in self.deleted:
+            return None
+        if param_id not in self.params:
+            # Запись создана позже загрузки реестра.
+            self.snapshot = registry.refresh(self.snapshot)
+            self.params = self.snapshot.params
+            if param_id not in self.params:
+                # Значение прочитано из реплики (`replicas.py`) до
+                # удаления параметра.
+                self.deleted.add(param_id)
+                return None
+        if value is None:
+            value = self.empty
+        if value is not None:
+            value = self.strings.setdefault(value, value)
+        return param_id, value
+
+    def columns(self):
+        """Столбцы широкого отчёта: заданные параметры в исходном порядке
+        или объединение параметров изделий, упорядоченное по имени."""
+        params = self.snapshot.params
+        if self.param_ids is not None:
+            return [params[param_id] for param_id in self.param_ids
+                    if param_id in params]
+        used = set()
+        for _, product_values in self.parts:
+            used.update(product_values.order_by().values_list(
+                'param_id', flat=True
+            ).distinct())
+        for values in self.inherited.values():
+            used.update(param_id for param_id, _ in values)
+        return sorted((params[param_id] for param_id in used
+                       if param_id in params),
+                      key=lambda meta: (meta.name, meta.id))
+
+    def __iter__(self):
+        rows = 0
+        for header in merge_sorted(
+                (self.iter_part(*part) for part in self.parts),
+                key=attrgetter('product_id')):
+            rows += 1
+            yield header
+        report_rows.observe(rows, self.name)
+
+    def iter_part(self, products, product_values):
+        strings = self.strings
+        inherited = self.inherited
+
+        # Значения изделий читаются потоком в порядке product_id
+        # и сливаются с упорядоченным списком изделий.
+        own_values = product_values.order_by(
+            'product_id', 'pk'
+        ).values_list(
+            'product_id', *self.value_columns
+        ).iterator(chunk_size=self.chunk_size)
+        pending = next(own_values, None)
+
+        for (product_id, name, amount, price, category_id,
+             category_name, measure) in products.values_list(
+                'id', 'name', 'amount', 'price', 'category_id',
+                'category__name', 'category__measure__name_short'
+        ).iterator(chunk_size=self.chunk_size):
+            measure = measure or ''
+            header = ProductRow(
+                category_id, strings.setdefault(category_name, category_name),
+                product_id, name, amount,
+                strings.setdefault(measure, measure), price
+            )
+            own = header.params
+            while pending is not None and pending[0] <= product_id:
+                if pending[0] == product_id:
+                    pair = self.resolve(pending[1:])
+                    if pair is not None:
+                        own.append(pair)
+                pending = next(own_values, None)
+            overridden = {param_id for param_id, _ in own}
+            for pair in inherited.get(category_id, ()):
+                if pair[0] not in overridden:
+                    own.append(pair)
+            yield header
+
+
+class Pivot:
+    """Широкий отчёт: одна строка на изделие, параметры — столбцы.
+
+    Строки строятся потоком из `ReportQuery`; каждая ячейка заполняется
+    по заранее вычисленному номеру столбца. Готовые столбцы `columns`
+    передаются, когда отчёт строится частями (`parallel.py`).
+    """
+
+    def __init__(self, query, columns=None):
+        self.query = query
+        self.columns = query.columns() if columns is None else columns
+
+    def __iter__(self):
+        index = {meta.id: i for i, meta in enumerate(self.columns)}
+        blank = [self.query.empty] * len(self.columns)
+        for header in self.query:
+            if not header.params:
+                continue
+            cells = blank.copy()
+            for param_id, value in header.params:
+                # Параметр, созданный после чтения столбцов, не выводится.
+                column = index.get(param_id)
+                if column is not None:
+                    cells[column] = value
+            yield header, cells
+
+
+def build_report(products, param_ids=None, empty=None, name='report'):
+    """Строит компактный отчёт по изделиям (см. `ReportQuery`)."""
+    query = ReportQuery(products, param_ids=param_ids, empty=empty,
+                        name=name)
+    return Report(list(query), query.params)
+
+
+def build_pivot(products, param_ids=None, empty='', name='report'):
+    """Строит широкий отчёт по изделиям (см. `ReportQuery`)."""
+    return Pivot(ReportQuery(products, param_ids=param_ids, empty=empty,
+                             name=name))
+
+
+# Выгрузки.
+
+HEADER_FIELDS = ('category_id', 'category', 'product_id', 'product',
+                 'amount', 'measure', 'price')
+ROW_FIELDS = HEADER_FIELDS + ('param_id', 'param_name', 'param_type',
+                              'param_value', 'param_measure')
+
+
+class _Echo:
+    """Псевдо-файл для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+def _export_value(value):
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+def csv_line(values):
+    return csv.writer(_Echo()).writerow(values)
+
+
+def rows_csv(query):
+    """Строки CSV высокого отчёта без заголовка."""
+    writer = csv.writer(_Echo())
+    for header in query:
+        for param_id, value in header.params:
+            row = ReportRow(header, query.params[param_id], value)
+            yield writer.writerow(getattr(row, field) for field in ROW_FIELDS)
+
+
+def rows_json(query):
+    """Объекты JSON высокого отчёта без разделителей."""
+    for header in query:
+        for param_id, value in header.params:
+            row = ReportRow(header, query.params[param_id], value)
+            yield json.dumps(
+                {field: _export_value(getattr(row, field))
+                 for field in ROW_FIELDS},
+                ensure_ascii=False
+            )
+
+
+def pivot_rows_csv(pivot):
+    """Строки CSV широкого отчёта без заголовка."""
+    writer = csv.writer(_Echo())
+    for header, cells in pivot:
+        yield writer.writerow(
+            [getattr(header, field) for field in HEADER_FIELDS] + cells
+        )
+
+
+def pivot_rows_json(pivot):
+    """Объекты JSON строк широкого отчёта без разделителей."""
+    for header, cells in pivot:
+        row = {field: _export_value(getattr(header, field))
+               for field in HEADER_FIELDS}
+        row['values'] = cells
+        yield json.dumps(row, ensure_ascii=False)
+
+
+# (раскладка, формат) -> строки выгрузки.
+EXPORT_ROWS = {
+    ('tall', 'csv'): rows_csv,
+    ('tall', 'json'): rows_json,
+    ('wide', 'csv'): pivot_rows_csv,
+    ('wide', 'json'): pivot_rows_json,
+}
+
+# Разделитель строк выгрузки по формату.
+EXPORT_SEPARATORS = {'csv': '', 'json': ','}
+
+
+def export_frame(layout, export_format, columns=None):
+    """Начало (список порций) и конец выгрузки; `columns` — столбцы
+    широкого отчёта."""
+    if export_format == 'csv':
+        names = ROW_FIELDS if layout == 'tall' else HEADER_FIELDS + tuple(
+            meta.name_short for meta in columns
+        )
+        return [csv_line(names)], ''
+    if layout == 'tall':
+        return ['['], ']'
+    columns = [
+        {'id': meta.id, 'name': meta.name, 'name_short': meta.name_short,
+         'data_type': meta.data_type, 'measure': meta.measure}
+        for meta in columns
+    ]
+    return ['{"columns":' + json.dumps(columns, ensure_ascii=False),
+            ',"rows":['], ']}'
+
+
+def iter_export(source, layout, export_format):
+    """Порции выгрузки отчёта `source` (`ReportQuery` или `Pivot`)."""
+    head, tail = export_frame(layout, export_format,
+                              getattr(source, 'columns', None))
+    yield from head
+    separator = ''
+    for row in EXPORT_ROWS[layout, export_format](source):
+        yield separator + row
+        separator = EXPORT_SEPARATORS[export_format]
+    if tail:
+        yield tail
+
+
+def iter_rows_csv(query):
+    return iter_export(query, 'tall', 'csv')
+
+
+def iter_pivot_csv(pivot):
+    return iter_export(pivot, 'wide', 'csv')
+
+
+def iter_rows_json(query):
+    return iter_export(query, 'tall', 'json')
+
+
+def iter_pivot_json(pivot):
+    return iter_export(pivot, 'wide', 'json')
@@ -0,0 +1,156 @@
+"""Сводные показатели по поддеревьям категорий.
+
+Для каждой категории считаются количество изделий, суммарный остаток
+(`Product.amount`) и стоимость остатка (`amount * price`) по всему
+поддереву. Суммы по категориям получаются одним GROUP BY-запросом и
+поднимаются к корням за один проход снизу вверх.
+
+Построенная сводка хранится в процессе. Изменение изделия (остаток, цена
+или категория) применяется к ней как разность вдоль пути к корню, без
+пересчёта всего дерева (см. `signals.py`); изменение самих категорий
+сбрасывает сводку. Изменения из других процессов подхватываются не позже
+чем через `CATEGORY_ROLLUP_TTL` секунд.
+"""
+
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, DecimalField, F, Sum
+
+from .metrics import cache_invalidations, cache_requests
+from .models import Category, Product
+from .sharding import fan_out
+
+CENTS = Decimal('0.01')
+
+
+class Totals:
+    __slots__ = ('products', 'amount', 'stock_value')
+
+    def __init__(self, products=0, amount=0, stock_value=Decimal(0)):
+        self.products = products
+        self.amount = amount
+        self.stock_value = stock_value
+
+    def as_dict(self):
+        return {
+            'products': self.products,
+            'amount': self.amount,
+            'stock_value': self.stock_value.quantize(CENTS),
+        }
+
+
+class CategoryRollup:
+    def __init__(self):
+        self.built_at = time.monotonic()
+        # При шардинге (`sharding.py`) суммы собираются со всех шардов;
+        # категории-перечисления повторяются в каждом шарде.
+        self.parents = {}
+        for categories in fan_out(Category.objects.all()):
+            for category_id, parent_id in categories.values_list(
+                    'id', 'parent_id'):
+                # Родитель перечисления задан только в `default`.
+                self.parents.setdefault(category_id, parent_id)
+        self.totals = {category_id: Totals() for category_id in self.parents}
+
+        for products in fan_out(Product.objects.all()):
+            own = products.order_by().values('category_id').annotate(
+                total_products=Count('id'),
+                total_amount=Sum('amount'),
+                total_value=Sum(F('amount') * F('price'),
+                                output_field=DecimalField(max_digits=20,
+                                                          decimal_places=2)),
+            ).values_list('category_id', 'total_products', 'total_amount',
+                          'total_value')
+            for category_id, products, amount, stock_value in own:
+                totals = self.totals[category_id]
+                totals.products += products
+                totals.amount += amount or 0
+                totals.stock_value += Decimal(stock_value or 0)
+
+        # Порядок обхода в ширину от корней; в обратном порядке каждая
+        # категория обрабатывается раньше своего родителя.
+        children = {}
+        for category_id, parent_id in self.parents.items():
+            children.setdefault(parent_id, []).append(category_id)
+        order = list(children.get(None, ()))
+        for category_id in order:
+            order.extend(children.get(category_id, ()))
+        for category_id in reversed(order):
+            parent_id = self.parents[category_id]
+            if parent_id is not None:
+                self._add(self.totals[parent_id],
+                          self.totals[category_id], 1)
+
+    @staticmethod
+    def _add(target, source, sign):
+        target.products += sign * source.products
+        target.amount += sign * source.amount
+        target.stock_value += sign * source.stock_value
+
+    def get(self, category_id):
+        return self.totals.get(category_id) or Totals()
+
+    def apply(self, category_id, products, amount, stock_value):
+        """Добавляет разность к категории и всем её предкам."""
+        delta = Totals(products, amount, stock_value)
+        seen = set()
+        while category_id is not None and category_id not in seen:
+            seen.add(category_id)
+            totals = self.totals.setdefault(category_id, Totals())
+            self._add(totals, delta, 1)
+            category_id = self.parents.get(category_id)
+
+
+class RollupCache:
+    def __init__(self):
+        self._rollup = None
+        self._lock = threading.RLock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CATEGORY_ROLLUP_TTL', 300)
+
+    def get(self):
+        with self._lock:
+            rollup = self._rollup
+            if (rollup is None or
+                    time.monotonic() - rollup.built_at > self.ttl):
+                cache_requests.inc('rollup', 'miss')
+                rollup = self._rollup = CategoryRollup()
+            else:
+                cache_requests.inc('rollup', 'hit')
+            return rollup
+
+    def product_changed(self, old, new, changed_at):
+        """Применяет изменение изделия.
+
+        `old` и `new` — кортежи `(category_id, amount, price)` до и после
+        изменения (цена — Decimal); `None` для созданного или удалённого
+        изделия. Сводка, построенная после `changed_at`, могла уже учесть
+        изменение, поэтому она сбрасывается.
+        """
+        with self._lock:
+            rollup = self._rollup
+            if rollup is None:
+                return
+            if rollup.built_at >= changed_at:
+                cache_invalidations.inc('rollup')
+                self._rollup = None
+                return
+            if old is not None:
+                category_id, amount, price = old
+                rollup.apply(category_id, -1, -amount, -amount * price)
+            if new is not None:
+                category_id, amount, price = new
+                rollup.apply(category_id, 1, amount, amount * price)
+
+    def invalidate(self):
+        cache_invalidations.inc('rollup')
+        with self._lock:
+            self._rollup = None
+
+
+rollups = RollupCache()
@@ -0,0 +1,384 @@
+"""Шардинг каталога по категориям верхнего уровня.
+
+Включается списком `CATALOG_SHARDS` псевдонимов из `DATABASES`, первым
+идёт `default`; при меньше чем двух базах шардинг выключен и
+`ShardRouter` ни на что не влияет.
+
+Поддерево каждой категории верхнего уровня (не перечисления) вместе с
+изделиями и значениями параметров хранится в одной базе-шарде.
+Размещение категорий записано в `CategoryShard` в `default` и
+кэшируется в процессе (`directory`) не дольше
+`CATALOG_SHARD_DIRECTORY_TTL` секунд. Новая категория верхнего уровня
+попадает в шард с наименьшим числом категорий, вложенная — в шард
+родителя. Справочники (`Measure`, `Parameter`, `EnumValue`,
+`ParameterAggregate` и категории-перечисления) записываются в `default`
+и копируются во все шарды с теми же идентификаторами (см. `signals.py`);
+массовые операции над справочниками сигналы обходят, после них
+выполняется `catalog_shards sync`.
+
+`ShardRouter` выбирает базу по объекту-подсказке: для загруженного
+объекта — его базу, для нового — базу категории, изделия или владельца
+значения; поэтому объекты каталога создаются через `save()`, а не
+`objects.create()`. Запросы без подсказки (`Product.objects.filter(...)`)
+идут в `default`; чтение из всех шардов — `fan_out()`, как в отчётах
+(`reports.py`), сводке (`rollup.py`), аналитике (`analytics.py`), отборе
+по диапазону значений и классификаторе. Записи в разные шарды — разные
+файлы SQLite с независимыми блокировками, поэтому выполняются
+параллельно.
+
+Чтобы идентификаторы не пересекались, счётчики AUTOINCREMENT таблиц
+шарда `i` начинаются с `i * ID_SPAN` (`catalog_shards init`). Поддерево
+переносится между шардами командой `catalog_shards move`; поддеревья с
+категориями-перечислениями остаются в `default`, а копии перечислений в
+шардах хранятся без родителя, если его в шарде нет.
+
+Журнал изменений (`changes.py`), проверка целостности и
+страницы, не перечисленные выше, читают только `default`.
+"""
+
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count
+
+from .models import (Category, CategoryShard, EnumValue, Measure, Parameter,
+                     ParameterAggregate, ParameterValue, Product)
+from .replicas import read_alias
+
+ID_SPAN = 2 ** 40
+
+SHARDED_MODELS = ('category', 'product', 'parametervalue')
+REPLICATED_MODELS = (Measure, Category, Parameter, EnumValue,
+                     ParameterAggregate)
+
+
+def shards():
+    return list(getattr(settings, 'CATALOG_SHARDS', ()) or ())
+
+
+def enabled():
+    return len(shards()) > 1
+
+
+def fan_out(queryset):
+    """Запрос для каждого шарда; без шардинга или для запроса с явно
+    заданной базой — сам запрос. В блоке чтения отчёта шард читается из
+    своей реплики (`replicas.py`)."""
+    # `_db` задан только явным `using()`.
+    if not enabled() or queryset._db is not None:
+        return [queryset]
+    return [queryset.using(read_alias(alias)) for alias in shards()]
+
+
+def merge_sorted(iterables, key):
+    """Сливает упорядоченные по `key` последовательности шардов."""
+    iterables = list(iterables)
+    if len(iterables) == 1:
+        return iter(iterables[0])
+    return heapq.merge(*iterables, key=key)
+
+
+def is_replicated(instance):
+    if isinstance(instance, Category):
+        return instance.is_enum
+    return isinstance(instance, REPLICATED_MODELS)
+
+
+# Размещение категорий.
+
+class ShardDirectory:
+    def __init__(self):
+        self._placement = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CATALOG_SHARD_DIRECTORY_TTL', 60)
+
+    def get(self, refresh=False):
+        """Словарь `category_id -> shard`."""
+        with self._lock:
+            if (refresh or self._placement is None or
+                    time.monotonic() - self._loaded_at > self.ttl):
+                self._placement = dict(
+                    CategoryShard.objects.using(DEFAULT_DB_ALIAS).values_list(
+                        'category_id', 'shard'
+                    )
+                )
+                self._loaded_at = time.monotonic()
+            return self._placement
+
+    def shard_of(self, category_id):
+        placement = self.get()
+        if category_id not in placement:
+            # Категория создана в другом процессе.
+            placement = self.get(refresh=True)
+        return placement.get(category_id, DEFAULT_DB_ALIAS)
+
+    def new_root_shard(self):
+        counts = dict(CategoryShard.objects.using(DEFAULT_DB_ALIAS).order_by(
+        ).values('shard').annotate(total=Count('pk')).values_list(
+            'shard', 'total'
+        ))
+        return min(shards(), key=lambda alias: counts.get(alias, 0))
+
+    def place(self, category_ids, shard):
+        CategoryShard.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+            [CategoryShard(category_id=category_id, shard=shard)
+             for category_id in category_ids],
+            update_conflicts=True, unique_fields=['category_id'],
+            update_fields=['shard'],
+        )
+        self.invalidate()
+
+    def remove(self, category_id, shard):
+        CategoryShard.objects.using(DEFAULT_DB_ALIAS).filter(
+            category_id=category_id, shard=shard
+        ).delete()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._placement = None
+
+
+directory = ShardDirectory()
+
+
+def find_product(product_id):
+    """Шард изделия; сначала проверяется шард по диапазону идентификатора."""
+    aliases = shards()
+    home = product_id // ID_SPAN
+    if home < len(aliases):
+        aliases.insert(0, aliases.pop(home))
+    for alias in aliases:
+        if Product.objects.using(alias).filter(pk=product_id).exists():
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+def shard_for(instance):
+    """База объекта каталога или None для прочих моделей."""
+    if is_replicated(instance):
+        return DEFAULT_DB_ALIAS
+    if not instance._state.adding and instance._state.db is not None:
+        return instance._state.db
+    # `_state.db` нового объекта мог задать Django по первому
+    # присвоенному внешнему ключу, поэтому база вычисляется заново.
+    if isinstance(instance, Category):
+        if instance.parent_id is None:
+            return directory.new_root_shard()
+        return directory.shard_of(instance.parent_id)
+    if isinstance(instance, Product):
+        return directory.shard_of(instance.category_id)
+    if isinstance(instance, ParameterValue):
+        if instance.category_id is not None:
+            return directory.shard_of(instance.category_id)
+        if ParameterValue.product.is_cached(instance):
+            return shard_for(instance.product)
+        if instance.product_id is not None:
+            return find_product(instance.product_id)
+    return None
+
+
+class ShardRouter:
+    """Маршрутизатор баз каталога (см. описание модуля)."""
+
+    def _route(self, model, hints):
+        if not enabled() or model._meta.app_label != 'django_db_app':
+            return None
+        if model._meta.model_name not in SHARDED_MODELS:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        return shard_for(instance) if instance is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not enabled():
+            return None
+        # Справочники есть в каждом шарде с теми же идентификаторами.
+        if is_replicated(obj1) or is_replicated(obj2):
+            return True
+        return obj1._state.db == obj2._state.db
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in shards():
+            return None
+        # В шардах — только таблицы каталога, без размещения категорий.
+        return app_label == 'django_db_app' and model_name != 'categoryshard'
+
+
+# Обслуживание шардов (команда `catalog_shards`).
+
+def init_shard(alias):
+    """Сдвигает счётчики идентификаторов шарда в его диапазон."""
+    index = shards().index(alias)
+    connection = connections[alias]
+    if connection.vendor != 'sqlite':
+        raise NotImplementedError(
+            f'Диапазоны идентификаторов не поддерживаются для '
+            f'{connection.vendor}.'
+        )
+    start = index * ID_SPAN
+    with transaction.atomic(using=alias), connection.cursor() as cursor:
+        for model in (Category, Product, ParameterValue):
+            table = model._meta.db_table
+            cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = %s',
+                           [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) '
+                               'VALUES (%s, %s)', [table, start])
+            elif row[0] < start:
+                cursor.execute('UPDATE sqlite_sequence SET seq = %s '
+                               'WHERE name = %s', [start, table])
+
+
+def copy_rows(queryset, alias, batch_size=1000, update=True):
+    """Копирует строки запроса в базу `alias` с теми же идентификаторами;
+    при `update` существующие строки обновляются."""
+    model = queryset.model
+    options = {}
+    if update:
+        options = {
+            'update_conflicts': True,
+            'unique_fields': ['pk'],
+            'update_fields': [field.name for field
+                              in model._meta.local_concrete_fields
+                              if not field.primary_key],
+        }
+    copied = 0
+    batch = []
+    for obj in queryset.order_by('pk').iterator(chunk_size=batch_size):
+        batch.append(obj)
+        if len(batch) == batch_size:
+            model.objects.using(alias).bulk_create(batch, **options)
+            copied += len(batch)
+            batch = []
+    if batch:
+        model.objects.using(alias).bulk_create(batch, **options)
+        copied += len(batch)
+    return copied
+
+
+def detach_enums(alias):
+    """Отвязывает категории-перечисления шарда от родителей, которых в нём
+    нет: в шардах перечисления нужны только как цели внешних ключей."""
+    categories = Category.objects.using(alias)
+    return categories.filter(is_enum=True, parent__isnull=False).exclude(
+        parent_id__in=categories.values('pk')
+    ).update(parent=None)
+
+
+def replicate(model, pk):
+    """Копирует справочную запись из `default` во все шарды или удаляет её
+    из шардов, если в `default` её нет."""
+    source = model.objects.using(DEFAULT_DB_ALIAS).filter(pk=pk)
+    exists = source.exists()
+    for alias in shards()[1:]:
+        with transaction.atomic(using=alias):
+            if not exists:
+                model.objects.using(alias).filter(pk=pk).delete()
+                continue
+            copy_rows(source, alias)
+            if model is Category:
+                detach_enums(alias)
+
+
+def sync_shard(alias):
+    """Копирует справочники из `default` в шард и удаляет из шарда
+    поддеревья, размещённые в других шардах."""
+    result = {}
+    with transaction.atomic(using=alias):
+        for model in (Measure, Category, Parameter, EnumValue,
+                      ParameterAggregate):
+            source = model.objects.using(DEFAULT_DB_ALIAS)
+            if model is Category:
+                source = source.filter(is_enum=True)
+            ids = set(source.values_list('pk', flat=True))
+            target = model.objects.using(alias)
+            if model is Category:
+                target = target.filter(is_enum=True)
+            stale = [pk for pk in target.values_list('pk', flat=True)
+                     if pk not in ids]
+            target.filter(pk__in=stale).delete()
+            result[model._meta.model_name] = copy_rows(source, alias)
+        detach_enums(alias)
+
+        placement = directory.get(refresh=True)
+        misplaced = [
+            pk for pk in Category.objects.using(alias).filter(
+                is_enum=False
+            ).values_list('pk', flat=True)
+            if placement.get(pk, DEFAULT_DB_ALIAS) != alias
+        ]
+        result['misplaced'] = delete_categories(alias, misplaced)
+    return result
+
+
+def delete_categories(alias, category_ids):
+    """Удаляет категории с изделиями и значениями из базы `alias`."""
+    categories = Category.objects.using(alias).filter(pk__in=category_ids)
+    products = Product.objects.using(alias).filter(
+        category_id__in=category_ids
+    )
+    with transaction.atomic(using=alias):
+        ParameterValue.objects.using(alias).filter(
+            product__in=products
+        ).delete()
+        ParameterValue.objects.using(alias).filter(
+            category_id__in=category_ids
+        ).delete()
+        products.delete()
+        deleted, _ = categories.delete()
+    return deleted
+
+
+def move_subtree(root_id, target, batch_size=1000):
+    """Переносит поддерево категории верхнего уровня в шард `target`.
+
+    Поддерево копируется в `target`, размещение переключается, затем
+    поддерево удаляется из исходного шарда. Повторный запуск после сбоя
+    продолжает перенос; записи в поддерево на время переноса следует
+    остановить.
+    """
+    source = directory.shard_of(root_id)
+    root = Category.objects.using(source).get(pk=root_id)
+    if root.parent_id is not None or root.is_enum:
+        raise ValueError('Переносится только категория верхнего уровня.')
+    ids = root.get_subtree_ids()
+    if Category.objects.using(source).filter(pk__in=ids, is_enum=True).exists():
+        # Перечисления хранятся в `default` и не переносятся.
+        raise ValueError('Поддерево содержит категории-перечисления и не '
+                         'переносится.')
+    if source == target:
+        directory.place(ids, target)
+        return {'categories': 0, 'products': 0, 'values': 0}
+
+    products = Product.objects.using(source).filter(category_id__in=ids)
+    values = ParameterValue.objects.using(source).filter(
+        product__in=products
+    ) | ParameterValue.objects.using(source).filter(category_id__in=ids)
+
+    # Остатки прерванного переноса в целевом шарде.
+    delete_categories(target, ids)
+    with transaction.atomic(using=target):
+        counts = {
+            'categories': copy_rows(Category.objects.using(source).filter(
+                pk__in=ids
+            ), target, batch_size, update=False),
+            'products': copy_rows(products, target, batch_size, update=False),
+            'values': copy_rows(values, target, batch_size, update=False),
+        }
+    directory.place(ids, target)
+    delete_categories(source, ids)
+    return counts
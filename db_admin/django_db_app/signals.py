@@ -0,0 +1,332 @@
+import sys
+import time
+from decimal import Decimal
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from . import display, sharding, units
+from .metrics import install_query_wrapper
+from .models import (Category, EnumValue, Measure, Parameter,
+                     ParameterAggregate, ParameterValue, Product)
+from .paramcache import param_cache
+from .registry import registry
+from .rollup import rollups
+
+
+def _analytics():
+    # Матрица аналитики строится только по запросу: пока модуль (и NumPy)
+    # не загружен, применять изменения не к чему.
+    module = sys.modules.get(f'{__package__}.analytics')
+    return module.analytics if module is not None else None
+
+
+def apply_analytics(method, *args):
+    analytics = _analytics()
+    if analytics is not None:
+        getattr(analytics, method)(*args)
+
+
+def invalidate_analytics():
+    apply_analytics('invalidate')
+
+
+def invalidate_metadata(sender, **kwargs):
+    # Сбрасываем сразу и ещё раз после фиксации транзакции, чтобы
+    # параллельный запрос не закэшировал незафиксированное состояние.
+    registry.invalidate()
+    transaction.on_commit(registry.invalidate)
+    transaction.on_commit(invalidate_analytics)
+    transaction.on_commit(param_cache.invalidate)
+
+
+for model in (Measure, Parameter, EnumValue, ParameterAggregate):
+    post_save.connect(invalidate_metadata, sender=model,
+                      dispatch_uid=f'invalidate_metadata_{model.__name__}')
+    post_delete.connect(invalidate_metadata, sender=model,
+                        dispatch_uid=f'invalidate_metadata_{model.__name__}')
+
+
+# Сводка по поддеревьям категорий.
+
+def _stock_state(category_id, amount, price):
+    return category_id, amount, Decimal(str(price))
+
+
+def remember_product_state(sender, instance, using, **kwargs):
+    # Состояние до изменения читается из базы: в экземпляре уже новые данные.
+    # При шардинге — из шарда, в который идёт запись.
+    old = None
+    if instance.pk is not None:
+        row = Product.objects.using(using).filter(
+            pk=instance.pk
+        ).values_list('category_id', 'amount', 'price').first()
+        if row is not None:
+            old = _stock_state(*row)
+    instance._rollup_state = old
+
+
+def apply_product_save(sender, instance, using, **kwargs):
+    old = getattr(instance, '_rollup_state', None)
+    new = _stock_state(instance.category_id, instance.amount, instance.price)
+    if old != new:
+        changed_at = time.monotonic()
+        transaction.on_commit(
+            lambda: rollups.product_changed(old, new, changed_at),
+            using=using,
+        )
+    # Новое или перенесённое изделие меняет строки матрицы аналитики.
+    if old is None or old[0] != new[0]:
+        transaction.on_commit(invalidate_analytics, using=using)
+        # Перенесённое изделие наследует значения другой категории.
+        transaction.on_commit(lambda: param_cache.evict([instance.pk]),
+                              using=using)
+    elif old[1] != new[1]:
+        transaction.on_commit(
+            lambda: apply_analytics('amount_changed', instance.pk, new[1]),
+            using=using,
+        )
+
+
+def apply_product_delete(sender, instance, using, **kwargs):
+    old = _stock_state(instance.category_id, instance.amount, instance.price)
+    changed_at = time.monotonic()
+    transaction.on_commit(
+        lambda: rollups.product_changed(old, None, changed_at), using=using
+    )
+    transaction.on_commit(invalidate_analytics, using=using)
+    product_id = instance.pk
+    transaction.on_commit(lambda: param_cache.evict([product_id]),
+                          using=using)
+
+
+def invalidate_rollups(sender, using, **kwargs):
+    transaction.on_commit(rollups.invalidate, using=using)
+    transaction.on_commit(invalidate_analytics, using=using)
+
+
+pre_save.connect(remember_product_state, sender=Product,
+                 dispatch_uid='rollup_remember_product_state')
+post_save.connect(apply_product_save, sender=Product,
+                  dispatch_uid='rollup_apply_product_save')
+post_delete.connect(apply_product_delete, sender=Product,
+                    dispatch_uid='rollup_apply_product_delete')
+post_save.connect(invalidate_rollups, sender=Category,
+                  dispatch_uid='rollup_invalidate_category_save')
+post_delete.connect(invalidate_rollups, sender=Category,
+                    dispatch_uid='rollup_invalidate_category_delete')
+
+
+# Матрица числовых параметров (см. `analytics.py`) и кэш параметров
+# изделий (см. `paramcache.py`).
+
+def _value_state(value):
+    return (value.product_id, value.category_id, value.param_id,
+            value.value_num)
+
+
+def evict_value_owners(*states):
+    """Сбрасывает кэш параметров для владельцев значений `states`."""
+    states = [state for state in states if state is not None]
+    param_cache.evict(state[0] for state in states)
+    param_cache.evict_categories(state[1] for state in states)
+
+
+def remember_value_state(sender, instance, using, **kwargs):
+    old = None
+    if instance.pk is not None and (_analytics() is not None or
+                                    param_cache.active):
+        old = ParameterValue.objects.using(using).filter(
+            pk=instance.pk
+        ).values_list(
+            'product_id', 'category_id', 'param_id', 'value_num'
+        ).first()
+    instance._analytics_state = old
+
+
+def apply_value_save(sender, instance, using, **kwargs):
+    old = getattr(instance, '_analytics_state', None)
+    new = _value_state(instance)
+    if old != new:
+        transaction.on_commit(
+            lambda: apply_analytics('value_changed', old, new), using=using
+        )
+    # Строковые значения и пути в состоянии не учитываются, поэтому
+    # сброс не зависит от сравнения.
+    transaction.on_commit(lambda: evict_value_owners(old, new), using=using)
+
+
+def apply_value_delete(sender, instance, using, **kwargs):
+    old = _value_state(instance)
+    transaction.on_commit(
+        lambda: apply_analytics('value_changed', old, None), using=using
+    )
+    transaction.on_commit(lambda: evict_value_owners(old), using=using)
+
+
+pre_save.connect(remember_value_state, sender=ParameterValue,
+                 dispatch_uid='analytics_remember_value_state')
+post_save.connect(apply_value_save, sender=ParameterValue,
+                  dispatch_uid='analytics_apply_value_save')
+post_delete.connect(apply_value_delete, sender=ParameterValue,
+                    dispatch_uid='analytics_apply_value_delete')
+
+
+# Числовые значения в базовых единицах (см. `units.py`).
+
+# Поля, от которых зависят `value_num` значений и элементов перечислений.
+UNIT_FIELDS = {
+    Measure: ('factor',),
+    Parameter: ('data_type', 'measure_id'),
+    Category: ('is_enum', 'measure_id'),
+    EnumValue: ('category_id', 'value_num'),
+}
+
+
+def fill_value_num(sender, instance, using, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is EnumValue:
+        instance.value_num = units.enum_value_num(instance, using)
+    else:
+        instance.value_num = units.param_value_num(
+            instance.param_id, instance.value_int, instance.value_real,
+            instance.value_enum_id, using
+        )
+
+
+def remember_unit_state(sender, instance, using, raw=False, **kwargs):
+    old = None
+    if not raw and instance.pk is not None:
+        old = sender.objects.using(using).filter(pk=instance.pk).values_list(
+            *UNIT_FIELDS[sender]
+        ).first()
+    instance._unit_state = old
+
+
+def refresh_units(sender, instance, created, raw=False, **kwargs):
+    # У новой строки зависимых значений нет.
+    old = getattr(instance, '_unit_state', None)
+    if raw or created or old is None:
+        return
+    if old == tuple(getattr(instance, name) for name in UNIT_FIELDS[sender]):
+        return
+    if sender is Measure:
+        units.refresh_measure(instance.pk)
+    elif sender is Parameter:
+        units.refresh(param_ids=[instance.pk], enum_category_ids=[])
+    elif sender is Category:
+        if instance.is_enum or old[0]:
+            units.refresh(param_ids=[], enum_category_ids=[instance.pk])
+    else:
+        units.refresh(param_ids=[], enum_category_ids=[instance.category_id])
+
+
+for model in (EnumValue, ParameterValue):
+    pre_save.connect(fill_value_num, sender=model,
+                     dispatch_uid=f'units_fill_value_num_{model.__name__}')
+for model in UNIT_FIELDS:
+    pre_save.connect(
+        remember_unit_state, sender=model,
+        dispatch_uid=f'units_remember_state_{model.__name__}'
+    )
+    post_save.connect(refresh_units, sender=model,
+                      dispatch_uid=f'units_refresh_{model.__name__}')
+
+
+# Отображаемые значения (см. `display.py`).
+
+# Поля, от которых зависят `display_value` значений.
+DISPLAY_FIELDS = {
+    Parameter: ('data_type',),
+    EnumValue: ('display_value',),
+}
+
+
+def fill_display_value(sender, instance, using, raw=False, **kwargs):
+    if raw:
+        return
+    if sender is EnumValue:
+        instance.display_value = display.enum_display_value(instance)
+    else:
+        instance.display_value = display.param_display_value(
+            instance.param_id, instance.value_str, instance.value_int,
+            instance.value_real, instance.value_path, instance.value_enum_id,
+            using
+        )
+
+
+def remember_display_state(sender, instance, using, raw=False, **kwargs):
+    old = None
+    if not raw and instance.pk is not None:
+        old = sender.objects.using(using).filter(pk=instance.pk).values_list(
+            *DISPLAY_FIELDS[sender]
+        ).first()
+    instance._display_state = old
+
+
+def refresh_display(sender, instance, created, raw=False, **kwargs):
+    old = getattr(instance, '_display_state', None)
+    if raw or created or old is None:
+        return
+    if old == tuple(getattr(instance, name)
+                    for name in DISPLAY_FIELDS[sender]):
+        return
+    if sender is Parameter:
+        display.refresh(param_ids=[instance.pk], enum_ids=[])
+    else:
+        display.refresh(param_ids=[], enum_ids=[instance.pk])
+
+
+for model in (EnumValue, ParameterValue):
+    pre_save.connect(
+        fill_display_value, sender=model,
+        dispatch_uid=f'display_fill_value_{model.__name__}'
+    )
+for model in DISPLAY_FIELDS:
+    pre_save.connect(
+        remember_display_state, sender=model,
+        dispatch_uid=f'display_remember_state_{model.__name__}'
+    )
+    post_save.connect(refresh_display, sender=model,
+                      dispatch_uid=f'display_refresh_{model.__name__}')
+
+
+# Шардинг каталога (см. `sharding.py`).
+
+def replicate_reference(sender, instance, using, **kwargs):
+    # Справочники пишутся в `default` и копируются в шарды после фиксации.
+    if (sharding.enabled() and using == DEFAULT_DB_ALIAS and
+            sharding.is_replicated(instance)):
+        pk = instance.pk
+        transaction.on_commit(lambda: sharding.replicate(sender, pk),
+                              using=using)
+
+
+def place_category(sender, instance, created, using, **kwargs):
+    if created and not instance.is_enum and sharding.enabled():
+        sharding.directory.place([instance.pk], using)
+
+
+def remove_category(sender, instance, using, **kwargs):
+    if not instance.is_enum and sharding.enabled():
+        sharding.directory.remove(instance.pk, using)
+
+
+for model in (Measure, Category, Parameter, EnumValue, ParameterAggregate):
+    post_save.connect(replicate_reference, sender=model,
+                      dispatch_uid=f'shard_replicate_save_{model.__name__}')
+    post_delete.connect(
+        replicate_reference, sender=model,
+        dispatch_uid=f'shard_replicate_delete_{model.__name__}'
+    )
+post_save.connect(place_category, sender=Category,
+                  dispatch_uid='shard_place_category')
+post_delete.connect(remove_category, sender=Category,
+                    dispatch_uid='shard_remove_category')
+
+
+# Метрики SQL-запросов (см. `metrics.py`).
+connection_created.connect(install_query_wrapper,
+                           dispatch_uid='metrics_install_query_wrapper')
@@ -0,0 +1,305 @@
+"""Резервирование остатков изделий.
+
+Остаток `Product.amount` уменьшается условным UPDATE
+(`amount = amount - n WHERE amount >= n`), поэтому одновременные заказы не
+теряют изменений и не уводят остаток в минус. Резерв охватывает несколько
+изделий и создаётся целиком или не создаётся вовсе (`InsufficientStock`).
+Резерв подтверждают (`commit`) или отменяют (`release`, остаток
+возвращается); не подтверждённый за `STOCK_RESERVATION_TTL` секунд резерв
+просрочивается и тоже возвращает остаток.
+
+Запись в SQLite выполняется по одной транзакции за раз, поэтому
+одновременные вызовы процесса объединяются (`StockBatcher`): поток,
+получивший очередь, выполняет до `STOCK_BATCH_SIZE` ожидающих операций в
+одной короткой транзакции, каждую в своей точке сохранения, так что
+ошибка одной операции не отменяет остальные. Просроченные резервы
+возвращаются тем же потоком не чаще раза в
+`STOCK_RESERVATION_SWEEP_INTERVAL` секунд, а также командой
+`stock_reservations expire`.
+
+Изменения остатков применяются к сводке (`rollup.py`) и матрице аналитики
+как разности после фиксации. При шардинге резервируются только изделия
+базы `default`.
+"""
+
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .metrics import stock_batch_size, stock_operations
+from .models import Product, StockReservation, StockReservationItem
+from .rollup import rollups
+from .signals import apply_analytics
+
+
+class StockError(Exception):
+    pass
+
+
+class InsufficientStock(StockError):
+    def __init__(self, product_ids):
+        super().__init__('Недостаточно остатка: '
+                         + ', '.join(map(str, product_ids)) + '.')
+        self.product_ids = product_ids
+
+
+class ReservationNotFound(StockError):
+    def __init__(self):
+        super().__init__('Резерв не найден.')
+
+
+class ReservationNotActive(StockError):
+    def __init__(self, status):
+        super().__init__(f'Резерв не действует: {status}.')
+        self.status = status
+
+
+class _Short(Exception):
+    """Условие остатка не выполнено хотя бы для одного изделия."""
+
+
+def normalize_items(items):
+    """Словарь `product_id -> quantity` из словаря или пар; количества
+    одного изделия складываются."""
+    if isinstance(items, dict):
+        items = items.items()
+    result = {}
+    for product_id, quantity in items:
+        if type(product_id) is not int or type(quantity) is not int:
+            raise ValueError('Изделие и количество — целые числа.')
+        if quantity <= 0:
+            raise ValueError('Количество должно быть положительным.')
+        result[product_id] = result.get(product_id, 0) + quantity
+    if not result:
+        raise ValueError('Резерв без изделий.')
+    return dict(sorted(result.items()))
+
+
+def _by_product(items):
+    return Case(*(When(pk=product_id, then=Value(quantity))
+                  for product_id, quantity in items.items()),
+                output_field=IntegerField())
+
+
+class _Call:
+    __slots__ = ('operation', 'args', 'done', 'result', 'error')
+
+    def __init__(self, operation, args):
+        self.operation = operation
+        self.args = args
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class StockBatcher:
+    """Объединяет одновременные операции процесса в одну транзакцию."""
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+        # Транзакцию выполняет один поток за раз.
+        self._leader = threading.Lock()
+        self._swept_at = 0.0
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'STOCK_BATCH_SIZE', 100)
+
+    def call(self, operation, *args):
+        call = _Call(operation, args)
+        with self._lock:
+            self._pending.append(call)
+        # Пока поток ждёт очереди, его операцию может выполнить другой.
+        while not call.done:
+            with self._leader:
+                if call.done:
+                    break
+                with self._lock:
+                    batch = self._pending[:self.batch_size]
+                    del self._pending[:self.batch_size]
+                self._run(batch)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _run(self, batch):
+        changed_at = time.monotonic()
+        deltas = {}
+        try:
+            with transaction.atomic():
+                for call in batch:
+                    changes = {}
+                    try:
+                        with transaction.atomic():
+                            call.result = getattr(self, call.operation)(
+                                *call.args, changes=changes
+                            )
+                    except Exception as e:
+                        call.error = e
+                        stock_operations.inc(call.operation, 'rejected')
+                        continue
+                    stock_operations.inc(call.operation, 'ok')
+                    for product_id, delta in changes.items():
+                        deltas[product_id] = deltas.get(product_id, 0) + delta
+                self._sweep_if_due(deltas)
+        except Exception as e:
+            # Транзакция не зафиксирована: не выполнена ни одна операция.
+            for call in batch:
+                if call.error is None:
+                    call.error = e
+                    call.result = None
+            deltas = {}
+        finally:
+            for call in batch:
+                call.done = True
+        stock_batch_size.observe(len(batch))
+        if deltas:
+            apply_stock_changes(deltas, changed_at)
+
+    def _sweep_if_due(self, deltas):
+        interval = getattr(settings, 'STOCK_RESERVATION_SWEEP_INTERVAL', 10)
+        if time.monotonic() - self._swept_at < interval:
+            return
+        self._swept_at = time.monotonic()
+        with transaction.atomic():
+            changes = {}
+            self.expire(changes=changes)
+        for product_id, delta in changes.items():
+            deltas[product_id] = deltas.get(product_id, 0) + delta
+
+    # Операции; выполняются внутри транзакции пакета, `changes` —
+    # изменения остатков по изделиям.
+
+    def reserve(self, items, ttl, user, changes):
+        quantity = _by_product(items)
+        try:
+            with transaction.atomic():
+                updated = Product.objects.filter(
+                    pk__in=list(items), amount__gte=quantity
+                ).update(amount=F('amount') - quantity)
+                if updated != len(items):
+                    raise _Short
+        except _Short:
+            amounts = dict(Product.objects.filter(
+                pk__in=list(items)
+            ).values_list('pk', 'amount'))
+            raise InsufficientStock([
+                product_id for product_id, needed in items.items()
+                if amounts.get(product_id, 0) < needed
+            ])
+        reservation = StockReservation.objects.create(
+            expires_at=timezone.now() + timedelta(seconds=ttl),
+            created_by=user,
+        )
+        reservation.reserved_items = StockReservationItem.objects.bulk_create(
+            StockReservationItem(reservation=reservation,
+                                 product_id=product_id, quantity=quantity)
+            for product_id, quantity in items.items()
+        )
+        for product_id, quantity in items.items():
+            changes[product_id] = -quantity
+        return reservation
+
+    def commit(self, reservation_id, changes):
+        now = timezone.now()
+        if StockReservation.objects.filter(
+                pk=reservation_id, status=StockReservation.ACTIVE,
+                expires_at__gt=now
+        ).update(status=StockReservation.COMMITTED, finished_at=now):
+            return StockReservation.objects.get(pk=reservation_id)
+        raise self._not_active(reservation_id)
+
+    def release(self, reservation_id, changes,
+                status=StockReservation.RELEASED):
+        now = timezone.now()
+        # Остаток возвращает тот, чей UPDATE статуса выполнился.
+        if not StockReservation.objects.filter(
+                pk=reservation_id, status=StockReservation.ACTIVE
+        ).update(status=status, finished_at=now):
+            raise self._not_active(reservation_id)
+        items = dict(StockReservationItem.objects.filter(
+            reservation_id=reservation_id
+        ).values_list('product_id', 'quantity'))
+        if items:
+            quantity = _by_product(items)
+            Product.objects.filter(pk__in=list(items)).update(
+                amount=F('amount') + quantity
+            )
+        for product_id, quantity in items.items():
+            changes[product_id] = changes.get(product_id, 0) + quantity
+        return StockReservation.objects.get(pk=reservation_id)
+
+    def expire(self, changes, limit=1000):
+        expired = 0
+        for reservation_id in list(StockReservation.objects.filter(
+                status=StockReservation.ACTIVE,
+                expires_at__lte=timezone.now(),
+        ).order_by('expires_at').values_list('pk', flat=True)[:limit]):
+            try:
+                self.release(reservation_id, changes,
+                             status=StockReservation.EXPIRED)
+            except ReservationNotActive:
+                continue
+            expired += 1
+        return expired
+
+    @staticmethod
+    def _not_active(reservation_id):
+        status = StockReservation.objects.filter(
+            pk=reservation_id
+        ).values_list('status', flat=True).first()
+        if status is None:
+            return ReservationNotFound()
+        if status == StockReservation.ACTIVE:
+            return ReservationNotActive(StockReservation.EXPIRED)
+        return ReservationNotActive(status)
+
+
+batcher = StockBatcher()
+
+
+def apply_stock_changes(deltas, changed_at):
+    """Применяет изменения остатков к сводке и матрице аналитики."""
+    for product_id, category_id, amount, price in Product.objects.filter(
+            pk__in=list(deltas)
+    ).values_list('pk', 'category_id', 'amount', 'price'):
+        delta = deltas[product_id]
+        if not delta:
+            continue
+        price = Decimal(str(price))
+        rollups.product_changed((category_id, 0, price),
+                                (category_id, delta, price), changed_at)
+        apply_analytics('amount_changed', product_id, amount)
+
+
+def reserve(items, ttl=None, user=None):
+    """Резервирует остатки (`{product_id: quantity}` или пары) целиком;
+    иначе вызывает InsufficientStock со списком изделий."""
+    items = normalize_items(items)
+    if ttl is None:
+        ttl = getattr(settings, 'STOCK_RESERVATION_TTL', 600)
+    if user is not None and not user.is_authenticated:
+        user = None
+    return batcher.call('reserve', items, ttl, user)
+
+
+def commit(reservation_id):
+    """Подтверждает действующий резерв."""
+    return batcher.call('commit', reservation_id)
+
+
+def release(reservation_id):
+    """Отменяет действующий резерв и возвращает остатки."""
+    return batcher.call('release', reservation_id)
+
+
+def expire():
+    """Просрочивает резервы с истёкшим сроком; возвращает их число."""
+    return batcher.call('expire')
@@ -0,0 +1,217 @@
+"""Быстрый вывод таблиц отчётов в HTML.
+
+Шаблоны отчётов (`pages/all_products_with_params.html` и др.) выводят
+строку таблицы на каждую пару (изделие, параметр) циклом языка шаблонов
+Django, и для больших отчётов вывод дольше построения. Здесь цикл по
+отчёту вырезается из исходного текста шаблона один раз на процесс (и
+заново при изменении шаблона):
+
+* остальная страница рендерится обычным шаблоном, в котором цикл заменён
+  меткой, и делится по ней на начало и конец;
+* тело цикла компилируется в список фрагментов: текст и поля строки
+  (`{{ row.field }}` без фильтров). Части строки, зависящие только от
+  изделия, собираются один раз на изделие, только от параметра — один
+  раз на параметр; значение экранируется один раз на строку значения
+  (значения отчёта интернированы, см. `reports.py`).
+
+Значения выводятся как в шаблоне: `localize`, `str` и экранирование,
+поэтому разметка совпадает с обычным рендером побайтно. Страница
+отдаётся потоковым ответом порциями по `REPORT_TABLE_CHUNK_SIZE`
+символов. Шаблон с другим телом цикла (фильтры, теги) выводится обычным
+рендером; отключается `REPORT_FAST_TABLES = False`.
+"""
+
+import re
+import threading
+from itertools import chain
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.template import engines
+from django.template.base import TextNode, VariableNode
+from django.utils.formats import localize
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from .reports import HEADER_FIELDS
+
+# Поля строки отчёта (`ReportRow`), зависящие только от параметра.
+META_FIELDS = {
+    'param_id': 'id',
+    'param_name': 'name_short',
+    'param_type': 'data_type',
+    'param_measure': 'measure',
+}
+
+# Метка места цикла в выводе страницы.
+MARKER = '\x00report-table-rows\x00'
+MARKER_VARIABLE = 'report_table_rows'
+
+
+class NotCompilable(Exception):
+    """Тело цикла содержит что-то кроме текста и полей строки."""
+
+
+def _escape(value, cache):
+    # Ключ с типом: 1, 1.0 и Decimal('1') выводятся по-разному.
+    key = value if type(value) is str else (type(value), value)
+    escaped = cache.get(key)
+    if escaped is None:
+        text = value if type(value) is str else str(localize(value))
+        escaped = cache[key] = conditional_escape(text)
+    return escaped
+
+
+class TableTemplate:
+    """Шаблон страницы отчёта с вырезанным циклом по `key`."""
+
+    def __init__(self, source, key):
+        engine = engines['django']
+        loop = re.search(
+            r'{%\s*for\s+(\w+)\s+in\s+' + re.escape(key) +
+            r'\s*%}(.*?){%\s*endfor\s*%}', source, re.DOTALL
+        )
+        if loop is None or re.search(r'{%\s*for\s', loop.group(2)):
+            raise NotCompilable
+        self.page = engine.from_string(
+            source[:loop.start()] + '{{ ' + MARKER_VARIABLE + ' }}' +
+            source[loop.end():]
+        )
+        self.groups = self.compile(
+            engine.from_string(loop.group(2)).template.nodelist,
+            loop.group(1)
+        )
+
+    @staticmethod
+    def compile(nodelist, name):
+        """Группы `(источник, фрагменты)` тела цикла. Источник — 'header',
+        'meta', 'value' или 'text'; фрагмент — `(поле ли, текст или имя
+        поля)`. Текст относится к группе следующего за ним поля."""
+        groups = []
+        text = []
+        for node in nodelist:
+            if isinstance(node, TextNode):
+                text.append((False, node.s))
+                continue
+            if not isinstance(node, VariableNode):
+                raise NotCompilable
+            expression = node.filter_expression
+            lookups = getattr(expression.var, 'lookups', None)
+            if (expression.filters or lookups is None or
+                    len(lookups) != 2 or lookups[0] != name):
+                raise NotCompilable
+            field = lookups[1]
+            if field in HEADER_FIELDS:
+                source = 'header'
+            elif field in META_FIELDS:
+                source, field = 'meta', META_FIELDS[field]
+            elif field == 'param_value':
+                source = 'value'
+            else:
+                raise NotCompilable
+            fragments = [*text, (True, field)]
+            text = []
+            if groups and groups[-1][0] == source:
+                groups[-1][1].extend(fragments)
+            else:
+                groups.append((source, fragments))
+        if text:
+            groups.append(('text', text))
+        return [(source, tuple(fragments)) for source, fragments in groups]
+
+    def stream(self, context, key, request=None, chunk_size=65536):
+        """Порции страницы отчёта `context[key]`."""
+        page = self.page.render(
+            {**context, MARKER_VARIABLE: mark_safe(MARKER)}, request
+        )
+        head, marker, tail = page.partition(MARKER)
+        if not marker:
+            # Цикл не выводится, например, при пустом отчёте.
+            return iter([page])
+        return chain([head], self.rows(context[key], chunk_size), [tail])
+
+    def rows(self, report, chunk_size):
+        """Разметка строк отчёта порциями примерно по `chunk_size`
+        символов."""
+        escaped = {}
+        meta_parts = {}
+        groups = self.groups
+        chunk = []
+        size = 0
+        for header in report.products:
+            if not header.params:
+                continue
+            header_parts = [
+                _render(fragments, header, escaped)
+                if source == 'header' else None
+                for source, fragments in groups
+            ]
+            for param_id, value in header.params:
+                meta = meta_parts.get(param_id)
+                if meta is None:
+                    meta = meta_parts[param_id] = [
+                        _render(fragments, report.params[param_id], escaped)
+                        if source == 'meta' else None
+                        for source, fragments in groups
+                    ]
+                for index, (source, fragments) in enumerate(groups):
+                    if source == 'header':
+                        part = header_parts[index]
+                    elif source == 'meta':
+                        part = meta[index]
+                    elif source == 'value':
+                        part = ''.join(
+                            _escape(value, escaped) if is_field else text
+                            for is_field, text in fragments
+                        )
+                    else:
+                        part = ''.join(text for _, text in fragments)
+                    chunk.append(part)
+                    size += len(part)
+                if size >= chunk_size:
+                    yield ''.join(chunk)
+                    chunk = []
+                    size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+
+def _render(fragments, obj, escaped):
+    return ''.join(
+        _escape(getattr(obj, text), escaped) if is_field else text
+        for is_field, text in fragments
+    )
+
+
+_tables = {}
+_lock = threading.Lock()
+
+
+def table_template(template_name, key):
+    """`TableTemplate` шаблона или None, если цикл не компилируется."""
+    source = engines['django'].engine.find_template(template_name)[0].source
+    with _lock:
+        cached = _tables.get((template_name, key))
+    if cached is not None and cached[0] == source:
+        return cached[1]
+    try:
+        table = TableTemplate(source, key)
+    except NotCompilable:
+        table = None
+    with _lock:
+        _tables[template_name, key] = (source, table)
+    return table
+
+
+def render_table(request, template_name, context, key):
+    """Потоковый ответ со страницей отчёта `context[key]` (`Report`) или
+    None, если быстрый вывод выключен или шаблон не подходит."""
+    if not getattr(settings, 'REPORT_FAST_TABLES', True):
+        return None
+    table = table_template(template_name, key)
+    if table is None:
+        return None
+    return StreamingHttpResponse(table.stream(
+        context, key, request,
+        getattr(settings, 'REPORT_TABLE_CHUNK_SIZE', 65536)
+    ))
@@ -0,0 +1,262 @@
+"""Числовые значения параметров в базовых единицах.
+
+Единица измерения (`Measure`) может ссылаться на базовую единицу
+(`base`) с множителем `factor`; единицы с общей базовой совместимы, и
+значения в них сравнимы после перевода в базовую.
+
+`value_num` хранит числовое значение в базовой единице:
+
+* у `EnumValue` — значение `value_int` или `value_real` в единице
+  категории-перечисления;
+* у `ParameterValue` — значение `value_int` или `value_real` в единице
+  параметра, для перечислений — `value_num` элемента перечисления.
+
+Поле заполняется при сохранении через ORM (`signals.py`) и массовыми
+операциями (`bulk.py`); при изменении множителя единицы, единицы
+параметра или категории-перечисления и числового значения элемента
+перечисления затронутые значения пересчитываются (`refresh`) во всех
+базах каталога. Прямой SQL поле не обновляет — после него выполняется
+`refresh()`.
+
+По `(param, value_num)` есть индекс: отбор по диапазону (`in_range`)
+читает по нему собственные значения изделий уже упорядоченными, а
+значения категорий сливает с ними без сортировки изделий. В единицу
+параметра или запрошенную единицу значение переводится только при выводе
+(`convert`).
+"""
+
+import heapq
+from itertools import islice
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Exists, F, FloatField, OuterRef, Value
+from django.db.models.functions import Cast, Coalesce
+
+from . import sharding
+from .models import Category, EnumValue, Measure, Parameter, ParameterValue
+
+# Типы параметров, значения которых переводятся единицей параметра;
+# перечисления переводятся единицей своей категории.
+NUMERIC_TYPES = ('int', 'real')
+
+
+class IncompatibleUnits(ValueError):
+    def __init__(self, source, target):
+        source, target = (measure.name_short if measure else '—'
+                          for measure in (source, target))
+        super().__init__(f'Единицы «{source}» и «{target}» несовместимы.')
+
+
+def number(value_int, value_real):
+    """Числовое значение из полей значения или None."""
+    if value_int is not None:
+        return float(value_int)
+    if value_real is not None:
+        return float(value_real)
+    return None
+
+
+def _number_expression(factor):
+    return Coalesce(Cast('value_int', FloatField()), F('value_real'),
+                    output_field=FloatField()) * Value(float(factor))
+
+
+def _scaled(value, factor):
+    return None if value is None else value * (factor or 1.0)
+
+
+def enum_value_num(enum, using=DEFAULT_DB_ALIAS):
+    """`value_num` элемента перечисления."""
+    value = number(enum.value_int, enum.value_real)
+    if value is None:
+        return None
+    return _scaled(value, Category.objects.using(using).filter(
+        pk=enum.category_id
+    ).values_list('measure__factor', flat=True).first())
+
+
+def param_value_num(param_id, value_int=None, value_real=None,
+                    value_enum_id=None, using=DEFAULT_DB_ALIAS):
+    """`value_num` значения параметра."""
+    if value_enum_id is not None:
+        return EnumValue.objects.using(using).filter(
+            pk=value_enum_id
+        ).values_list('value_num', flat=True).first()
+    value = number(value_int, value_real)
+    if value is None:
+        return None
+    data_type, factor = Parameter.objects.using(using).filter(
+        pk=param_id
+    ).values_list('data_type', 'measure__factor').first() or (None, None)
+    if data_type not in NUMERIC_TYPES:
+        return None
+    return _scaled(value, factor)
+
+
+# Пересчёт. Функции с `apps` вызываются из миграций.
+
+def _refresh(models, source, targets, param_ids=None,
+             enum_category_ids=None):
+    Measure, Category, Parameter, EnumValue, ParameterValue = models
+    factors = dict(Measure.objects.using(source).values_list('id', 'factor'))
+
+    enums = EnumValue.objects.using(source)
+    if enum_category_ids is not None:
+        enums = enums.filter(category_id__in=enum_category_ids)
+    measure_of = dict(Category.objects.using(source).filter(
+        is_enum=True
+    ).values_list('id', 'measure_id'))
+    enum_ids = {}
+    for pk, category_id, value_int, value_real in enums.values_list(
+            'id', 'category_id', 'value_int', 'value_real'):
+        value = _scaled(number(value_int, value_real),
+                        factors.get(measure_of.get(category_id)))
+        enum_ids.setdefault(value, []).append(pk)
+
+    # Значения перечислений пересчитываются по элементам; у нечисловых
+    # параметров (в том числе сменивших тип) значения нет.
+    params = Parameter.objects.using(source).exclude(data_type='enum')
+    if param_ids is not None:
+        params = params.filter(pk__in=param_ids)
+    param_ids_by_factor = {}
+    for pk, data_type, measure_id in params.values_list('id', 'data_type',
+                                                        'measure_id'):
+        factor = (factors.get(measure_id) or 1.0
+                  if data_type in NUMERIC_TYPES else None)
+        param_ids_by_factor.setdefault(factor, []).append(pk)
+
+    for alias in targets:
+        with transaction.atomic(using=alias):
+            values = ParameterValue.objects.using(alias)
+            for value, ids in enum_ids.items():
+                EnumValue.objects.using(alias).filter(pk__in=ids).update(
+                    value_num=value
+                )
+                values.filter(value_enum_id__in=ids).update(value_num=value)
+            for factor, ids in param_ids_by_factor.items():
+                values.filter(param_id__in=ids).update(
+                    value_num=(_number_expression(factor)
+                               if factor is not None else None)
+                )
+
+
+def fill_base_values(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    _refresh([apps.get_model('django_db_app', name) for name in (
+        'Measure', 'Category', 'Parameter', 'EnumValue', 'ParameterValue'
+    )], alias, [alias])
+
+
+def refresh(param_ids=None, enum_category_ids=None):
+    """Пересчитывает `value_num` значений параметров `param_ids` и
+    перечислений категорий `enum_category_ids` (None — всех) во всех
+    базах каталога.
+
+    Справочники читаются из `default`: их копии в шардах обновляются
+    только после фиксации.
+    """
+    _refresh((Measure, Category, Parameter, EnumValue, ParameterValue),
+             DEFAULT_DB_ALIAS,
+             sharding.shards() if sharding.enabled() else [DEFAULT_DB_ALIAS],
+             param_ids, enum_category_ids)
+
+
+def refresh_measure(measure_id):
+    """Пересчитывает значения в единице `measure_id`."""
+    refresh(
+        param_ids=list(Parameter.objects.filter(
+            measure_id=measure_id
+        ).values_list('pk', flat=True)),
+        enum_category_ids=list(Category.objects.filter(
+            is_enum=True, measure_id=measure_id
+        ).values_list('pk', flat=True)),
+    )
+
+
+# Отбор и вывод.
+
+def compatible(source, target):
+    """Совместимы ли единицы `source` и `target` (или обе не заданы)."""
+    if source is None or target is None:
+        return source is target
+    return (source.base_id or source.pk) == (target.base_id or target.pk)
+
+
+def value_measure(param):
+    """Единица значений параметра `param`: у перечислений — единица
+    категории-перечисления."""
+    if param.data_type == 'enum':
+        return param.enum.measure if param.enum_id is not None else None
+    return param.measure
+
+
+def convert(value_num, measure=None):
+    """Значение в базовой единице — в единице `measure`."""
+    if value_num is None or measure is None:
+        return value_num
+    return value_num / measure.factor
+
+
+def in_range(products, param, low=None, high=None, measure=None,
+             limit=None):
+    """Изделия `products` со значением параметра `param` в диапазоне
+    `[low, high]` в единице `measure` (по умолчанию — единице значений
+    параметра, `value_measure`): не больше `limit` строк `(value_num, id,
+    name, category_id)` по возрастанию значения в базовой единице и id.
+
+    Значение изделия без собственного берётся из его категории, как в
+    отчётах. Собственные значения читаются по индексу `(param, value_num)`
+    уже упорядоченными; значений категорий немного, и изделия каждой
+    такой категории без собственного значения читаются по первичному
+    ключу. Оба потока сливаются без сортировки изделий.
+    """
+    own_measure = value_measure(param)
+    if measure is None:
+        measure = own_measure
+    elif not compatible(own_measure, measure):
+        raise IncompatibleUnits(own_measure, measure)
+    factor = measure.factor if measure is not None else 1.0
+
+    values = ParameterValue.objects.using(products.db).filter(
+        param=param, value_num__isnull=False
+    )
+    if low is not None:
+        values = values.filter(value_num__gte=low * factor)
+    if high is not None:
+        values = values.filter(value_num__lte=high * factor)
+
+    own = values.filter(product__in=products).order_by(
+        'value_num', 'product_id'
+    ).values_list('value_num', 'product_id', 'product__name',
+                  'product__category_id')
+    if limit is not None:
+        own = own[:limit]
+
+    # Значения категорий по возрастанию; категории с равным значением
+    # читаются вместе.
+    categories = {}
+    for number, category_id in values.filter(
+            category_id__in=products.values('category_id')
+    ).order_by('value_num', 'category_id').values_list('value_num',
+                                                      'category_id'):
+        categories.setdefault(number, []).append(category_id)
+    without_own = products.exclude(Exists(ParameterValue.objects.filter(
+        param=param, product_id=OuterRef('pk')
+    )))
+
+    def inherited():
+        found = 0
+        for number, category_ids in categories.items():
+            rows = without_own.filter(category_id__in=category_ids).order_by(
+                'pk'
+            ).values_list('id', 'name', 'category_id')
+            if limit is not None:
+                rows = rows[:limit - found]
+            for row in rows:
+                yield (number, *row)
+                found += 1
+            if limit is not None and found >= limit:
+                return
+
+    return list(islice(heapq.merge(own, inherited(),
+                                   key=lambda row: row[:2]), limit))
@@ -8,6 +8,9 @@ urlpatterns = [
     path('classifier/',
          views.ClassifierView.as_view(),
          name='classifier'),
+    path('classifier/rollup/',
+         views.ClassifierRollupView.as_view(),
+         name='classifier_rollup'),
     path('descendants_by_category/',
          views.DescendantsByCategoryView.as_view(),
          name='descendants_by_category'),
@@ -29,4 +32,49 @@ urlpatterns = [
     path('products_with_aggregate_params/',
          views.ProductsWithAggregateParamsView.as_view(),
          name='products_with_aggregate_params'),
+    path('products/params/',
+         views.BatchProductParamsView.as_view(),
+         name='batch_product_params'),
+    path('products/by_param/',
+         views.ParameterRangeView.as_view(),
+         name='products_by_param'),
+    path('products/<int:pk>/similar/',
+         views.SimilarProductsView.as_view(),
+         name='similar_products'),
+    path('jobs/',
+         views.ExportJobCreateView.as_view(),
+         name='export_jobs'),
+    path('jobs/<int:pk>/',
+         views.ExportJobView.as_view(),
+         name='export_job'),
+    path('jobs/<int:pk>/download/',
+         views.ExportJobDownloadView.as_view(),
+         name='export_job_download'),
+    path('stock/reservations/',
+         views.StockReservationCreateView.as_view(),
+         name='stock_reservations'),
+    path('stock/reservations/<uuid:pk>/',
+         views.StockReservationView.as_view(),
+         name='stock_reservation'),
+    path('stock/reservations/<uuid:pk>/commit/',
+         views.StockReservationCommitView.as_view(),
+         name='stock_reservation_commit'),
+    path('stock/reservations/<uuid:pk>/release/',
+         views.StockReservationReleaseView.as_view(),
+         name='stock_reservation_release'),
+    path('analytics/stats/',
+         views.ParameterStatsView.as_view(),
+         name='parameter_stats'),
+    path('changes/',
+         views.CatalogChangesView.as_view(),
+         name='changes'),
+    path('metrics',
+         views.MetricsView.as_view(),
+         name='metrics'),
+    path('profiles/',
+         views.ProfileListView.as_view(),
+         name='profiles'),
+    path('profiles/<str:name>',
+         views.ProfileDownloadView.as_view(),
+         name='profile_download'),
 ]
@@ -0,0 +1,348 @@
+"""Использование.
+
+Находясь в директории `/db_admin/`, выполните:
+```bash
+py manage.py shell
+```
+
+Откроется интерпретатор Python. В нём выполните:
+```python
+from django_db_app.utils.benchmarks import fill_bench_data, bench_report_memory
+fill_bench_data(products=20000)
+bench_report_memory()
+```
+
+`fill_bench_data` добавляет синтетический каталог (категории с префиксом
+`bench-`), поэтому запускайте его на копии базы.
+
+Резервирование остатков (`stock.py`) под конкуренцией:
+```python
+from django_db_app.utils.benchmarks import bench_stock_reservations
+bench_stock_reservations(clients=(1, 8, 32), duration=5)
+```
+или `py manage.py stock_reservations bench`.
+
+Параллельная выгрузка отчёта (`parallel.py`):
+```python
+from django_db_app.utils.benchmarks import bench_parallel_reports
+bench_parallel_reports(workers=(1, 2, 4, 8))
+```
+или `py manage.py export_jobs bench`.
+
+Вывод HTML-таблицы отчёта (`tables.py`) против цикла шаблона:
+```python
+from django_db_app.utils.benchmarks import bench_report_render
+bench_report_render()
+```
+"""
+
+import hashlib
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from django.db import connections, transaction
+from django.db.models import Min, Sum
+from django.template import engines
+from django.test.utils import override_settings
+
+from .. import display, parallel, stock, units
+from ..tables import table_template
+from ..models import (
+    Measure, Category, Product, Parameter, ParameterValue, StockReservation,
+    StockReservationItem
+)
+from ..reports import Pivot, ReportQuery, build_report, iter_export
+
+
+@transaction.atomic
+def fill_bench_data(categories=50, products=20000, params=12, seed=0):
+    rng = random.Random(seed)
+    measure, _ = Measure.objects.get_or_create(
+        name_short='bench', defaults={'name': 'Bench'}
+    )
+    root = Category.objects.create(name='bench-root', measure=measure)
+    leaves = Category.objects.bulk_create(
+        Category(name=f'bench-{i}', parent=root, measure=measure)
+        for i in range(categories)
+    )
+    parameters = Parameter.objects.bulk_create(
+        Parameter(name=f'Параметр {i}', name_short=f'b{i}',
+                  data_type='int' if i % 2 else 'real', measure=measure)
+        for i in range(params)
+    )
+    product_objs = Product.objects.bulk_create(
+        (Product(name=f'Изделие {i}', category=rng.choice(leaves),
+                 amount=rng.randint(0, 500), price=rng.randint(1, 10000))
+         for i in range(products)),
+        batch_size=1000,
+    )
+    # Половина параметров задаётся на уровне категории.
+    ParameterValue.objects.bulk_create(
+        (ParameterValue(category=leaf, param=param,
+                        value_real=rng.random() * 100)
+         for leaf in leaves for param in parameters[::2]),
+        batch_size=1000,
+    )
+    ParameterValue.objects.bulk_create(
+        (ParameterValue(product=product, param=param,
+                        value_int=rng.randint(1, 1000))
+         for product in product_objs for param in parameters[1::2]),
+        batch_size=1000,
+    )
+    # bulk_create обходит сигналы, заполняющие значения в базовых единицах
+    # и отображаемые значения.
+    param_ids = [param.pk for param in parameters]
+    units.refresh(param_ids=param_ids, enum_category_ids=[])
+    display.refresh(param_ids=param_ids, enum_ids=[])
+
+
+def _measure(func):
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = func()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def _dict_report(products):
+    """Отчёт в прежнем виде: список словарей, по два запроса значений на
+    изделие (как в представлениях до `reports.py`)."""
+    results = []
+    for product in products.select_related('category', 'category__measure'):
+        param_values = ParameterValue.objects.filter(
+            product=product
+        ).select_related('param', 'param__measure', 'value_enum')
+        overridden_params = {pv.param_id for pv in param_values}
+        inherited_param_values = ParameterValue.objects.filter(
+            category=product.category
+        ).exclude(
+            param_id__in=overridden_params
+        ).select_related('param', 'param__measure', 'value_enum')
+
+        for pv in list(param_values) + list(inherited_param_values):
+            param = pv.param
+            if param.data_type == 'int':
+                value = str(pv.value_int) if pv.value_int else ''
+            elif param.data_type == 'real':
+                value = str(pv.value_real) if pv.value_real else ''
+            elif param.data_type == 'str':
+                value = pv.value_str if pv.value_str else ''
+            elif param.data_type == 'path':
+                value = pv.value_path if pv.value_path else ''
+            elif param.data_type == 'enum' and pv.value_enum:
+                value = (pv.value_enum.value_str or
+                         pv.value_enum.value_int or
+                         pv.value_enum.value_real or
+                         pv.value_enum.value_path)
+            else:
+                value = ''
+            results.append({
+                'category_id': product.category.id,
+                'category': product.category.name,
+                'product_id': product.id,
+                'product': product.name,
+                'amount': product.amount,
+                'measure': (product.category.measure.name_short
+                            if product.category.measure else ''),
+                'price': product.price,
+                'param_id': param.id,
+                'param_name': param.name_short,
+                'param_type': param.data_type,
+                'param_value': value,
+                'param_measure': (param.measure.name_short
+                                  if param.measure else ''),
+            })
+    return results
+
+
+def bench_report_memory():
+    """Сравнивает пиковую память и время компактного отчёта и прежнего
+    списка словарей (`_dict_report`)."""
+    products = Product.objects.all()
+
+    report, compact_time, compact_peak = _measure(
+        lambda: build_report(products)
+    )
+    rows = sum(len(header.params) for header in report.products)
+    del report
+    _, dicts_time, dicts_peak = _measure(lambda: _dict_report(products))
+
+    print(f'Строк отчёта: {rows}')
+    print(f'Компактный отчёт: {compact_peak / 2**20:.1f} МиБ, '
+          f'{compact_time:.2f} с')
+    print(f'Список словарей: {dicts_peak / 2**20:.1f} МиБ, '
+          f'{dicts_time:.2f} с')
+    print(f'Экономия памяти: {dicts_peak / max(compact_peak, 1):.1f}x')
+
+
+def _stock_run(product_ids, clients, duration, items, seed):
+    deadline = time.perf_counter() + duration
+    latencies = [[] for _ in range(clients)]
+    rejected = [0] * clients
+
+    def client(index):
+        rng = random.Random(seed + index)
+        try:
+            while time.perf_counter() < deadline:
+                wanted = {product_id: rng.randint(1, 3) for product_id in
+                          rng.sample(product_ids, items)}
+                started = time.perf_counter()
+                try:
+                    reservation = stock.reserve(wanted)
+                except stock.InsufficientStock:
+                    rejected[index] += 1
+                    continue
+                finally:
+                    latencies[index].append(time.perf_counter() - started)
+                # Подтверждается примерно половина резервов.
+                if rng.random() < 0.5:
+                    stock.commit(reservation.pk)
+                else:
+                    stock.release(reservation.pk)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=client, args=(index,))
+               for index in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for client_latencies in latencies
+                       for latency in client_latencies)
+    return elapsed, latencies, sum(rejected)
+
+
+def bench_stock_reservations(clients=(1, 8, 32), duration=5, products=20,
+                             amount=1000, items=3, seed=0):
+    """Пропускная способность резервирования при `clients` одновременных
+    клиентах с объединением операций и без него (по транзакции на
+    операцию); проверяет, что остатки не уходят в минус и сходятся с
+    подтверждёнными резервами."""
+    measure, created = Measure.objects.get_or_create(
+        name_short='bench', defaults={'name': 'Bench'}
+    )
+    category = Category.objects.create(name='bench-stock', measure=measure)
+    product_ids = [product.pk for product in Product.objects.bulk_create(
+        Product(name=f'Изделие {i}', category=category, amount=amount,
+                price=100)
+        for i in range(products)
+    )]
+    bench_products = Product.objects.filter(pk__in=product_ids)
+    reserved = StockReservationItem.objects.filter(
+        product_id__in=product_ids
+    )
+    try:
+        modes = (('с объединением', stock.batcher.batch_size),
+                 ('по транзакции на операцию', 1))
+        for title, batch_size in modes:
+            for count in clients:
+                bench_products.update(amount=amount)
+                StockReservation.objects.filter(
+                    items__product_id__in=product_ids
+                ).delete()
+                with override_settings(STOCK_BATCH_SIZE=batch_size):
+                    elapsed, latencies, rejected = _stock_run(
+                        product_ids, count, duration, items, seed
+                    )
+                stock.expire()
+
+                left = bench_products.aggregate(total=Sum('amount'),
+                                                low=Min('amount'))
+                held = reserved.filter(
+                    reservation__status__in=(StockReservation.ACTIVE,
+                                             StockReservation.COMMITTED)
+                ).aggregate(total=Sum('quantity'))['total'] or 0
+                consistent = (left['low'] >= 0 and
+                              left['total'] + held == amount * products)
+                operations = len(latencies)
+                if operations:
+                    timing = (
+                        f'{operations / elapsed:.0f} резервов/с, '
+                        f'отказов {rejected}, '
+                        f'p50 {latencies[operations // 2] * 1000:.1f} мс, '
+                        f'p99 {latencies[int(operations * 0.99)] * 1000:.1f}'
+                        f' мс'
+                    )
+                else:
+                    timing = 'ни одной операции'
+                print(f'{title}, клиентов {count}: {timing}, остатки '
+                      + ('сходятся' if consistent else 'НЕ СХОДЯТСЯ'))
+    finally:
+        StockReservation.objects.filter(
+            items__product_id__in=product_ids
+        ).delete()
+        bench_products.delete()
+        category.delete()
+        if created:
+            measure.delete()
+
+
+def bench_parallel_reports(workers=(1, 2, 4, 8), layout='tall',
+                           export_format='csv'):
+    """Время выгрузки всех изделий последовательно и частями в `workers`
+    процессах; проверяет, что выгрузки совпадают побайтно."""
+    products = Product.objects.all()
+
+    def serial():
+        query = ReportQuery(products, empty='', name='bench')
+        source = Pivot(query) if layout == 'wide' else query
+        return ''.join(iter_export(source, layout, export_format))
+
+    def parallel_run():
+        return ''.join(parallel.iter_export(products, layout, export_format,
+                                            empty='', name='bench'))
+
+    started = time.perf_counter()
+    expected = hashlib.sha256(serial().encode()).hexdigest()
+    serial_time = time.perf_counter() - started
+    print(f'Изделий: {products.count()}, ядер: {os.cpu_count()}')
+    print(f'Последовательно: {serial_time:.2f} с')
+    for count in workers:
+        with override_settings(PARALLEL_REPORTS_WORKERS=count):
+            # Первый прогон запускает процессы пула.
+            parallel_run()
+            started = time.perf_counter()
+            digest = hashlib.sha256(parallel_run().encode()).hexdigest()
+            elapsed = time.perf_counter() - started
+        print(f'{count} процессов: {elapsed:.2f} с, ускорение '
+              f'{serial_time / elapsed:.2f}x'
+              + ('' if digest == expected else ' — ВЫГРУЗКА ОТЛИЧАЕТСЯ'))
+
+
+def bench_report_render(template_name='pages/all_products_with_params.html',
+                        key='results'):
+    """Время вывода HTML-таблицы отчёта по всем изделиям циклом шаблона
+    и быстрым выводом; проверяет, что разметка совпадает."""
+    report = build_report(Product.objects.all(), empty='')
+    context = {'results': bool(report), key: report}
+    template = engines['django'].get_template(template_name)
+    table = table_template(template_name, key)
+    if table is None:
+        print('Шаблон не поддерживает быстрый вывод.')
+        return
+
+    def fast():
+        return ''.join(table.stream(context, key))
+
+    started = time.perf_counter()
+    expected = template.render(context)
+    template_time = time.perf_counter() - started
+    started = time.perf_counter()
+    output = fast()
+    fast_time = time.perf_counter() - started
+
+    print(f'Строк отчёта: {sum(len(h.params) for h in report.products)}')
+    print(f'Цикл шаблона: {template_time:.2f} с')
+    print(f'Быстрый вывод: {fast_time:.2f} с, ускорение '
+          f'{template_time / fast_time:.1f}x'
+          + ('' if output == expected else ' — РАЗМЕТКА ОТЛИЧАЕТСЯ'))
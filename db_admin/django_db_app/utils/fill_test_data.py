@@ -36,6 +36,13 @@ def fill_test_data():
         ]
         measures = {name: Measure.objects.create(name=name, name_short=short)
                     for name, short in measure_data}
+        # Дольные единицы переводятся в базовые.
+        for name, base, factor in (("Миллиметр", "Метр", 0.001),
+                                   ("Сантиметр", "Метр", 0.01),
+                                   ("Грамм", "Килограмм", 0.001)):
+            measures[name].base = measures[base]
+            measures[name].factor = factor
+            measures[name].save()
 
         # Категории.
         root_category = Category.objects.create(
@@ -1,9 +1,114 @@
+import json
+import re
+from itertools import chain
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
-from .models import Category, Product, ParameterValue, ParameterAggregate
+from .models import (Category, ExportJob, Measure, Parameter, Product,
+                     ParameterAggregate, StockReservation)
 from django.views.generic.edit import FormView
-from django.views.generic import TemplateView
+from django.views.generic import TemplateView, View
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import (FileResponse, Http404, HttpResponse,
+                         JsonResponse, StreamingHttpResponse)
+from django.utils.decorators import method_decorator
 from django.shortcuts import render, get_object_or_404
-from .forms import CategorySelectForm, ProductSelectForm, ParentParamForm
+from django.urls import reverse
+from .forms import (CategorySelectForm, ProductSelectForm, ParentParamForm,
+                    ReportFormatForm)
+from .analytics import analytics
+from .changes import ChangeLogCompacted, ChangeLogUnavailable, changes_since
+from .jobs import CONTENT_TYPES, job_path, submit
+from .metrics import render as render_metrics
+from .paramcache import param_cache
+from .profiling import list_profiles, phase, profile_dir
+from .registry import registry
+from .replicas import ReplicaReadMixin
+from .rollup import rollups
+from .sharding import fan_out, merge_sorted
+from .tables import render_table
+from . import parallel, stock, units
+from .reports import (ReportQuery, build_report, build_pivot,
+                      iter_rows_csv, iter_rows_json,
+                      iter_pivot_csv, iter_pivot_json)
+
+
+class ReportFormatMixin(ReplicaReadMixin):
+    """Вывод отчёта по изделиям строками или столбцами в HTML, CSV и JSON.
+
+    Данные каталога читаются из реплики, если она задана (`replicas.py`).
+    """
+    pivot_template_name = 'pages/pivot_report.html'
+    report_title = ''
+    export_name = 'report'
+
+    def get_format_form(self):
+        data = (self.request.POST if self.request.method == 'POST'
+                else self.request.GET)
+        return ReportFormatForm(data)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['format_form'] = self.get_format_form()
+        return context
+
+    def stream_export(self, chunks, export_format):
+        response = StreamingHttpResponse(
+            chunks, content_type=CONTENT_TYPES[export_format]
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="{self.export_name}.{export_format}"'
+        )
+        return response
+
+    def render_report(self, products, context, report_key,
+                      param_ids=None, empty=None):
+        format_form = context.setdefault('format_form',
+                                         self.get_format_form())
+        layout = format_form.get_layout()
+        export_format = format_form.get_format()
+
+        if export_format in ('csv', 'json') and parallel.applies(products):
+            return self.stream_export(parallel.iter_export(
+                products, layout, export_format, param_ids=param_ids,
+                empty='' if layout == 'wide' else empty,
+                name=self.export_name
+            ), export_format)
+
+        if layout == 'wide':
+            with phase('build'):
+                pivot = build_pivot(products, param_ids=param_ids,
+                                    name=self.export_name)
+            if export_format == 'csv':
+                return self.stream_export(iter_pivot_csv(pivot), 'csv')
+            if export_format == 'json':
+                return self.stream_export(iter_pivot_json(pivot), 'json')
+            context['pivot'] = pivot
+            context['report_title'] = self.report_title
+            with phase('render'):
+                return render(self.request, self.pivot_template_name,
+                              context)
+
+        if export_format in ('csv', 'json'):
+            query = ReportQuery(products, param_ids=param_ids, empty=empty,
+                                name=self.export_name)
+            chunks = (iter_rows_csv(query) if export_format == 'csv'
+                      else iter_rows_json(query))
+            return self.stream_export(chunks, export_format)
+
+        with phase('build'):
+            context[report_key] = build_report(products, param_ids=param_ids,
+                                               empty=empty,
+                                               name=self.export_name)
+        context.setdefault('results', bool(context[report_key]))
+        # Таблица выводится потоком без цикла шаблона (`tables.py`) уже
+        # после возврата из представления; её вывод учитывают метрики и
+        # профилировщик при выдаче ответа.
+        response = render_table(self.request, self.template_name, context,
+                                report_key)
+        if response is not None:
+            return response
+        with phase('render'):
+            return render(self.request, self.template_name, context)
 
 
 class IndexView(TemplateView):
@@ -17,8 +122,12 @@ class ClassifierView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        categories = Category.objects.filter(is_enum=False)
-        products = Product.objects.all()
+        # При шардинге (`sharding.py`) дерево собирается из всех шардов.
+        categories = chain.from_iterable(
+            fan_out(Category.objects.filter(is_enum=False))
+        )
+        products = chain.from_iterable(fan_out(Product.objects.all()))
+        rollup = rollups.get()
 
         category_map = {}
         for cat in categories:
@@ -36,7 +145,8 @@ class ClassifierView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
                     'id': counter,
                     'name': category.name,
                     'level': level,
-                    'is_product': False
+                    'is_product': False,
+                    'totals': rollup.get(category.id).as_dict(),
                 })
                 for product in sorted(product_map.get(category.id, []),
                                       key=lambda p: p.name):
@@ -56,6 +166,177 @@ class ClassifierView(LoginRequiredMixin, PermissionRequiredMixin, TemplateView):
         return context
 
 
+class ClassifierRollupView(LoginRequiredMixin, PermissionRequiredMixin,
+                           View):
+    """Сводка по поддеревьям категорий в JSON."""
+    permission_required = 'django_db_app.view_category'
+    raise_exception = True
+
+    def get(self, request, *args, **kwargs):
+        rollup = rollups.get()
+        # При шардинге категории читаются из всех шардов и сливаются по имени.
+        categories = merge_sorted(
+            fan_out(Category.objects.filter(is_enum=False).order_by(
+                'name', 'id'
+            ).values_list('id', 'name', 'parent_id')),
+            key=lambda row: (row[1], row[0]),
+        )
+
+        results = []
+        for category_id, name, parent_id in categories:
+            totals = rollup.get(category_id).as_dict()
+            results.append({
+                'id': category_id,
+                'name': name,
+                'parent_id': parent_id,
+                'products': totals['products'],
+                'amount': totals['amount'],
+                'stock_value': str(totals['stock_value']),
+            })
+
+        return JsonResponse({'categories': results})
+
+
+class CatalogChangesView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """Изменения каталога после `since` порциями (см. `changes.py`)."""
+    permission_required = 'django_db_app.view_catalogchange'
+    raise_exception = True
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since = int(request.GET.get('since', 0))
+            limit = request.GET.get('limit')
+            limit = int(limit) if limit else None
+        except ValueError:
+            return JsonResponse({'error': 'Некорректные since или limit.'},
+                                status=400)
+        try:
+            changes, next_seq, has_more = changes_since(since, limit)
+        except ChangeLogCompacted as e:
+            return JsonResponse({'error': str(e)}, status=410)
+        except ChangeLogUnavailable as e:
+            return JsonResponse({'error': str(e)}, status=501)
+        return JsonResponse({
+            'changes': changes,
+            'next': next_seq,
+            'has_more': has_more,
+        })
+
+
+class ParameterStatsView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """Статистика числовых параметров поддерева категории в JSON.
+
+    `?category=<id>&param=<name_short>&param=...&bins=<n>`; без `param` —
+    все числовые параметры.
+    """
+    permission_required = 'django_db_app.view_parametervalue'
+    raise_exception = True
+
+    def get(self, request, *args, **kwargs):
+        try:
+            category_id = int(request.GET['category'])
+            bins = int(request.GET.get('bins', 10))
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'Укажите category и bins числом.'},
+                                status=400)
+        if not 1 <= bins <= 1000:
+            return JsonResponse({'error': 'bins должно быть от 1 до 1000.'},
+                                status=400)
+
+        matrix = analytics.get()
+        if category_id not in matrix.category_row:
+            return JsonResponse({'error': 'Категория не найдена.'},
+                                status=404)
+        param_ids = None
+        names = request.GET.getlist('param')
+        if names:
+            params = registry.get().params_by_name
+            unknown = [name for name in names if name not in params]
+            if unknown:
+                return JsonResponse(
+                    {'error': f"Неизвестные параметры: {', '.join(unknown)}."},
+                    status=400
+                )
+            param_ids = [params[name].id for name in names]
+        return JsonResponse(matrix.stats(category_id, param_ids, bins=bins))
+
+
+class ParameterRangeView(LoginRequiredMixin, PermissionRequiredMixin,
+                         ReplicaReadMixin, View):
+    """Изделия со значением параметра в диапазоне, по возрастанию значения.
+
+    `?param=<name_short>&min=<x>&max=<y>&measure=<name_short>&category=<id>`
+    `&limit=<n>`: границы и значения — в единице `measure` (совместимой с
+    единицей параметра, у перечислений — категории-перечисления, по
+    умолчанию — в ней самой); значение изделия без
+    собственного берётся из категории. Отбор выполняется по значениям в
+    базовых единицах (см. `units.py`).
+    """
+    permission_required = 'django_db_app.view_product'
+    raise_exception = True
+    max_limit = 1000
+
+    def error(self, message, status=400):
+        return JsonResponse({'error': message}, status=status)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            low, high = (float(request.GET[name]) if request.GET.get(name)
+                         else None for name in ('min', 'max'))
+            limit = int(request.GET.get('limit', 100))
+            category_id = request.GET.get('category')
+            category_id = int(category_id) if category_id else None
+        except ValueError:
+            return self.error('min, max, limit и category должны быть '
+                              'числами.')
+        if not 1 <= limit <= self.max_limit:
+            return self.error(f'limit должно быть от 1 до {self.max_limit}.')
+
+        param = Parameter.objects.select_related(
+            'measure', 'enum__measure'
+        ).filter(name_short=request.GET.get('param', '')).first()
+        if param is None:
+            return self.error('Параметр не найден.', status=404)
+        measure = units.value_measure(param)
+        if request.GET.get('measure'):
+            measure = Measure.objects.filter(
+                name_short=request.GET['measure']
+            ).first()
+            if measure is None:
+                return self.error('Единица измерения не найдена.',
+                                  status=404)
+
+        products = Product.objects.all()
+        if category_id is not None:
+            category = next(chain.from_iterable(
+                fan_out(Category.objects.filter(pk=category_id))
+            ), None)
+            if category is None:
+                return self.error('Категория не найдена.', status=404)
+            products = products.filter(
+                category_id__in=category.get_subtree_ids()
+            )
+        try:
+            parts = [units.in_range(part, param, low, high, measure, limit)
+                     for part in fan_out(products)]
+        except units.IncompatibleUnits as e:
+            return self.error(str(e))
+
+        found = []
+        for value, product_id, name, category in merge_sorted(
+                parts, key=lambda row: row[:2]):
+            if len(found) == limit:
+                break
+            found.append({'id': product_id, 'name': name,
+                          'category_id': category,
+                          'value': units.convert(value, measure)})
+        return JsonResponse({
+            'param': param.name_short,
+            'measure': measure.name_short if measure else None,
+            'products': found,
+        })
+
+
 class DescendantsByCategoryView(LoginRequiredMixin, PermissionRequiredMixin,
                                 FormView):
     permission_required = 'django_db_app.view_category'
@@ -181,10 +462,12 @@ class TerminalCategoriesView(LoginRequiredMixin, PermissionRequiredMixin,
 
 
 class ProductsWithParamsView(LoginRequiredMixin, PermissionRequiredMixin,
-                             FormView):
+                             ReportFormatMixin, FormView):
     permission_required = 'django_db_app.view_product'
     template_name = 'pages/products_with_params.html'
     form_class = CategorySelectForm
+    report_title = 'Изделия в категории'
+    export_name = 'products_with_params'
 
     def form_valid(self, form):
         selected_category = form.cleaned_data['category']
@@ -200,154 +483,30 @@ class ProductsWithParamsView(LoginRequiredMixin, PermissionRequiredMixin,
             category_ids.append(category.id)
             categories_to_check.extend(category.subcategories.all())
 
-        # Получаем все продукты в этих категориях.
-        products = Product.objects.filter(
-            category_id__in=category_ids
-        ).select_related('category', 'category__measure')
-
-        results = []
-
-        for product in products:
-            # Сначала получаем параметры самого продукта.
-            param_values = ParameterValue.objects.filter(
-                product=product
-            ).select_related('param', 'param__measure', 'value_enum')
-
-            # Затем параметры категории,
-            # если не переопределены на уровне продукта.
-            overridden_params = {pv.param_id for pv in param_values}
-
-            inherited_param_values = ParameterValue.objects.filter(
-                category=product.category
-            ).exclude(
-                param_id__in=overridden_params
-            ).select_related('param', 'param__measure', 'value_enum')
-
-            combined_params = list(param_values) + list(inherited_param_values)
-
-            for pv in combined_params:
-                param = pv.param
-                value = None
-                if param.data_type == 'int':
-                    value = str(pv.value_int)
-                elif param.data_type == 'real':
-                    value = str(pv.value_real)
-                elif param.data_type == 'str':
-                    value = pv.value_str
-                elif param.data_type == 'path':
-                    value = pv.value_path
-                elif param.data_type == 'enum' and pv.value_enum:
-                    value = (pv.value_enum.value_str or
-                             pv.value_enum.value_int or
-                             pv.value_enum.value_real or
-                             pv.value_enum.value_path)
-
-                results.append({
-                    'category_id': product.category.id,
-                    'category': product.category.name,
-                    'product_id': product.id,
-                    'product': product.name,
-                    'amount': product.amount,
-                    'measure': (product.category.measure.name_short
-                                if product.category.measure else ''),
-                    'price': product.price,
-                    'param_id': param.id,
-                    'param_name': param.name_short,
-                    'param_type': param.data_type,
-                    'param_value': value,
-                    'param_measure': (param.measure.name_short
-                                      if param.measure else ''),
-                })
-
-        return render(self.request, self.template_name, {
-            'form': form,
-            'selected_category': selected_category,
-            'products': results,
-            'results': True,
-        })
+        # Получаем все продукты в этих категориях вместе с параметрами.
+        return self.render_report(
+            Product.objects.filter(category_id__in=category_ids), {
+                'form': form,
+                'selected_category': selected_category,
+                'results': True,
+            }, 'products'
+        )
 
 
 class AllProductsWithParamsView(LoginRequiredMixin, PermissionRequiredMixin,
-                                TemplateView):
+                                ReportFormatMixin, TemplateView):
     permission_required = 'django_db_app.view_product'
     template_name = 'pages/all_products_with_params.html'
+    report_title = 'Все продукты и их параметры'
+    export_name = 'all_products_with_params'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
-
-        # Получаем все продукты, которые принадлежат корневой категории.
-        products = Product.objects.all().select_related(
-            'category', 'category__measure'
-        )
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
 
-        results = []
-
-        # Для каждого продукта получаем параметры.
-        for product in products:
-            # Параметры, заданные для продукта.
-            param_values = ParameterValue.objects.filter(
-                product=product
-            ).select_related('param', 'param__measure', 'value_enum')
-
-            # Параметры, заданные для категории,
-            # если они не переопределены на уровне продукта.
-            overridden_params = {pv.param_id for pv in param_values}
-            inherited_param_values = ParameterValue.objects.filter(
-                category=product.category
-            ).exclude(
-                param_id__in=overridden_params
-            ).select_related('param', 'param__measure', 'value_enum')
-
-            # Комбинируем параметры продукта и параметры категории.
-            combined_params = list(param_values) + list(inherited_param_values)
-
-            # Добавляем результат для каждого параметра.
-            for pv in combined_params:
-                param = pv.param
-                value = None
-
-                # Преобразуем значение в строку в зависимости от типа данных.
-                if param.data_type == 'int':
-                    value = str(pv.value_int) if pv.value_int else ''
-                elif param.data_type == 'real':
-                    value = str(pv.value_real) if pv.value_real else ''
-                elif param.data_type == 'str':
-                    value = pv.value_str if pv.value_str else ''
-                elif param.data_type == 'path':
-                    value = pv.value_path if pv.value_path else ''
-                elif param.data_type == 'enum' and pv.value_enum:
-                    value = (pv.value_enum.value_str or
-                             pv.value_enum.value_int or
-                             pv.value_enum.value_real or
-                             pv.value_enum.value_path)
-                else:
-                    value = ''  # Если нет значений, оставляем пустую строку.
-
-                # Добавляем информацию о продукте и параметре в результаты.
-                try:
-                    results.append({
-                        'category_id': product.category.id,
-                        'category': product.category.name,
-                        'product_id': product.id,
-                        'product': product.name,
-                        'amount': product.amount,
-                        'measure': (product.category.measure.name_short
-                                    if product.category.measure else ''),
-                        'price': product.price,
-                        'param_id': param.id,
-                        'param_name': param.name_short,
-                        'param_type': param.data_type,
-                        'param_value': value,
-                        'param_measure': (param.measure.name_short
-                                          if param.measure else ''),
-                    })
-                except Exception as e:
-                    print(f"Error while processing {product.name}: {e}")
-                    continue
-
-        # Добавляем результаты в контекст.
-        context['results'] = results
-        return context
+        # Параметры, заданные для продукта, и параметры категории,
+        # если они не переопределены на уровне продукта.
+        return self.render_report(Product.objects.all(), context, 'results',
+                                  empty='')
 
 
 class ProductParamsView(LoginRequiredMixin, PermissionRequiredMixin,
@@ -362,9 +521,9 @@ class ProductParamsView(LoginRequiredMixin, PermissionRequiredMixin,
             form = ProductSelectForm(self.request.GET)
             if form.is_valid():
                 product = form.cleaned_data['product']
-                params = ParameterValue.objects.filter(
-                    product=product
-                ).select_related('param', 'param__measure', 'value_enum')
+                # Собственные и унаследованные от категории значения
+                # (см. `paramcache.py`).
+                params = param_cache.get(product)
             else:
                 product = None
                 params = []
@@ -386,12 +545,435 @@ class ProductParamsView(LoginRequiredMixin, PermissionRequiredMixin,
         return context
 
 
-class ProductsWithAggregateParamsView(TemplateView):
+class BatchProductParamsView(LoginRequiredMixin, PermissionRequiredMixin,
+                             ReplicaReadMixin, View):
+    """Параметры многих изделий одним запросом в JSON.
+
+    POST с телом `{"products": [<id>, ...], "params": [<name_short>, ...]}`;
+    без `params` — все параметры. Значения разрешаются как в отчётах
+    (`ReportQuery`): собственные значения изделия и не переопределённые
+    значения его категории, перечисления — отображаемым значением. Число
+    запросов к базе не зависит от числа изделий. Изделия выводятся в
+    порядке запроса, ненайденные перечисляются в `missing`.
+    """
+    permission_required = 'django_db_app.view_product'
+    raise_exception = True
+
+    def error(self, message, status=400):
+        return JsonResponse({'error': message}, status=status)
+
+    def post(self, request, *args, **kwargs):
+        max_body = getattr(settings, 'BATCH_PARAMS_MAX_BODY', 65536)
+        max_products = getattr(settings, 'BATCH_PARAMS_MAX_PRODUCTS', 500)
+        max_params = getattr(settings, 'BATCH_PARAMS_MAX_PARAMS', 100)
+
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_body or len(request.body) > max_body:
+            return self.error(f'Тело запроса больше {max_body} байт.',
+                              status=413)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return self.error('Тело запроса должно быть JSON.')
+        if not isinstance(data, dict):
+            return self.error('Ожидается JSON-объект.')
+
+        product_ids = data.get('products')
+        names = data.get('params')
+        if (not isinstance(product_ids, list) or not product_ids or
+                not all(type(i) is int for i in product_ids)):
+            return self.error('products — непустой список идентификаторов.')
+        if names is not None and (
+                not isinstance(names, list) or
+                not all(isinstance(name, str) for name in names)):
+            return self.error('params — список кратких имён параметров.')
+        product_ids = list(dict.fromkeys(product_ids))
+        if len(product_ids) > max_products:
+            return self.error(f'Не больше {max_products} изделий за запрос.',
+                              status=413)
+
+        param_ids = None
+        if names is not None:
+            names = list(dict.fromkeys(names))
+            if len(names) > max_params:
+                return self.error(
+                    f'Не больше {max_params} параметров за запрос.',
+                    status=413
+                )
+            params = registry.get().params_by_name
+            unknown = [name for name in names if name not in params]
+            if unknown:
+                return self.error(
+                    f"Неизвестные параметры: {', '.join(unknown)}."
+                )
+            param_ids = [params[name].id for name in names]
+
+        query = ReportQuery(Product.objects.filter(pk__in=product_ids),
+                            param_ids=param_ids,
+                            name='batch_product_params')
+        found = {}
+        for header in query:
+            found[header.product_id] = {
+                'id': header.product_id,
+                'name': header.product,
+                'category_id': header.category_id,
+                'category': header.category,
+                'amount': header.amount,
+                'measure': header.measure,
+                'price': str(header.price),
+                'params': [
+                    {
+                        'param_id': param_id,
+                        'name_short': query.params[param_id].name_short,
+                        'name': query.params[param_id].name,
+                        'data_type': query.params[param_id].data_type,
+                        'measure': query.params[param_id].measure,
+                        'value': value,
+                    }
+                    for param_id, value in header.params
+                ],
+            }
+        return JsonResponse({
+            'products': [found[i] for i in product_ids if i in found],
+            'missing': [i for i in product_ids if i not in found],
+        })
+
+
+class SimilarProductsView(LoginRequiredMixin, PermissionRequiredMixin, View):
+    """Изделия, ближайшие к заданному по числовым параметрам, в JSON.
+
+    `?k=<n>&category=<id>&aggregate=<name_short>&param=<name_short>&in_stock=1`:
+    параметры задаются агрегатом (например, «Размеры») или списком `param`,
+    по умолчанию — все числовые параметры; `category` ограничивает поиск
+    поддеревом, `in_stock=1` исключает изделия с нулевым остатком.
+    """
+    permission_required = 'django_db_app.view_product'
+    raise_exception = True
+    max_k = 100
+
+    def error(self, message, status=400):
+        return JsonResponse({'error': message}, status=status)
+
+    def get(self, request, pk, *args, **kwargs):
+        try:
+            k = int(request.GET.get('k', 10))
+            category_id = request.GET.get('category')
+            category_id = int(category_id) if category_id else None
+        except ValueError:
+            return self.error('k и category должны быть числами.')
+        if not 1 <= k <= self.max_k:
+            return self.error(f'k должно быть от 1 до {self.max_k}.')
+
+        snapshot = registry.get()
+        matrix = analytics.get()
+        names = request.GET.getlist('param')
+        aggregate = request.GET.get('aggregate')
+        if aggregate:
+            parent = snapshot.params_by_name.get(aggregate)
+            if parent is None or parent.id not in snapshot.aggregates:
+                return self.error(f'Агрегат «{aggregate}» не найден.')
+            param_ids = snapshot.aggregates[parent.id]
+        elif names:
+            unknown = [name for name in names
+                       if name not in snapshot.params_by_name]
+            if unknown:
+                return self.error(
+                    f"Неизвестные параметры: {', '.join(unknown)}."
+                )
+            param_ids = [snapshot.params_by_name[name].id for name in names]
+        else:
+            param_ids = [meta.id for meta in matrix.params]
+        if category_id is not None and category_id not in matrix.category_row:
+            return self.error('Категория не найдена.', status=404)
+
+        try:
+            nearest = matrix.similar(
+                pk, param_ids, category_id=category_id, k=k,
+                in_stock=request.GET.get('in_stock') == '1',
+            )
+        except KeyError:
+            return self.error('Изделие не найдено.', status=404)
+
+        ids = [pk] + [product_id for product_id, _, _ in nearest]
+        values = matrix.product_values(ids, param_ids)
+        params = [snapshot.params[param_id] for param_id in param_ids
+                  if param_id in matrix.column]
+        products = {
+            product_id: (name, category, amount, price)
+            for part in fan_out(Product.objects.filter(pk__in=ids))
+            for product_id, name, category, amount, price in
+            part.values_list('id', 'name', 'category__name', 'amount',
+                             'price')
+        }
+
+        if pk not in products:
+            return self.error('Изделие не найдено.', status=404)
+
+        def describe(product_id):
+            name, category, amount, price = products[product_id]
+            return {
+                'id': product_id,
+                'name': name,
+                'category': category,
+                'amount': amount,
+                'price': str(price),
+                'values': {
+                    meta.name_short: values.get(product_id, {}).get(meta.id)
+                    for meta in params
+                },
+            }
+
+        results = []
+        for product_id, distance, shared in nearest:
+            if product_id in products:
+                results.append({**describe(product_id),
+                                'distance': round(distance, 6),
+                                'shared': shared})
+        return JsonResponse({
+            'product': describe(pk),
+            'params': [meta.name_short for meta in params],
+            # Единицы значений (у перечислений — категории-перечисления).
+            'measures': {
+                meta.name_short: matrix.measures[matrix.column[meta.id]]
+                for meta in params
+            },
+            'results': results,
+        })
+
+
+class ExportJobMixin(LoginRequiredMixin, PermissionRequiredMixin):
+    permission_required = 'django_db_app.view_product'
+    raise_exception = True
+
+    def error(self, message, status=400):
+        return JsonResponse({'error': message}, status=status)
+
+    def describe(self, job):
+        done = job.status == ExportJob.DONE
+        return {
+            'id': job.pk,
+            'kind': job.kind,
+            'params': job.params,
+            'layout': job.layout,
+            'format': job.format,
+            'status': job.status,
+            'rows': job.rows,
+            'total': job.total,
+            'error': job.error or None,
+            'created_at': job.created_at,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+            'expires_at': job.expires_at,
+            'progress': self.request.build_absolute_uri(
+                reverse('django_db_app:export_job', args=[job.pk])
+            ),
+            'download': self.request.build_absolute_uri(
+                reverse('django_db_app:export_job_download', args=[job.pk])
+            ) if done else None,
+        }
+
+
+class ExportJobCreateView(ExportJobMixin, View):
+    """Ставит выгрузку отчёта в очередь (см. `jobs.py`).
+
+    POST с телом `{"kind": "<вид>", "params": {...}, "layout": "tall",
+    "format": "csv"}`; виды — имена страниц отчётов, параметры — поля их
+    форм (`category`, `parent_param_id`). Возвращает задание со ссылкой
+    на ход выполнения; такая же незавершённая выгрузка не создаётся
+    повторно.
+    """
+    forms = {
+        'products_with_params': CategorySelectForm,
+        'all_products_with_params': None,
+        'products_with_aggregate_params': ParentParamForm,
+    }
+
+    def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return self.error('Тело запроса должно быть JSON.')
+        if not isinstance(data, dict):
+            return self.error('Ожидается JSON-объект.')
+
+        kind = data.get('kind')
+        if kind not in self.forms:
+            return self.error(f"kind — один из: {', '.join(self.forms)}.")
+        params = data.get('params') or {}
+        if not isinstance(params, dict):
+            return self.error('params — JSON-объект.')
+        format_form = ReportFormatForm({'layout': data.get('layout'),
+                                        'format': data.get('format', 'csv')})
+        if not format_form.is_valid() or format_form.get_format() == 'html':
+            return self.error('layout — tall или wide, format — csv или '
+                              'json.')
+
+        form_class = self.forms[kind]
+        cleaned = {}
+        if form_class is not None:
+            form = form_class(params)
+            if not form.is_valid():
+                return JsonResponse({'error': 'Неверные параметры.',
+                                     'fields': form.errors}, status=400)
+            cleaned = {name: getattr(value, 'pk', value)
+                       for name, value in form.cleaned_data.items()}
+
+        job, created = submit(kind, cleaned, format_form.get_layout(),
+                              format_form.get_format(), request.user)
+        return JsonResponse({**self.describe(job), 'created': created},
+                            status=202 if created else 200)
+
+
+class ExportJobView(ExportJobMixin, View):
+    """Ход выполнения выгрузки: изделий выгружено `rows` из `total`."""
+
+    def get(self, request, pk, *args, **kwargs):
+        job = ExportJob.objects.filter(pk=pk).first()
+        if job is None:
+            return self.error('Выгрузка не найдена.', status=404)
+        return JsonResponse(self.describe(job))
+
+
+class ExportJobDownloadView(ExportJobMixin, View):
+    def get(self, request, pk, *args, **kwargs):
+        job = ExportJob.objects.filter(pk=pk).first()
+        if job is None:
+            return self.error('Выгрузка не найдена.', status=404)
+        if job.status != ExportJob.DONE:
+            return self.error('Выгрузка ещё не готова.', status=409)
+        try:
+            f = open(job_path(job), 'rb')
+        except FileNotFoundError:
+            return self.error('Файл выгрузки удалён.', status=410)
+        return FileResponse(f, as_attachment=True,
+                            filename=f'{job.kind}.{job.format}',
+                            content_type=CONTENT_TYPES[job.format])
+
+
+class StockReservationMixin(LoginRequiredMixin, PermissionRequiredMixin):
+    permission_required = 'django_db_app.change_product'
+    raise_exception = True
+
+    def error(self, message, status=400, **extra):
+        return JsonResponse({'error': message, **extra}, status=status)
+
+    def stock_error(self, e):
+        if isinstance(e, stock.InsufficientStock):
+            return self.error(str(e), status=409, insufficient=e.product_ids)
+        if isinstance(e, stock.ReservationNotFound):
+            return self.error(str(e), status=404)
+        return self.error(str(e), status=409,
+                          reservation_status=e.status)
+
+    def describe(self, reservation):
+        items = getattr(reservation, 'reserved_items', None)
+        if items is None:
+            items = reservation.items.order_by('product_id')
+        return {
+            'id': str(reservation.pk),
+            'status': reservation.status,
+            'items': [{'product': item.product_id, 'quantity': item.quantity}
+                      for item in items],
+            'created_at': reservation.created_at,
+            'expires_at': reservation.expires_at,
+            'finished_at': reservation.finished_at,
+        }
+
+
+class StockReservationCreateView(StockReservationMixin, View):
+    """Резервирует остатки нескольких изделий (см. `stock.py`).
+
+    POST с телом `{"items": [{"product": <id>, "quantity": <n>}, ...],
+    "ttl": <секунды>}`; `ttl` необязателен. Резерв создаётся целиком или не
+    создаётся: при нехватке остатка — 409 со списком изделий в
+    `insufficient`.
+    """
+
+    def post(self, request, *args, **kwargs):
+        max_items = getattr(settings, 'STOCK_RESERVATION_MAX_ITEMS', 100)
+        max_ttl = getattr(settings, 'STOCK_RESERVATION_MAX_TTL', 3600)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return self.error('Тело запроса должно быть JSON.')
+        if not isinstance(data, dict):
+            return self.error('Ожидается JSON-объект.')
+
+        items = data.get('items')
+        if (not isinstance(items, list) or not items or
+                not all(isinstance(item, dict) for item in items)):
+            return self.error('items — непустой список объектов.')
+        if len(items) > max_items:
+            return self.error(f'Не больше {max_items} изделий за запрос.',
+                              status=413)
+        ttl = data.get('ttl')
+        if ttl is not None and (type(ttl) is not int or
+                                not 0 < ttl <= max_ttl):
+            return self.error(f'ttl — целое число секунд от 1 до {max_ttl}.')
+        try:
+            items = stock.normalize_items(
+                (item.get('product'), item.get('quantity')) for item in items
+            )
+        except ValueError as e:
+            return self.error(str(e))
+        missing = set(items) - set(Product.objects.filter(
+            pk__in=list(items)
+        ).values_list('pk', flat=True))
+        if missing:
+            return self.error('Изделия не найдены.', status=404,
+                              missing=sorted(missing))
+
+        try:
+            reservation = stock.reserve(items, ttl, request.user)
+        except stock.StockError as e:
+            return self.stock_error(e)
+        return JsonResponse(self.describe(reservation), status=201)
+
+
+class StockReservationView(StockReservationMixin, View):
+    def get(self, request, pk, *args, **kwargs):
+        reservation = StockReservation.objects.filter(pk=pk).first()
+        if reservation is None:
+            return self.error('Резерв не найден.', status=404)
+        return JsonResponse(self.describe(reservation))
+
+
+class StockReservationCommitView(StockReservationMixin, View):
+    """Подтверждает резерв; просроченный или отменённый — 409."""
+
+    def post(self, request, pk, *args, **kwargs):
+        try:
+            reservation = stock.commit(pk)
+        except stock.StockError as e:
+            return self.stock_error(e)
+        return JsonResponse(self.describe(reservation))
+
+
+class StockReservationReleaseView(StockReservationMixin, View):
+    """Отменяет резерв и возвращает остатки."""
+
+    def post(self, request, pk, *args, **kwargs):
+        try:
+            reservation = stock.release(pk)
+        except stock.StockError as e:
+            return self.stock_error(e)
+        return JsonResponse(self.describe(reservation))
+
+
+class ProductsWithAggregateParamsView(LoginRequiredMixin,
+                                     PermissionRequiredMixin,
+                                     ReportFormatMixin, TemplateView):
     template_name = 'pages/products_with_aggregate_params.html'
     permission_required = 'django_db_app.view_product'
+    raise_exception = True
+    report_title = 'Продукты с параметрами агрегата'
+    export_name = 'products_with_aggregate_params'
 
-    def get_context_data(self, **kwargs):
-        context = super().get_context_data(**kwargs)
+    def get(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
 
         if 'parent_param_id' in self.request.GET:
             form = ParentParamForm(self.request.GET)
@@ -405,103 +987,52 @@ class ProductsWithAggregateParamsView(TemplateView):
 
         context['form'] = form
 
-        products_with_params = self.get_products_with_params()
+        if not parent_param_id:
+            context['aggregate_params'] = []
+            context['results'] = False
+            return self.render_to_response(context)
 
-        aggregate_params = self.filter_params_by_aggregate(products_with_params,
-                                                           parent_param_id) \
-            if parent_param_id else []
+        # Строим отчёт только по параметрам агрегата.
+        return self.render_report(
+            Product.objects.all(), context, 'aggregate_params',
+            param_ids=self.get_aggregate_param_ids(parent_param_id)
+        )
 
-        context['aggregate_params'] = aggregate_params
-        context['results'] = bool(aggregate_params)
+    def get_aggregate_param_ids(self, parent_param_id):
+        # Получаем все параметры, связанные с родительским параметром.
+        return list(ParameterAggregate.objects.filter(
+            parent_param_id=parent_param_id
+        ).order_by('pk').values_list('param_id', flat=True))
 
-        return context
 
-    def get_products_with_params(self):
-        results = []
+@method_decorator(staff_member_required, name='dispatch')
+class ProfileListView(TemplateView):
+    """Последние профили запросов (см. `profiling.py`)."""
+    template_name = 'admin/profiles.html'
 
-        # Получаем все продукты с оптимизированными запросами
-        # для связанных объектов.
-        products = Product.objects.select_related(
-            'category', 'category__measure'
-        ).all()
-
-        for product in products:
-            # Получаем параметры продукта.
-            product_param_values = list(
-                ParameterValue.objects.filter(product=product).select_related(
-                    'param', 'param__measure', 'value_enum'
-                )
-            )
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['title'] = 'Профили запросов'
+        context['profiles'] = list_profiles(limit=100)
+        return context
 
-            used_param_ids = [pv.param_id for pv in product_param_values]
-
-            # Получаем наследуемые параметры категории,
-            # если они не переопределены на уровне продукта.
-            inherited_param_values = ParameterValue.objects.filter(
-                category=product.category
-            ).exclude(
-                param_id__in=used_param_ids
-            ).select_related('param', 'param__measure', 'value_enum')
-
-            # Объединяем параметры продукта и наследуемые параметры.
-            combined_params = (product_param_values +
-                               list(inherited_param_values))
-
-            for pv in combined_params:
-                param = pv.param
-                value = None
-
-                # Приведение значений к строкам в зависимости от типа данных.
-                if param.data_type == 'int':
-                    value = str(pv.value_int)
-                elif param.data_type == 'real':
-                    value = str(pv.value_real)
-                elif param.data_type == 'str':
-                    value = pv.value_str
-                elif param.data_type == 'path':
-                    value = pv.value_path
-                elif param.data_type == 'enum' and pv.value_enum:
-                    if pv.value_enum.value_str is not None:
-                        value = pv.value_enum.value_str
-                    elif pv.value_enum.value_int is not None:
-                        value = str(pv.value_enum.value_int)
-                    elif pv.value_enum.value_real is not None:
-                        value = str(pv.value_enum.value_real)
-                    elif pv.value_enum.value_path is not None:
-                        value = pv.value_enum.value_path
-
-                # Добавляем результат в список.
-                results.append({
-                    'category_id': product.category.id,
-                    'category': product.category.name,
-                    'product_id': product.id,
-                    'product': product.name,
-                    'amount': product.amount,
-                    'measure': (product.category.measure.name_short
-                                if product.category.measure else ''),
-                    'price': product.price,
-                    'param_id': param.id,
-                    'param_name': param.name_short,
-                    'param_type': param.data_type,
-                    'param_value': value,
-                    'param_measure': (param.measure.name_short
-                                      if param.measure else '')
-                })
 
-        return results
+@method_decorator(staff_member_required, name='dispatch')
+class ProfileDownloadView(View):
+    name_pattern = re.compile(r'^[0-9A-Za-z-]+\.(folded|json)$')
 
-    def filter_params_by_aggregate(self, products_with_params, parent_param_id):
-        aggregate_params = []
+    def get(self, request, name):
+        path = profile_dir() / name
+        if not self.name_pattern.match(name) or not path.is_file():
+            raise Http404('Профиль не найден.')
+        return FileResponse(open(path, 'rb'), as_attachment=True,
+                            filename=name)
 
-        # Получаем все параметры, связанные с родительским параметром.
-        parent_params = ParameterAggregate.objects.filter(
-            parent_param_id=parent_param_id
-        )
-        parent_param_ids = set(pp.param_id for pp in parent_params)
 
-        # Фильтруем параметры продуктов, связанные с родительским параметром.
-        for product_param in products_with_params:
-            if product_param['param_id'] in parent_param_ids:
-                aggregate_params.append(product_param)
+class MetricsView(View):
+    """Метрики в текстовом формате Prometheus (см. `metrics.py`)."""
 
-        return aggregate_params
+    def get(self, request):
+        return HttpResponse(render_metrics(),
+                            content_type='text/plain; version=0.0.4; '
+                                         'charset=utf-8')
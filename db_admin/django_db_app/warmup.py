@@ -0,0 +1,88 @@
+"""Прогрев процесса до приёма запросов.
+
+`warm_up()` один раз строит структуры, которые иначе строятся на первых
+запросах каждого рабочего процесса: маршруты (и вместе с ними модули
+представлений, форм и отчётов), скомпилированные шаблоны, реестр
+метаданных, сводку по категориям и, по желанию, матрицу аналитики.
+
+Вызывается из `db_admin/wsgi.py`, если `WARMUP_ON_STARTUP` включён. При
+запуске с предзагрузкой приложения в главном процессе, например
+```bash
+gunicorn db_admin.wsgi --preload --workers 4
+```
+прогрев выполняется до fork, и рабочие процессы разделяют построенные
+структуры copy-on-write. Перед fork закрываются соединения с базой, а
+объекты переводятся в постоянное поколение сборщика мусора (`gc.freeze()`),
+чтобы он не копировал разделяемые страницы при обходе.
+
+В `AppConfig.ready()` прогрев не выполняется: `ready()` вызывается и для
+команд `manage.py`, в том числе до создания таблиц.
+
+Время прогрева и время от запуска процесса до первого ответа
+записываются в метрику `catalog_startup_seconds`; их внешнее измерение —
+команда `startup_time`.
+"""
+
+import gc
+import logging
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.template import engines
+from django.urls import get_resolver
+
+from . import metrics
+from .registry import registry
+from .rollup import rollups
+
+logger = logging.getLogger(__name__)
+
+
+def _templates():
+    """Имена шаблонов проекта (`TEMPLATES['DIRS']`)."""
+    for engine in engines.all():
+        for directory in getattr(engine, 'dirs', ()):
+            root = Path(directory)
+            for path in root.rglob('*.html'):
+                yield path.relative_to(root).as_posix()
+
+
+def warm_up(analytics=None):
+    """Прогревает процесс; возвращает длительность этапов в секундах."""
+    if analytics is None:
+        analytics = getattr(settings, 'WARMUP_ANALYTICS', False)
+    stages = {}
+    started = time.perf_counter()
+
+    def stage(name, func):
+        stage_started = time.perf_counter()
+        func()
+        stages[name] = round(time.perf_counter() - stage_started, 4)
+
+    def load_templates():
+        engine = engines['django']
+        for name in _templates():
+            engine.get_template(name)
+
+    stage('urls', lambda: get_resolver().url_patterns)
+    stage('templates', load_templates)
+    stage('registry', registry.get)
+    stage('rollups', rollups.get)
+    if analytics:
+        from .analytics import analytics as matrix
+        stage('analytics', matrix.get)
+
+    # Соединения не должны переходить в дочерние процессы.
+    connections.close_all()
+    if getattr(settings, 'WARMUP_GC_FREEZE', True):
+        gc.collect()
+        gc.freeze()
+
+    total = time.perf_counter() - started
+    stages['total'] = round(total, 4)
+    metrics.startup_duration.observe(total, 'warmup')
+    metrics.flush(force=True)
+    logger.info('Прогрев завершён за %.3f с: %s', total, stages)
+    return stages